@@ -0,0 +1,58 @@
+
+# The ids that an internal link, [text](#id), can point to: the sections and
+# the headers with an id. They are collected before rendering, so a link is
+# resolved with a dict lookup and all the broken links are found at once
+
+import re
+
+from book_section import _parse_header_line
+
+INTERNAL_LINK_RE = re.compile(r'\[(?P<text>[^\]]+)\]\(#(?P<link_id>[^\)]+)\)')
+
+
+def get_header_anchor_id(header_line, section_id):
+    # the id of the main header is the section id, the section already has it
+    header_id = _parse_header_line(header_line).get('id')
+    if header_id == section_id:
+        return None
+    return header_id
+
+
+def scan_md_anchors(md_lines, section_id):
+    header_ids = []
+    text_lines = []
+    for line in md_lines:
+        if line.startswith('#'):
+            header_id = get_header_anchor_id(line, section_id)
+            if header_id:
+                header_ids.append(header_id)
+        else:
+            text_lines.append(line)
+    link_ids = [match.group('link_id')
+                for match in INTERNAL_LINK_RE.finditer(''.join(text_lines))]
+    return {'header_ids': header_ids, 'link_ids': link_ids}
+
+
+class AnchorTable:
+    def __init__(self):
+        self._urls = {}
+        self._links = []
+
+    def add_anchor(self, anchor_id, url):
+        if anchor_id in self._urls:
+            raise ValueError(f'Repeated id: {anchor_id}')
+        self._urls[anchor_id] = url
+
+    def add_link(self, source_id, link_id):
+        self._links.append((source_id, link_id))
+
+    def get_url(self, anchor_id):
+        return self._urls[anchor_id]
+
+    def check_links(self):
+        dangling_links = [f'#{link_id} in {source_id}'
+                          for source_id, link_id in self._links
+                          if link_id not in self._urls]
+        if dangling_links:
+            msg = 'Internal links to ids that do not exist: ' + ', '.join(dangling_links)
+            raise ValueError(msg)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Answers like pandoc with pandoc-citeproc for the markdown written by
+# references.process_citations, so the benchmarks do not depend on pandoc
+# pandoc_stub.py --csl style.csl --bibliography library.json < text.md
+
+import argparse
+import json
+import re
+import sys
+
+CITATION_RE = re.compile(r'@(?P<key>[^ \],;<]+)[^<]*<(?P<id>[^>]+)>')
+ITEM_RE = re.compile(r'^item\s+\[(?P<citations>.*)\]$', re.DOTALL)
+
+
+def _format_reference(entry):
+    author = entry['author'][0]
+    year = entry['issued']['date-parts'][0][0]
+    return f'{author["family"]}, {author["given"]} <em>{entry["title"]}</em>. {year}.'
+
+
+def _format_note(key, id_, library):
+    if key not in library:
+        return (f'<span class="citeproc-not-found" data-reference-id="{key}">'
+                f'<strong>???</strong></span> &lt;{id_}&gt;')
+    entry = library[key]
+    return f'{entry["author"][0]["family"]}, <em>{entry["title"]}</em> &lt;{id_}&gt;'
+
+
+def render_citations(md_text, library):
+    paragraphs = []
+    notes = []
+    keys_cited = []
+    for item_text in md_text.split('\n\n'):
+        match = ITEM_RE.match(item_text.strip())
+        if not match:
+            paragraphs.append(f'<p>{item_text}</p>')
+            continue
+        citations = CITATION_RE.findall(match.group('citations'))
+        keys = [key for key, _ in citations]
+        keys_cited.extend(key for key in keys if key not in keys_cited)
+        number = len(notes) + 1
+        paragraphs.append(f'<p>item <span class="citation" data-cites="{" ".join(keys)}">'
+                          f'<a href="#fn{number}" class="footnote-ref" id="fnref{number}" '
+                          f'role="doc-noteref"><sup>{number}</sup></a></span></p>')
+        note = '; '.join(_format_note(key, id_, library) for key, id_ in citations)
+        notes.append(f'<li id="fn{number}" role="doc-endnote"><p>{note}.'
+                     f'<a href="#fnref{number}" class="footnote-back" '
+                     f'role="doc-backlink">↩︎</a></p></li>')
+
+    html = paragraphs
+    references = [f'<div id="ref-{key}"><p>{_format_reference(library[key])}</p></div>'
+                  for key in keys_cited if key in library]
+    if references:
+        html.append('<div id="refs" class="references" role="doc-bibliography">')
+        html.extend(references)
+        html.append('</div>')
+    html.append('<section class="footnotes" role="doc-endnotes">\n<hr />\n<ol>')
+    html.extend(notes)
+    html.append('</ol>\n</section>')
+    return '\n'.join(html) + '\n'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--csl')
+    parser.add_argument('--bibliography', required=True)
+    parser.add_argument('--filter')
+    parser.add_argument('md_path', nargs='?', default=None)
+    args = parser.parse_args()
+    with open(args.bibliography) as fhand:
+        library = {entry['id']: entry for entry in json.load(fhand)}
+    if args.md_path is None:
+        md_text = sys.stdin.read()
+    else:
+        with open(args.md_path) as fhand:
+            md_text = fhand.read()
+    sys.stdout.write(render_citations(md_text, library))
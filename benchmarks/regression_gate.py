@@ -0,0 +1,123 @@
+
+# Compares the benchmarks with a stored baseline and fails when a stage got
+# slower or uses more memory than the threshold allows
+# python -m benchmarks.regression_gate --save --sizes small medium
+# python -m benchmarks.regression_gate --threshold 0.3
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+from benchmarks.run_benchmarks import run_benchmarks, SIZES
+
+BASELINE_PATH = Path(__file__).resolve().parent / 'baseline.json'
+GATED_METRICS = ('median', 'peak_memory')
+REPORTED_METRICS = ('median', 'p95', 'peak_memory')
+
+
+def save_baseline(results, baseline_path=BASELINE_PATH):
+    with Path(baseline_path).open('wt') as fhand:
+        json.dump(results, fhand, indent=2)
+
+
+def load_baseline(baseline_path=BASELINE_PATH):
+    with Path(baseline_path).open('rt') as fhand:
+        return json.load(fhand)
+
+
+def compare_results(baseline, current, threshold=0.25, memory_threshold=0.25):
+    if baseline['pandoc'] != current['pandoc']:
+        msg = (f'The baseline was run with the {baseline["pandoc"]} pandoc and the '
+               f'current results with the {current["pandoc"]} one, they can not be compared')
+        raise ValueError(msg)
+
+    thresholds = {'median': threshold, 'p95': threshold,
+                  'peak_memory': memory_threshold}
+    rows = []
+    for size, baseline_result in baseline['sizes'].items():
+        if size not in current['sizes']:
+            continue
+        current_stages = current['sizes'][size]['stages']
+        for stage, baseline_stats in baseline_result['stages'].items():
+            current_stats = current_stages.get(stage)
+            for metric in REPORTED_METRICS:
+                baseline_value = baseline_stats.get(metric)
+                if baseline_value is None:
+                    continue
+                row = {'size': size, 'stage': stage, 'metric': metric,
+                       'baseline': baseline_value, 'current': None,
+                       'change': None, 'regression': False}
+                if current_stats is None or current_stats.get(metric) is None:
+                    # a stage that disappeared can not hide a regression
+                    row['regression'] = metric in GATED_METRICS
+                    rows.append(row)
+                    continue
+                row['current'] = current_stats[metric]
+                if baseline_value:
+                    row['change'] = row['current'] / baseline_value - 1
+                    row['regression'] = (metric in GATED_METRICS and
+                                         row['change'] > thresholds[metric])
+                rows.append(row)
+    return rows
+
+
+def _format_value(metric, value):
+    if value is None:
+        return '-'
+    if metric == 'peak_memory':
+        return f'{value / 1024 ** 2:.2f} MiB'
+    return f'{value:.4f} s'
+
+
+def print_comparison_table(rows, fhand=sys.stdout):
+    header = ('size', 'stage', 'metric', 'baseline', 'current', 'change', '')
+    lines = [header]
+    for row in rows:
+        change = '-' if row['change'] is None else f'{row["change"]:+.1%}'
+        lines.append((row['size'], row['stage'], row['metric'],
+                      _format_value(row['metric'], row['baseline']),
+                      _format_value(row['metric'], row['current']),
+                      change, 'REGRESSION' if row['regression'] else ''))
+    widths = [max(len(line[idx]) for line in lines) for idx in range(len(header))]
+    for line in lines:
+        fhand.write('  '.join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip() + '\n')
+    num_regressions = sum(row['regression'] for row in rows)
+    fhand.write(f'{num_regressions} regressions\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the benchmarks against a baseline')
+    parser.add_argument('--baseline', type=Path, default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true',
+                        help='Run the benchmarks and store them as the new baseline')
+    parser.add_argument('--current', type=Path, default=None,
+                        help='Compare these results instead of running the benchmarks')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=None)
+    parser.add_argument('--repeat', type=int, default=None)
+    parser.add_argument('--real-pandoc', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed relative increase of the median time')
+    parser.add_argument('--memory-threshold', type=float, default=0.25,
+                        help='Allowed relative increase of the peak memory')
+    args = parser.parse_args()
+
+    if args.save:
+        results = run_benchmarks(args.sizes or ['small', 'medium'],
+                                 repeat=args.repeat or 5,
+                                 real_pandoc=args.real_pandoc)
+        save_baseline(results, args.baseline)
+        print(f'Baseline saved in {args.baseline}')
+        sys.exit(0)
+
+    baseline = load_baseline(args.baseline)
+    if args.current:
+        current = load_baseline(args.current)
+    else:
+        current = run_benchmarks(args.sizes or list(baseline['sizes']),
+                                 repeat=args.repeat or baseline['repeat'],
+                                 real_pandoc=baseline['pandoc'] == 'real')
+    rows = compare_results(baseline, current, threshold=args.threshold,
+                           memory_threshold=args.memory_threshold)
+    print_comparison_table(rows)
+    sys.exit(1 if any(row['regression'] for row in rows) else 0)
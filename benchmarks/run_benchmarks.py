@@ -0,0 +1,193 @@
+
+# Times every step of the build with synthetic books of several sizes
+# python -m benchmarks.run_benchmarks --sizes small medium --json results.json
+
+import argparse
+import json
+import math
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import references
+from book_section import BookSection, BOOK
+from site_creation import (SiteRenderer, RenderCache, _itemize_md_text, HTML,
+                           EPUB3)
+from benchmarks.synthetic_book import create_synthetic_book
+
+PANDOC_STUB_PATH = Path(__file__).resolve().parent / 'pandoc_stub.py'
+
+SIZES = {'small': {'chapters_per_part': 5,
+                   'paragraphs_per_section': 5},
+         'medium': {'num_parts': 4,
+                    'chapters_per_part': 10,
+                    'subchapters_per_chapter': 3,
+                    'paragraphs_per_section': 10},
+         'large': {'num_parts': 10,
+                   'chapters_per_part': 20,
+                   'subchapters_per_chapter': 5,
+                   'paragraphs_per_section': 20,
+                   'bibliography_size': 1000}}
+
+
+def _get_percentile(values, percent):
+    values = sorted(values)
+    idx = max(math.ceil(percent / 100 * len(values)) - 1, 0)
+    return values[idx]
+
+
+def _summarize_times(times, peak_memory=None):
+    return {'median': statistics.median(times),
+            'p95': _get_percentile(times, 95),
+            'peak_memory': peak_memory}
+
+
+def _get_peak_memory(func):
+    # tracemalloc slows the code down, so it gets its own run
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+
+def _measure(func, repeat):
+    times = []
+    results = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results.append(func())
+        times.append(time.perf_counter() - start)
+    return _summarize_times(times, _get_peak_memory(func)), results
+
+
+def _get_write_times(reports):
+    # the writer stage is what the render spends writing and closing the output
+    return [sum(report['stages'].get(stage, {}).get('wall_time', 0.0)
+                for stage in ('write', 'close'))
+            for report in reports]
+
+
+def _read_book(book_dir):
+    book = BookSection(book_dir)
+    sections = [section for section in book._walk_book_sections(stop_in_me=False)
+                if section.kind != BOOK]
+    for section in sections:
+        section.id
+        section.title
+    return book, sections
+
+
+def _itemize_sections(sections):
+    return {section.id: list(_itemize_md_text(section.md_text))
+            for section in sections}
+
+
+def _process_citations(book, items_by_section):
+    # the citations found tell that pandoc really resolved them
+    num_calls = 0
+    num_found = 0
+    for items in items_by_section.values():
+        citation_texts = [item['md_orig_main_text'] for item in items
+                          if item['kind'] == 'citation']
+        if citation_texts:
+            result = references.process_citations(citation_texts,
+                                                  libray_csl_json_path=book.bibliography_path)
+            num_calls += 1
+            num_found += sum(item['citations_found'] for item in result['citation_items'])
+    return num_calls, num_found
+
+
+def _render_site(book_dir, site_kind, out_dir):
+    # a new book, cache and output every time, nothing is reused between runs
+    out_path = Path(tempfile.mkdtemp(dir=out_dir)) / 'out'
+    if site_kind == EPUB3:
+        out_path = out_path.with_suffix('.epub')
+    book = BookSection(book_dir)
+    target = {'zip_path': out_path} if site_kind == EPUB3 else {'out_dir': out_path}
+    with SiteRenderer(book, site_kind=site_kind, render_cache=RenderCache(),
+                      **target) as renderer:
+        return renderer.render()
+
+
+def run_benchmark(params, repeat=5):
+    stages = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        book_dir = tmp_dir / 'book'
+        create_synthetic_book(book_dir, **params)
+
+        stages['book_section'], results = _measure(lambda: _read_book(book_dir), repeat)
+        book, sections = results[-1]
+        stages['itemize'], results = _measure(lambda: _itemize_sections(sections), repeat)
+        items_by_section = results[-1]
+        stages['citations'], results = _measure(lambda: _process_citations(book, items_by_section),
+                                                repeat)
+        num_pandoc_calls, num_citations_found = results[-1]
+        stages['render_html'], html_reports = _measure(lambda: _render_site(book_dir, HTML, tmp_dir),
+                                                       repeat)
+        stages['write_html'] = _summarize_times(_get_write_times(html_reports))
+        stages['package_epub'], epub_reports = _measure(lambda: _render_site(book_dir, EPUB3, tmp_dir),
+                                                        repeat)
+        stages['write_epub'] = _summarize_times(_get_write_times(epub_reports))
+    return {'params': params,
+            'num_sections': len(sections),
+            'num_pandoc_calls': num_pandoc_calls,
+            'num_citations_found': num_citations_found,
+            'stages': stages,
+            'render_stages': {HTML: html_reports[-1]['stages'],
+                              EPUB3: epub_reports[-1]['stages']}}
+
+
+def run_benchmarks(sizes, repeat=5, real_pandoc=False):
+    pandoc_bin = references.PANDOC_BIN
+    if not real_pandoc:
+        references.PANDOC_BIN = str(PANDOC_STUB_PATH)
+    try:
+        results = {}
+        for size in sizes:
+            results[size] = run_benchmark(SIZES[size], repeat=repeat)
+    finally:
+        references.PANDOC_BIN = pandoc_bin
+    return {'pandoc': 'real' if real_pandoc else 'stub',
+            'repeat': repeat,
+            'python': sys.version.split()[0],
+            'sizes': results}
+
+
+def print_benchmark_results(results):
+    for size, result in results['sizes'].items():
+        print(f'{size}: {result["num_sections"]} sections, '
+              f'{result["num_pandoc_calls"]} pandoc calls ({results["pandoc"]}), '
+              f'{result["num_citations_found"]} citations found')
+        for stage, stats in result['stages'].items():
+            line = f'  {stage}: {stats["median"]:.4f} s median, {stats["p95"]:.4f} s p95'
+            if stats['peak_memory'] is not None:
+                line += f', {stats["peak_memory"] / 1024 ** 2:.1f} MiB peak'
+            print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the build with synthetic books')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES),
+                        default=['small', 'medium'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--real-pandoc', action='store_true',
+                        help='Use pandoc instead of the local stub')
+    parser.add_argument('--json', type=Path, default=None,
+                        help='Write the results to this json file')
+    args = parser.parse_args()
+    results = run_benchmarks(args.sizes, repeat=args.repeat,
+                             real_pandoc=args.real_pandoc)
+    print_benchmark_results(results)
+    if args.json:
+        with args.json.open('wt') as fhand:
+            json.dump(results, fhand, indent=2)
@@ -0,0 +1,133 @@
+
+# Writes books of any size to measure how the build scales
+
+import json
+import random
+from pathlib import Path
+
+WORDS = ('the', 'doubt', 'method', 'evidence', 'of', 'a', 'theory', 'and',
+         'science', 'reason', 'in', 'observation', 'is', 'not', 'knowledge',
+         'experiment', 'belief', 'with', 'model', 'truth', 'error', 'data')
+
+BOOK_METADATA = '''---
+title: 'A synthetic book'
+lang: 'en'
+uid: 'synthetic-book'
+author:
+- Synthetic Author
+bibliography: '{bibliography_path}'
+---
+'''
+
+BIBLIOGRAPHY_FNAME = 'bibliography.csl.json'
+
+
+def _create_bibliography(num_references):
+    return [{'id': f'ref{idx}',
+             'type': 'book',
+             'title': f'Book number {idx}',
+             'author': [{'family': f'Author{idx}', 'given': 'A.'}],
+             'issued': {'date-parts': [[1950 + idx % 70]]}}
+            for idx in range(num_references)]
+
+
+def _create_sentence(rng, num_words):
+    words = [rng.choice(WORDS) for _ in range(num_words)]
+    return ' '.join(words).capitalize() + '.'
+
+
+def _create_paragraph(rng, params, footnote_numbers):
+    sentences = []
+    for idx in range(params['sentences_per_paragraph']):
+        sentence = _create_sentence(rng, params['words_per_sentence'])
+        if idx < params['citations_per_paragraph'] and params['bibliography_size']:
+            ref_idx = rng.randrange(params['bibliography_size'])
+            sentence = sentence[:-1] + f' [@ref{ref_idx}].'
+        sentences.append(sentence)
+    paragraph = ' '.join(sentences)
+    if footnote_numbers:
+        paragraph += ''.join(f'[^{number}]' for number in footnote_numbers)
+    return paragraph
+
+
+def _create_section_md(rng, params, header, num_paragraphs):
+    # the footnotes are numbered within the section
+    lines = [header, '']
+    footnotes = []
+    num_footnotes = params['footnotes_per_section']
+    for idx in range(num_paragraphs):
+        if idx < num_footnotes:
+            footnote_numbers = [len(footnotes) + 1]
+            footnotes.append(_create_sentence(rng, params['words_per_sentence']))
+        else:
+            footnote_numbers = []
+        lines.append(_create_paragraph(rng, params, footnote_numbers))
+        lines.append('')
+    for number, footnote in enumerate(footnotes, start=1):
+        lines.append(f'[^{number}]: {footnote}')
+    return '\n'.join(lines) + '\n'
+
+
+def _write_md(dir_, fname, text):
+    dir_.mkdir(parents=True, exist_ok=True)
+    (dir_ / fname).write_text(text)
+
+
+def _create_chapter(rng, params, chapter_dir, chapter_number):
+    num_subchapters = params['subchapters_per_chapter']
+    # a chapter with subchapters can only have its header in its own file
+    num_paragraphs = 1 if num_subchapters else params['paragraphs_per_section']
+    _write_md(chapter_dir, 'chapter.md',
+              _create_section_md(rng, params, f'# Chapter {chapter_number}',
+                                 num_paragraphs))
+    for subchapter_idx in range(1, num_subchapters + 1):
+        _write_md(chapter_dir / f'sub{subchapter_idx:03d}', 'subchapter.md',
+                  _create_section_md(rng, params,
+                                     f'# Subchapter {chapter_number}.{subchapter_idx}',
+                                     params['paragraphs_per_section']))
+
+
+DEFAULT_BOOK_PARAMS = {'num_parts': 0,
+                       'chapters_per_part': 10,
+                       'subchapters_per_chapter': 0,
+                       'paragraphs_per_section': 10,
+                       'sentences_per_paragraph': 4,
+                       'words_per_sentence': 12,
+                       'citations_per_paragraph': 1,
+                       'footnotes_per_section': 0,
+                       'bibliography_size': 100,
+                       'seed': 0}
+
+
+def create_synthetic_book(book_dir, **params):
+    # chapters_per_part is the number of chapters of the book if it has no
+    # parts, the bibliography is written next to the book dir
+    unknown_params = set(params).difference(DEFAULT_BOOK_PARAMS)
+    if unknown_params:
+        raise ValueError(f'Unknown book params: {", ".join(sorted(unknown_params))}')
+    params = dict(DEFAULT_BOOK_PARAMS, **params)
+    rng = random.Random(params['seed'])
+    book_dir = Path(book_dir)
+
+    bibliography_path = (book_dir.parent / f'{book_dir.name}_{BIBLIOGRAPHY_FNAME}').resolve()
+    with bibliography_path.open('wt') as fhand:
+        json.dump(_create_bibliography(params['bibliography_size']), fhand)
+    _write_md(book_dir, 'book.md',
+              BOOK_METADATA.format(bibliography_path=bibliography_path))
+
+    chapter_number = 1
+    if params['num_parts']:
+        for part_idx in range(1, params['num_parts'] + 1):
+            part_dir = book_dir / f'part{part_idx:03d}'
+            _write_md(part_dir, 'part.md', f'# Part {part_idx} {{$part}}\n')
+            for _ in range(params['chapters_per_part']):
+                _create_chapter(rng, params, part_dir / f'chapter{chapter_number:04d}',
+                                chapter_number)
+                chapter_number += 1
+    else:
+        for _ in range(params['chapters_per_part']):
+            _create_chapter(rng, params, book_dir / f'chapter{chapter_number:04d}',
+                            chapter_number)
+            chapter_number += 1
+    return {'book_dir': book_dir, 'bibliography_path': bibliography_path,
+            'params': params}
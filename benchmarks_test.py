@@ -0,0 +1,125 @@
+
+import io
+import unittest
+import tempfile
+from pathlib import Path
+
+import references
+from book_section import BookSection
+from site_creation import SiteRenderer, HTML
+from benchmarks.synthetic_book import create_synthetic_book
+from benchmarks.run_benchmarks import run_benchmarks, SIZES, PANDOC_STUB_PATH
+from benchmarks.regression_gate import (compare_results, print_comparison_table,
+                                        load_baseline)
+
+TINY_BOOK_PARAMS = {'num_parts': 1, 'chapters_per_part': 2,
+                    'subchapters_per_chapter': 1, 'paragraphs_per_section': 2,
+                    'bibliography_size': 5}
+
+
+class SyntheticBookTest(unittest.TestCase):
+    def test_create_book(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            book_dir = Path(tmp_dir) / 'book'
+            result = create_synthetic_book(book_dir, **TINY_BOOK_PARAMS)
+            assert result['bibliography_path'].exists()
+            book = BookSection(book_dir)
+            sections = list(book._walk_book_sections(stop_in_me=False))
+            # book, part, two chapters and a subchapter in each one
+            assert len(sections) == 6
+            assert book.bibliography_path == result['bibliography_path']
+
+
+class PandocStubTest(unittest.TestCase):
+    def test_synthetic_citations_are_resolved(self):
+        pandoc_bin = references.PANDOC_BIN
+        references.PANDOC_BIN = str(PANDOC_STUB_PATH)
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                book_dir = Path(tmp_dir) / 'book'
+                out_dir = Path(tmp_dir) / 'site'
+                create_synthetic_book(book_dir, **TINY_BOOK_PARAMS)
+                with SiteRenderer(BookSection(book_dir), site_kind=HTML,
+                                  out_dir=out_dir) as renderer:
+                    renderer.render()
+                assert not renderer.citation_keys_not_found
+                endnotes = (out_dir / 'section' / 'endnotes.html').read_text()
+                assert 'id="endnotes_1"' in endnotes
+                bibliography = (out_dir / 'section' / 'bibliography.html').read_text()
+                assert '<li>Author' in bibliography
+        finally:
+            references.PANDOC_BIN = pandoc_bin
+
+
+class RunBenchmarksTest(unittest.TestCase):
+    def test_run_benchmarks(self):
+        SIZES['tiny'] = TINY_BOOK_PARAMS
+        try:
+            results = run_benchmarks(['tiny'], repeat=1)
+        finally:
+            del SIZES['tiny']
+        result = results['sizes']['tiny']
+        assert results['pandoc'] == 'stub'
+        assert result['num_pandoc_calls'] > 0
+        assert result['num_citations_found'] > 0
+        assert set(result['stages']) == {'book_section', 'itemize', 'citations',
+                                         'render_html', 'write_html',
+                                         'package_epub', 'write_epub'}
+        stats = result['stages']['render_html']
+        assert 0 < stats['median'] <= stats['p95']
+        assert stats['peak_memory'] > 0
+        assert result['stages']['write_html']['peak_memory'] is None
+        assert result['render_stages']['html']['citations']['num_calls']
+
+
+def _create_results(median, peak_memory):
+    stats = {'median': median, 'p95': median * 1.1, 'peak_memory': peak_memory}
+    return {'pandoc': 'stub', 'repeat': 5,
+            'sizes': {'small': {'stages': {'itemize': stats}}}}
+
+
+class RegressionGateTest(unittest.TestCase):
+    def test_compare_results(self):
+        baseline = _create_results(1.0, 1000)
+
+        rows = compare_results(baseline, _create_results(1.1, 1000))
+        assert not any(row['regression'] for row in rows)
+        assert [row['metric'] for row in rows] == ['median', 'p95', 'peak_memory']
+
+        rows = compare_results(baseline, _create_results(1.5, 1000))
+        assert [row['metric'] for row in rows if row['regression']] == ['median']
+        rows = compare_results(baseline, _create_results(1.5, 1000), threshold=0.6)
+        assert not any(row['regression'] for row in rows)
+
+        rows = compare_results(baseline, _create_results(1.0, 2000))
+        assert [row['metric'] for row in rows if row['regression']] == ['peak_memory']
+
+        current = _create_results(1.0, 1000)
+        current['sizes']['small']['stages'] = {}
+        rows = compare_results(baseline, current)
+        assert [row['metric'] for row in rows if row['regression']] == ['median', 'peak_memory']
+
+        current = _create_results(1.0, 1000)
+        current['pandoc'] = 'real'
+        with self.assertRaises(ValueError):
+            compare_results(baseline, current)
+
+    def test_comparison_table(self):
+        rows = compare_results(_create_results(1.0, 1000), _create_results(2.0, 1000))
+        fhand = io.StringIO()
+        print_comparison_table(rows, fhand)
+        table = fhand.getvalue()
+        assert '+100.0%' in table
+        assert 'REGRESSION' in table
+        assert '1 regressions' in table
+
+    def test_stored_baseline(self):
+        baseline = load_baseline()
+        for result in baseline['sizes'].values():
+            assert result['num_citations_found'] > 0
+            for stage in ('book_section', 'itemize', 'citations', 'write_html'):
+                assert result['stages'][stage]['median'] > 0
+
+
+if __name__ == '__main__':
+    unittest.main()
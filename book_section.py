@@ -271,6 +271,25 @@ class BookSection(_BookSection):
         if self.kind != BOOK:
             self._title = res.get('text')
 
+    def refresh(self):
+        # the md files changed, forget what we read from them
+        self._set_kind()
+        self._id = None
+        self._title = None
+        # the ids of the subchapters are built with the one of their chapter
+        subsections = list(self.subsections)
+        while subsections:
+            section = subsections.pop()
+            section._id = None
+            subsections.extend(section.subsections)
+        book = self.book
+        if self is book:
+            self._set_book_metadata()
+            if hasattr(self, '_bibliography_path'):
+                del self._bibliography_path
+        if hasattr(book, '_section_index'):
+            del book._section_index
+
     @property
     def kind(self):
         return self._kind
@@ -335,6 +354,9 @@ class BookSection(_BookSection):
 
     @property
     def md_text(self):
+        return self.iter_md_text()
+
+    def iter_md_text(self, keep_header_ids=False):
         in_metadata_yaml = False
         metadata_yaml_done = False
         in_comment = False
@@ -390,8 +412,10 @@ class BookSection(_BookSection):
                                 msg = f'In a section with subsections only one header is allowed: {line}'
                                 raise ValueError(msg)
                         header_level = res['level'] - (first_header_level_in_file - main_header_level)
-                        line = '#' * header_level + ' ' + res['text'] + '\n'
-                        yield line
+                        line = '#' * header_level + ' ' + res['text']
+                        if keep_header_ids and 'id' in res:
+                            line += ' {#' + res['id'] + '}'
+                        yield line + '\n'
                         line = '\n'
 
                     if line == '\n':
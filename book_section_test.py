@@ -8,7 +8,8 @@ import shutil
 
 from book_section import (BookSection, _parse_header_line, BOOK, CHAPTER, PART,
                           SUBCHAPTER)
-from epub_creation import create_epub, unzip_epub, check_epub
+from epub_creation import (create_epub, unzip_epub, check_epub, _BuildContext,
+                           _create_html_for_md_text_in_section)
 
 
 class ParseHeadersTest(unittest.TestCase):
@@ -266,5 +267,19 @@ class CreateEpubTest(unittest.TestCase):
             shutil.copyfile(epub_path, 'rendered_book3.epub')
             unzip_epub(epub_path, out_dir)
 
+    def test_build_context(self):
+        with _prepare_book_md_files(BOOK1_STRUCTURE) as book_dir:
+            book = BookSection(Path(book_dir))
+            chapter = book.subsections[0]
+            # every build starts counting the notes again
+            for _ in range(2):
+                context = _BuildContext(book)
+                res = _create_html_for_md_text_in_section(chapter, context=context)
+                assert '<sup>1</sup>' in ''.join(res['rendered_lines'])
+                assert context.footnote_ids_seen == {'1'}
+
+            with self.assertRaises(RuntimeError):
+                _create_html_for_md_text_in_section(chapter, context=context)
+
 if __name__ == '__main__':
     unittest.main()
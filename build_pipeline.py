@@ -0,0 +1,90 @@
+
+import threading
+import queue
+import time
+
+DEFAULT_QUEUE_SIZE = 4
+
+_END_OF_STREAM = object()
+
+
+class _PipelineStage(threading.Thread):
+    def __init__(self, name, process, in_queue, out_queue):
+        super().__init__(name=f'pipeline_{name}', daemon=True)
+        self.stage_name = name
+        self.process = process
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.busy_time = 0
+        self.num_items = 0
+        self.error = None
+
+    def _put(self, item):
+        if self.out_queue is not None:
+            self.out_queue.put(item)
+
+    def run(self):
+        while True:
+            item = self.in_queue.get()
+            if item is _END_OF_STREAM:
+                break
+            if self.error is not None:
+                # keep draining so that the previous stages do not block
+                continue
+            start = time.perf_counter()
+            try:
+                result = self.process(item)
+            except BaseException as error:
+                self.error = error
+                continue
+            finally:
+                self.busy_time += time.perf_counter() - start
+            self.num_items += 1
+            self._put(result)
+        self._put(_END_OF_STREAM)
+
+
+def run_pipeline(items, stages, queue_size=DEFAULT_QUEUE_SIZE):
+    # stages is a list of (name, function) pairs, every function gets the
+    # result of the previous one, the items flow through them in order
+    start = time.perf_counter()
+
+    in_queue = queue.Queue(maxsize=queue_size)
+    first_queue = in_queue
+    threads = []
+    for idx, (name, process) in enumerate(stages):
+        if idx == len(stages) - 1:
+            out_queue = None
+        else:
+            out_queue = queue.Queue(maxsize=queue_size)
+        threads.append(_PipelineStage(name, process, in_queue, out_queue))
+        in_queue = out_queue
+
+    for thread in threads:
+        thread.start()
+    feed_error = None
+    try:
+        for item in items:
+            if any(thread.error is not None for thread in threads):
+                break
+            first_queue.put(item)
+    except BaseException as error:
+        feed_error = error
+    first_queue.put(_END_OF_STREAM)
+    for thread in threads:
+        thread.join()
+
+    if feed_error is not None:
+        raise feed_error
+    for thread in threads:
+        if thread.error is not None:
+            raise thread.error
+
+    wall_time = time.perf_counter() - start
+    stats = {}
+    for thread in threads:
+        occupancy = thread.busy_time / wall_time if wall_time else 0
+        stats[thread.stage_name] = {'busy_time': thread.busy_time,
+                                    'num_items': thread.num_items,
+                                    'occupancy': occupancy}
+    return {'wall_time': wall_time, 'stages': stats}
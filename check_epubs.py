@@ -0,0 +1,120 @@
+
+# Validates many epubs at once, the epubcheck runs are done in parallel
+# python check_epubs.py book1.epub book2.epub --json report.json
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from epub_validation import validate_epub
+from site_creation import EPUBCHECK_JAR
+
+ERROR = 'ERROR'
+FATAL = 'FATAL'
+WARNING = 'WARNING'
+FAILING_SEVERITIES = (ERROR, FATAL)
+
+
+def _parse_epubcheck_report(report):
+    messages = []
+    for message in report.get('messages', []):
+        locations = message.get('locations') or [{}]
+        for location in locations:
+            messages.append({'path': location.get('path'),
+                             'line': location.get('line'),
+                             'message': message.get('message'),
+                             'severity': message.get('severity'),
+                             'id': message.get('ID')})
+    return messages
+
+
+def _run_epubcheck(epub_path, epubcheck_jar):
+    # epubcheck writes a json report, it is easier to parse than its output
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_path = Path(tmp_dir) / 'report.json'
+        cmd = ['java', '-jar', str(epubcheck_jar), str(epub_path),
+               '--json', str(json_path)]
+        try:
+            completed_process = subprocess.run(cmd, capture_output=True)
+        except OSError as error:
+            return [{'path': None, 'line': None, 'severity': FATAL, 'id': None,
+                     'message': f'epubcheck could not be run: {error}'}]
+        if not json_path.exists():
+            stderr = completed_process.stderr.decode().strip()
+            return [{'path': None, 'line': None, 'severity': FATAL, 'id': None,
+                     'message': f'epubcheck failed: {stderr}'}]
+        with json_path.open('rt') as fhand:
+            return _parse_epubcheck_report(json.load(fhand))
+
+
+def check_epub_path(epub_path, epubcheck=True, epubcheck_jar=EPUBCHECK_JAR):
+    start = time.perf_counter()
+    messages = []
+    try:
+        messages.extend({'path': error['path'], 'line': None, 'message': error['message'],
+                         'severity': ERROR, 'id': None}
+                        for error in validate_epub(epub_path))
+        if epubcheck:
+            messages.extend(_run_epubcheck(epub_path, epubcheck_jar))
+    except Exception as error:
+        # a book that breaks the check fails alone, the other ones are still checked
+        messages.append({'path': None, 'line': None, 'severity': FATAL, 'id': None,
+                         'message': f'The epub could not be checked: {error!r}'})
+    num_errors = sum(message['severity'] in FAILING_SEVERITIES for message in messages)
+    return {'epub_path': str(epub_path),
+            'ok': not num_errors,
+            'num_errors': num_errors,
+            'messages': messages,
+            'check_time': time.perf_counter() - start}
+
+
+def check_epubs(epub_paths, jobs=None, epubcheck=True, epubcheck_jar=EPUBCHECK_JAR):
+    # each epubcheck is a java process, threads are enough to keep several
+    # of them running and jobs bounds how many jvms run at the same time
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(check_epub_path, epub_path, epubcheck=epubcheck,
+                               epubcheck_jar=epubcheck_jar)
+                   for epub_path in epub_paths]
+        return [future.result() for future in futures]
+
+
+def print_check_reports(reports, fhand=sys.stdout):
+    for report in reports:
+        status = 'OK' if report['ok'] else 'FAILED'
+        fhand.write(f'{report["epub_path"]}: {status}, {report["num_errors"]} errors '
+                    f'in {report["check_time"]:.3f} s\n')
+        for message in report['messages']:
+            location = message['path'] or ''
+            if message['line'] is not None:
+                location += f':{message["line"]}'
+            fhand.write(f'    {message["severity"]} {location}: {message["message"]}\n')
+    num_failed = sum(not report['ok'] for report in reports)
+    fhand.write(f'{len(reports) - num_failed} epubs passed, {num_failed} failed\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Validate several epubs in parallel')
+    parser.add_argument('epub_paths', type=Path, nargs='+')
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--no-epubcheck', action='store_true',
+                        help='Only run the fast python validation')
+    parser.add_argument('--epubcheck-jar', type=Path, default=EPUBCHECK_JAR)
+    parser.add_argument('--json', type=Path, default=None,
+                        help='Write the reports to this json file')
+    args = parser.parse_args()
+    reports = check_epubs(args.epub_paths, jobs=args.jobs,
+                          epubcheck=not args.no_epubcheck,
+                          epubcheck_jar=args.epubcheck_jar)
+    print_check_reports(reports)
+    if args.json:
+        with args.json.open('wt') as fhand:
+            json.dump(reports, fhand, indent=2)
+    sys.exit(0 if all(report['ok'] for report in reports) else 1)
@@ -0,0 +1,86 @@
+
+import unittest
+import tempfile
+import subprocess
+import sys
+from pathlib import Path
+
+from book_section_test import _prepare_book_md_files
+from site_creation_test import SUBCHAPTER_BOOK_STRUCTURE
+from epub_validation_test import _render_epub, _rewrite_epub
+from check_epubs import check_epubs, _parse_epubcheck_report, FATAL
+
+EPUBCHECK_REPORT = {'messages': [{'ID': 'RSC-005', 'severity': 'ERROR',
+                                  'message': 'Error while parsing file',
+                                  'locations': [{'path': 'EPUB/chapter_1.xhtml',
+                                                 'line': 12, 'column': 3}]},
+                                 {'ID': 'OPF-085', 'severity': 'WARNING',
+                                  'message': 'Invalid identifier', 'locations': []}]}
+
+
+def _break_compression_methods(zip_path):
+    # an unknown compression method in the central directory, zipfile can
+    # list the members but it raises when one is read
+    content = bytearray(zip_path.read_bytes())
+    idx = content.find(b'PK\x01\x02')
+    while idx != -1:
+        content[idx + 10:idx + 12] = (99).to_bytes(2, 'little')
+        idx = content.find(b'PK\x01\x02', idx + 1)
+    zip_path.write_bytes(bytes(content))
+
+
+class CheckEpubsTest(unittest.TestCase):
+    def test_check_epubs(self):
+        with _prepare_book_md_files(SUBCHAPTER_BOOK_STRUCTURE) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            zip_path = Path(tmp_dir) / 'book.epub'
+            _render_epub(book_dir, zip_path)
+            bad_zip_path = Path(tmp_dir) / 'bad.epub'
+            _rewrite_epub(zip_path, bad_zip_path,
+                          [('EPUB/toc.xhtml', '#nav_span_chapter_1_2', '#missing')])
+
+            reports = check_epubs([zip_path, bad_zip_path], jobs=2, epubcheck=False)
+            assert [report['ok'] for report in reports] == [True, False]
+            assert reports[1]['num_errors'] == 1
+            assert reports[1]['messages'][0]['path'] == 'EPUB/toc.xhtml'
+
+            cmd = [sys.executable, str(Path(__file__).parent / 'check_epubs.py'),
+                   '--no-epubcheck', str(zip_path)]
+            assert subprocess.run(cmd, capture_output=True).returncode == 0
+            cmd.append(str(bad_zip_path))
+            assert subprocess.run(cmd, capture_output=True).returncode == 1
+
+    def test_check_error(self):
+        with _prepare_book_md_files(SUBCHAPTER_BOOK_STRUCTURE) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            zip_path = Path(tmp_dir) / 'book.epub'
+            _render_epub(book_dir, zip_path)
+            broken_zip_path = Path(tmp_dir) / 'broken.epub'
+            broken_zip_path.write_bytes(zip_path.read_bytes())
+            _break_compression_methods(broken_zip_path)
+
+            reports = check_epubs([broken_zip_path, zip_path], jobs=2, epubcheck=False)
+            assert [report['ok'] for report in reports] == [False, True]
+            assert reports[0]['num_errors'] == 1
+            message = reports[0]['messages'][0]
+            assert message['severity'] == FATAL
+            assert message['message'].startswith('The epub could not be checked')
+
+            cmd = [sys.executable, str(Path(__file__).parent / 'check_epubs.py'),
+                   '--no-epubcheck', str(zip_path), str(broken_zip_path)]
+            process = subprocess.run(cmd, capture_output=True)
+            assert process.returncode == 1
+            assert b'1 epubs passed, 1 failed' in process.stdout
+
+    def test_parse_epubcheck_report(self):
+        messages = _parse_epubcheck_report(EPUBCHECK_REPORT)
+        assert messages == [{'path': 'EPUB/chapter_1.xhtml', 'line': 12,
+                             'message': 'Error while parsing file',
+                             'severity': 'ERROR', 'id': 'RSC-005'},
+                            {'path': None, 'line': None,
+                             'message': 'Invalid identifier',
+                             'severity': 'WARNING', 'id': 'OPF-085'}]
+
+
+if __name__ == '__main__':
+    unittest.main()
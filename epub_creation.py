@@ -2,7 +2,7 @@
 import zipfile
 from functools import partial
 import re
-from collections import OrderedDict, Counter, defaultdict
+from collections import OrderedDict, Counter
 import shutil
 import os
 from pprint import pprint
@@ -13,11 +13,14 @@ from pathlib import Path
 
 import mistune
 
-from book_section import (CHAPTER, PART, SUBCHAPTER, TOC,
+from book_section import (BOOK, CHAPTER, PART, SUBCHAPTER, TOC,
                           _parse_header_line,
                           BookSectionWithNoFiles)
+from anchors import (AnchorTable, INTERNAL_LINK_RE, scan_md_anchors,
+                     get_header_anchor_id)
 #from citations import create_citation_note, create_bibliography_citation
 from references import process_citations
+from epub_validation import validate_epub, report_validation_errors
 
 this_module_dir = Path(os.path.dirname(os.path.abspath(__file__)))
 
@@ -117,10 +120,19 @@ def _create_epub_fpath_for_section(section):
     return fpath_in_epub
 
 
-_NUM_FOOTNOTES_AND_CITATIONS_SEEN = Counter()
-_FOOTNOTE_IDS_SEEN = defaultdict(set)
-_CITATION_COUNTS = defaultdict(Counter)
-_FOOTNOTE_DEFINITION_ID_COUNTS = defaultdict(Counter)
+class _BuildContext:
+    # everything that one create_epub call accumulates, it is passed down to
+    # the processors so that nothing outlives the build or is shared by two
+    # builds running at the same time
+    def __init__(self, book):
+        self.book = book
+        self.anchors = None
+        self.num_footnotes_and_citations_seen = 0
+        self.footnote_ids_seen = set()
+        self.citation_counts = Counter()
+        self.footnote_definition_id_counts = Counter()
+        self.bibliography_entries_seen = OrderedDict()
+        self.references_not_found = set()
 
 
 def _create_html_for_numbered_footnote(number):
@@ -128,20 +140,19 @@ def _create_html_for_numbered_footnote(number):
     return html
 
 
-def _footnote_processor(footnote, endnote_chapter_fpath, book):
+def _footnote_processor(footnote, endnote_chapter_fpath, context):
     footnote_id = footnote['match'].group('id')
-    book_id = id(book)
 
-    if footnote_id in _FOOTNOTE_IDS_SEEN[book_id]:
+    if footnote_id in context.footnote_ids_seen:
         raise RuntimeError('Repeated footnote ID: ' + footnote_id)
-    _FOOTNOTE_IDS_SEEN[book_id].add(footnote_id)
-    _NUM_FOOTNOTES_AND_CITATIONS_SEEN[book_id] += 1
+    context.footnote_ids_seen.add(footnote_id)
+    context.num_footnotes_and_citations_seen += 1
 
     fpath = os.path.join('..', endnote_chapter_fpath)
     href_to_footnote_definition = f'{fpath}#ftd_{footnote_id}'
     a_id = f'ft_{footnote_id}'
 
-    html = _create_html_for_numbered_footnote(_NUM_FOOTNOTES_AND_CITATIONS_SEEN[book_id])
+    html = _create_html_for_numbered_footnote(context.num_footnotes_and_citations_seen)
 
     text = f'<a id="{a_id}" href="{href_to_footnote_definition}" role="doc-noteref" epub:type="noteref">{html}</a>'
     return {'processed_text': text,
@@ -150,11 +161,11 @@ def _footnote_processor(footnote, endnote_chapter_fpath, book):
 
 
 def _footnote_definition_processor(footnote_definition,
-                                   fpath_for_section_in_epub, book):
+                                   fpath_for_section_in_epub, context):
     footnote_id = footnote_definition['match'].group('id')
-    book_id = id(book)
-    _FOOTNOTE_DEFINITION_ID_COUNTS[book_id][footnote_id] += 1
-    if _FOOTNOTE_DEFINITION_ID_COUNTS[book_id][footnote_id] > 1:
+    footnote_definition_id_counts = context.footnote_definition_id_counts
+    footnote_definition_id_counts[footnote_id] += 1
+    if footnote_definition_id_counts[footnote_id] > 1:
         raise RuntimeError('More than one footnote definition for footnote ID: ' + footnote_id)
 
     li_id = f'ftd_{footnote_id}'
@@ -168,19 +179,13 @@ def _footnote_definition_processor(footnote_definition,
 class _CitationProcessor:
     def __init__(self, bibliography_chapter_fpath,
                  endnote_chapter_fpath,
-                 bibliography_entries_seen,
-                 references_not_found,
-                 citation_counts,
-                 book):
+                 context):
         self.bibliography_chapter_fpath = bibliography_chapter_fpath
         self.endnote_chapter_fpath = endnote_chapter_fpath
-        self.book = book
-        self.bibliography_path = book.bibliography_path
-        self.bibliography_entries_seen = bibliography_entries_seen
-        self.references_not_found = references_not_found
+        self.context = context
+        self.bibliography_path = context.book.bibliography_path
         self.last_citation_id_processed_for_section = {}
         self.last_citation_texts = []
-        self._citation_counts = citation_counts
 
     def __call__(self, citation, fpath_for_section_in_epub):
 
@@ -192,12 +197,12 @@ class _CitationProcessor:
             msg = 'No bibliography defined in metadata, but citations are used'
             raise ValueError(msg)
 
-        book_id = id(self.book)
+        context = self.context
         citation_id = citation['match'].group('id')
-        citation_counts = self._citation_counts
+        citation_counts = context.citation_counts
         citation_counts[citation_id] += 1
         footnote_id = f'{citation_id}_{citation_counts[citation_id]}'
-        _NUM_FOOTNOTES_AND_CITATIONS_SEEN[book_id] += 1
+        context.num_footnotes_and_citations_seen += 1
 
         if citation_id in debug_notes:
             print('citation_id', citation_id)
@@ -224,7 +229,7 @@ class _CitationProcessor:
 
         strip_citation_id = citation_id.strip().split(' ')[0].split('#')[0].strip('/:')
         if strip_citation_id in results['references_not_found']:
-            self.references_not_found.update(results['references_not_found'])
+            context.references_not_found.update(results['references_not_found'])
             citation_result = None
             #citation_texts_to_process = citation_texts_to_process[:-1]
         else:
@@ -246,14 +251,14 @@ class _CitationProcessor:
             pprint(citation_result)
 
         if citation_result:
-            html = _create_html_for_numbered_footnote(_NUM_FOOTNOTES_AND_CITATIONS_SEEN[book_id])
+            html = _create_html_for_numbered_footnote(context.num_footnotes_and_citations_seen)
             text = f'<a id="{a_id}" href="{href_to_footnote_definition}" role="doc-noteref" epub:type="noteref">{html}</a>'
 
             li_id = f'ftd_{footnote_id}'
             back_href_to_footnote = f'{fpath_for_section_in_epub}#ft_{footnote_id}'
             footnote_definition_text = f'<li id= "{li_id}" role="doc-endnote">{citation_result["footnote_html_text"]}</li>'
 
-            self.bibliography_entries_seen.update(results['references'])
+            context.bibliography_entries_seen.update(results['references'])
         else:
             text = citation['text']
             footnote_definition_text = None
@@ -269,15 +274,27 @@ class _CitationProcessor:
         return res
 
 
-def _internal_link_processor(internal_link, book):
+def _build_anchor_table(book):
+    anchors = AnchorTable()
+    for section in book._walk_book_sections(stop_in_me=False):
+        if section.kind == BOOK:
+            continue
+        fname = Path(_create_epub_fpath_for_section(section)).name
+        anchors.add_anchor(section.id, f'{fname}#nav_span_{section.id}')
+        res = scan_md_anchors(section.iter_md_text(keep_header_ids=True),
+                              section.id)
+        for header_id in res['header_ids']:
+            anchors.add_anchor(header_id, f'{fname}#{header_id}')
+        for link_id in res['link_ids']:
+            anchors.add_link(section.id, link_id)
+    return anchors
+
+
+def _internal_link_processor(internal_link, context):
     text = internal_link['match'].group('text')
     link_id = internal_link['match'].group('link_id')
-    section = book.get_section_by_id(link_id)
-    fname = Path(_create_epub_fpath_for_section(section)).name
-    link = fname
-
-    link = _build_link(link, text, id_=section.id, no_id=True)
-    return {'processed_text': link}
+    link = context.anchors.get_url(link_id)
+    return {'processed_text': _build_link(link, text)}
 
 
 def _get_citation_location_in_text(footnote_definition, footnote_locations):
@@ -295,12 +312,11 @@ def _split_md_text_in_items(md_text):
     footnote_re = re.compile(r' *\[\^(?P<id>[^\]]+)\]')
     footnote_definition_re = re.compile(r'\[\^(?P<id>[^\]]*)\]:(?P<content>[^\n]+)')
     citation_re = re.compile(r' *\[@(?P<id>[^ \],]+),? *(?P<locator_term>[\w]*):? *(?P<locator_positions>[0-9]*)\]', re.UNICODE)
-    internal_link_re = re.compile(r'\[(?P<text>[^\]]+)\]\(#(?P<link_id>[^\)]+)\)')
 
     item_kinds = OrderedDict([('footnote_definition', {'re': footnote_definition_re}),
                               ('footnote', {'re': footnote_re}),
                               ('citation', {'re': citation_re}),
-                              ('internal_link', {'re': internal_link_re}),
+                              ('internal_link', {'re': INTERNAL_LINK_RE}),
                               ])
     re_idx = {item_kind: idx for idx, item_kind in enumerate(item_kinds.keys())}
 
@@ -354,8 +370,7 @@ def _split_md_text_in_items(md_text):
 
 def _process_citations_and_footnotes(md_text,
                                      section,
-                                     bibliography_entries_seen,
-                                     references_not_found,
+                                     context,
                                      endnote_definitions):
     items = _split_md_text_in_items(md_text)
 
@@ -365,20 +380,17 @@ def _process_citations_and_footnotes(md_text,
     #split_text_in_items, item kinds: std_markdown, citation, footnote, footnote_definition,
     citation_processor = _CitationProcessor(bibliography_chapter_fpath=_get_epub_fpath_for_bibliography_chapter(),
                                             endnote_chapter_fpath=_get_epub_fpath_for_endnote_chapter(),
-                                            bibliography_entries_seen=bibliography_entries_seen,
-                                            references_not_found=references_not_found,
-                                            citation_counts=_FOOTNOTE_DEFINITION_ID_COUNTS[id(section.book)],
-                                            book=section.book)
+                                            context=context)
     item_processors = {'footnote': partial(_footnote_processor,
                                            endnote_chapter_fpath=_get_epub_fpath_for_endnote_chapter(),
-                                           book=section.book),
+                                           context=context),
                        'footnote_definition': partial(_footnote_definition_processor,
                                                       fpath_for_section_in_epub=fpath_for_section_in_epub,
-                                                      book=section.book),
+                                                      context=context),
                        'citation': partial(citation_processor,
                                            fpath_for_section_in_epub=fpath_for_section_in_epub),
                        'internal_link': partial(_internal_link_processor,
-                                                book=section.book)
+                                                context=context)
                       }
 
     debug_item = 'citation'
@@ -442,15 +454,12 @@ def _process_basic_markdown(md_text):
     return xhtml_text
 
 
-def _process_md_text(md_text, section, bibliography_entries_seen,
-                     references_not_found,
-                     endnote_definitions):
+def _process_md_text(md_text, section, context, endnote_definitions):
     md_text = '\n'.join(md_text)
 
     result = _process_citations_and_footnotes(md_text=md_text,
                                               section=section,
-                                              bibliography_entries_seen=bibliography_entries_seen,
-                                              references_not_found=references_not_found,
+                                              context=context,
                                               endnote_definitions=endnote_definitions)
     result['rendered_lines'] = _process_basic_markdown(result['rendered_text'])
     return result
@@ -473,9 +482,8 @@ def _split_section_in_fragments(lines):
                'lines': fragment_lines}
 
 
-def _create_html_for_md_text_in_section(section, bibliography_entries_seen,
-                                        references_not_found):
-    md_text = section.md_text
+def _create_html_for_md_text_in_section(section, context):
+    md_text = section.iter_md_text(keep_header_ids=True)
 
     rendered_lines = []
     footnote_definitions = []
@@ -484,12 +492,13 @@ def _create_html_for_md_text_in_section(section, bibliography_entries_seen,
         if fragment['kind'] == 'header':
             text = fragment['text']
             res = _parse_header_line(text)
-            header = f'<h{res["level"]}>{res["text"]}</h{res["level"]}>\n'
+            anchor_id = get_header_anchor_id(text, section.id)
+            id_str = f' id="{anchor_id}"' if anchor_id else ''
+            header = f'<h{res["level"]}{id_str}>{res["text"]}</h{res["level"]}>\n'
             rendered_lines.append(header)
         elif fragment['kind'] == 'fragment':
             result = _process_md_text(fragment['lines'], section=section,
-                                      bibliography_entries_seen=bibliography_entries_seen,
-                                      references_not_found=references_not_found,
+                                      context=context,
                                       endnote_definitions=footnote_definitions)
             rendered_lines.append(result['rendered_lines'])
     result = {'rendered_lines': rendered_lines,
@@ -503,22 +512,17 @@ def _write_html_in_zip_file(epub_zip, fpath, html):
     epub_zip.writestr(fpath, html)
 
 
-def _create_chapter(chapter, epub_zip, bibliography_entries_seen,
-                    references_not_found):
+def _create_chapter(chapter, epub_zip, context):
 
     footnote_definitions = []
-    res = _create_html_for_md_text_in_section(chapter,
-                                              bibliography_entries_seen=bibliography_entries_seen,
-                                              references_not_found=references_not_found)
+    res = _create_html_for_md_text_in_section(chapter, context=context)
     html = '\n'.join(res['rendered_lines'])
     footnote_definitions.extend(res['footnote_definitions'])
 
     for subchapter in chapter.subsections:
         html += CHAPTER_SECTION_LINE.format(epub_type='subchapter',
                                             section_id=subchapter.id)
-        res = _create_html_for_md_text_in_section(subchapter,
-                                                  bibliography_entries_seen=bibliography_entries_seen,
-                                                  references_not_found=references_not_found)
+        res = _create_html_for_md_text_in_section(subchapter, context=context)
         footnote_definitions.extend(res['footnote_definitions'])
         html += '\n'.join(res['rendered_lines'])
         html += '</section>\n'
@@ -545,16 +549,12 @@ def _create_section_xhtml_file(title, id_, section_html, fpath, epub_type,
     _write_html_in_zip_file(epub_zip, fpath, html)
 
 
-def _create_part(part, epub_zip, bibliography_entries_seen,
-                 references_not_found,
-                 endnote_definitions):
+def _create_part(part, epub_zip, context, endnote_definitions):
     title = part.title
     part_id = part.id
     fpath = _create_epub_fpath_for_section(part)
 
-    result = _create_html_for_md_text_in_section(part,
-                                                 bibliography_entries_seen=bibliography_entries_seen,
-                                                 references_not_found=references_not_found)
+    result = _create_html_for_md_text_in_section(part, context=context)
     section_html = '\n'.join(result['rendered_lines'])
     endnote_definitions.extend(result['footnote_definitions'])
 
@@ -568,9 +568,7 @@ def _create_part(part, epub_zip, bibliography_entries_seen,
     footnote_definitions = []
     for chapter in part.subsections:
         if chapter.kind == CHAPTER:
-            res = _create_chapter(chapter, epub_zip,
-                                  bibliography_entries_seen=bibliography_entries_seen,
-                                  references_not_found=references_not_found)
+            res = _create_chapter(chapter, epub_zip, context=context)
             footnote_definitions.extend(res['footnote_definitions'])
         else:
             raise RuntimeError('A part should only have chapters as subparts.')
@@ -843,24 +841,22 @@ def _create_opf(book, epub_zip):
 
 
 def create_epub(book, epub_path):
-    references_not_found = set()
+    context = _BuildContext(book)
+    context.anchors = _build_anchor_table(book)
+    context.anchors.check_links()
 
     with zipfile.ZipFile(epub_path, 'w') as epub_zip:
         _create_mimetype_file(epub_zip)
         _create_epub_backbone(epub_zip)
 
         endnote_definitions = []
-        bibliography_entries_seen = OrderedDict()
+        bibliography_entries_seen = context.bibliography_entries_seen
         for section in book.subsections:
             if section.kind == CHAPTER:
-                res = _create_chapter(section, epub_zip,
-                                      bibliography_entries_seen=bibliography_entries_seen,
-                                      references_not_found=references_not_found)
+                res = _create_chapter(section, epub_zip, context=context)
                 endnote_definitions.extend(res['footnote_definitions'])
             elif section.kind == PART:
-                _create_part(section, epub_zip,
-                             bibliography_entries_seen=bibliography_entries_seen,
-                             references_not_found=references_not_found,
+                _create_part(section, epub_zip, context=context,
                              endnote_definitions=endnote_definitions)
             elif section.kind == BOOK:
                 raise ValueError('A book should not include a subsection of kind BOOK')
@@ -921,6 +917,7 @@ def create_epub(book, epub_path):
         _create_opf(book, epub_zip=epub_zip)
 
     check_epub(epub_path)
+    references_not_found = context.references_not_found
     if references_not_found:
         msg = 'Some references were not found in the bibliography database'
         print('References not found:')
@@ -936,10 +933,17 @@ def unzip_epub(ebook_path, out_dir):
         epubzip.extractall(path=out_dir)
 
 
-def check_epub(ebook_path):
+def check_epub(ebook_path, epubcheck=True):
+    # the python validation is fast, epubcheck is slow but complete
+    errors = validate_epub(ebook_path)
+    report_validation_errors(ebook_path, errors)
+    if not epubcheck:
+        return errors
+
     cmd = ['java', '-jar', str(EPUBCHECK_JAR), str(ebook_path)]
     completed_process = subprocess.run(cmd, capture_output=True)
 
     if completed_process.returncode:
         sys.stdout.write(completed_process.stdout.decode())
         sys.stderr.write(completed_process.stderr.decode())
+    return errors
@@ -0,0 +1,240 @@
+
+# A structural check of the epub done in python, it takes milliseconds and
+# finds the errors that we usually make, epubcheck is the complete one
+
+import sys
+import zipfile
+import posixpath
+from urllib.parse import urlsplit, unquote
+from xml.etree import ElementTree
+
+from output_writers import MIMETYPE_FNAME
+
+EPUB_MIMETYPE = 'application/epub+zip'
+CONTAINER_PATH = 'META-INF/container.xml'
+XHTML_MEDIA_TYPE = 'application/xhtml+xml'
+NCX_MEDIA_TYPE = 'application/x-dtbncx+xml'
+
+CONTAINER_NS = '{urn:oasis:names:tc:opendocument:xmlns:container}'
+OPF_NS = '{http://www.idpf.org/2007/opf}'
+NCX_NS = '{http://www.daisy.org/z3986/2005/ncx/}'
+LINK_ATTRIBUTES = ('href', 'src', '{http://www.w3.org/1999/xlink}href')
+
+
+class _ZipEpub:
+    def __init__(self, path):
+        self._zip = zipfile.ZipFile(path)
+        self.infos = self._zip.infolist()
+        self.names = [zinfo.filename for zinfo in self.infos
+                      if not zinfo.filename.endswith('/')]
+
+    def read(self, name):
+        return self._zip.read(name)
+
+    def close(self):
+        self._zip.close()
+
+
+class _DirEpub:
+    def __init__(self, path):
+        self._dir = path
+        self.infos = None
+        # the hidden files, like the build manifest, are not part of the epub
+        self.names = sorted(str(file_path.relative_to(path).as_posix())
+                            for file_path in path.rglob('*')
+                            if file_path.is_file() and not file_path.name.startswith('.'))
+
+    def read(self, name):
+        return (self._dir / name).read_bytes()
+
+    def close(self):
+        pass
+
+
+def _create_error(path, message):
+    return {'path': path, 'message': message}
+
+
+def _check_mimetype(epub, errors):
+    if MIMETYPE_FNAME not in epub.names:
+        errors.append(_create_error(MIMETYPE_FNAME, 'The mimetype file is missing'))
+        return
+    if epub.infos is not None:
+        first = epub.infos[0]
+        if first.filename != MIMETYPE_FNAME:
+            errors.append(_create_error(MIMETYPE_FNAME,
+                                        'mimetype should be the first file in the epub'))
+        elif first.compress_type != zipfile.ZIP_STORED:
+            errors.append(_create_error(MIMETYPE_FNAME,
+                                        'mimetype should be stored without compression'))
+    if epub.read(MIMETYPE_FNAME) != EPUB_MIMETYPE.encode():
+        errors.append(_create_error(MIMETYPE_FNAME,
+                                    f'mimetype content should be {EPUB_MIMETYPE}'))
+
+
+def _parse_xml(epub, path, errors):
+    try:
+        return ElementTree.fromstring(epub.read(path))
+    except ElementTree.ParseError as error:
+        errors.append(_create_error(path, f'Not well-formed XML: {error}'))
+        return None
+
+
+def _resolve_href(base_path, href):
+    # returns the path within the epub and the fragment, None for remote links
+    parts = urlsplit(href)
+    if parts.scheme or parts.netloc:
+        return None
+    if not parts.path:
+        return base_path, unquote(parts.fragment)
+    path = posixpath.normpath(posixpath.join(posixpath.dirname(base_path),
+                                             unquote(parts.path)))
+    return path, unquote(parts.fragment)
+
+
+def _get_opf_path(epub, errors):
+    if CONTAINER_PATH not in epub.names:
+        errors.append(_create_error(CONTAINER_PATH, 'The container file is missing'))
+        return None
+    container = _parse_xml(epub, CONTAINER_PATH, errors)
+    if container is None:
+        return None
+    rootfile = container.find(f'.//{CONTAINER_NS}rootfile')
+    if rootfile is None or not rootfile.get('full-path'):
+        errors.append(_create_error(CONTAINER_PATH, 'No rootfile in the container'))
+        return None
+    opf_path = rootfile.get('full-path')
+    if opf_path not in epub.names:
+        errors.append(_create_error(CONTAINER_PATH, f'The rootfile {opf_path} is missing'))
+        return None
+    return opf_path
+
+
+def _check_opf(epub, opf_path, errors):
+    # returns the manifest items by id
+    opf = _parse_xml(epub, opf_path, errors)
+    if opf is None:
+        return {}, None
+
+    items = {}
+    for item in opf.iter(f'{OPF_NS}item'):
+        id_ = item.get('id')
+        if id_ in items:
+            errors.append(_create_error(opf_path, f'Repeated manifest id: {id_}'))
+        resolved = _resolve_href(opf_path, item.get('href', ''))
+        if resolved is None:
+            continue
+        path = resolved[0]
+        if path not in epub.names:
+            errors.append(_create_error(opf_path, f'Manifest item {id_} not found: {path}'))
+        items[id_] = {'path': path, 'media_type': item.get('media-type')}
+
+    spine = opf.find(f'{OPF_NS}spine')
+    if spine is None:
+        errors.append(_create_error(opf_path, 'The package has no spine'))
+        return items, None
+    for itemref in spine.iter(f'{OPF_NS}itemref'):
+        idref = itemref.get('idref')
+        if idref not in items:
+            errors.append(_create_error(opf_path, f'Spine item not in the manifest: {idref}'))
+    ncx_id = spine.get('toc')
+    if ncx_id is not None and ncx_id not in items:
+        errors.append(_create_error(opf_path, f'The spine toc is not in the manifest: {ncx_id}'))
+        ncx_id = None
+
+    in_manifest = {item['path'] for item in items.values()}
+    for name in epub.names:
+        if name in (MIMETYPE_FNAME, opf_path) or name.startswith('META-INF/'):
+            continue
+        if name not in in_manifest:
+            errors.append(_create_error(name, 'File not declared in the manifest'))
+    return items, ncx_id
+
+
+def _collect_links(path, root, links):
+    for element in root.iter():
+        for attribute in LINK_ATTRIBUTES:
+            href = element.get(attribute)
+            if href is not None:
+                links.append((path, href))
+
+
+def _check_ncx(epub, ncx_path, errors, links):
+    ncx = _parse_xml(epub, ncx_path, errors)
+    if ncx is None:
+        return
+    for expected, nav_point in enumerate(ncx.iter(f'{NCX_NS}navPoint'), start=1):
+        play_order = nav_point.get('playOrder')
+        if play_order != str(expected):
+            errors.append(_create_error(ncx_path,
+                                        f'navPoint {nav_point.get("id")} playOrder should be {expected}, not {play_order}'))
+        content = nav_point.find(f'{NCX_NS}content')
+        if content is None or content.get('src') is None:
+            errors.append(_create_error(ncx_path,
+                                        f'navPoint {nav_point.get("id")} has no content'))
+        else:
+            links.append((ncx_path, content.get('src')))
+
+
+def _check_links(links, ids_by_path, names, errors):
+    for path, href in links:
+        resolved = _resolve_href(path, href)
+        if resolved is None:
+            continue
+        target_path, fragment = resolved
+        if target_path not in names:
+            errors.append(_create_error(path, f'Broken link: {href}'))
+        elif fragment and target_path in ids_by_path and fragment not in ids_by_path[target_path]:
+            errors.append(_create_error(path, f'Broken link, no id {fragment}: {href}'))
+
+
+def _validate_epub(path):
+    epub = _DirEpub(path) if path.is_dir() else _ZipEpub(path)
+    errors = []
+    try:
+        _check_mimetype(epub, errors)
+        opf_path = _get_opf_path(epub, errors)
+        if opf_path is None:
+            return errors
+        items, ncx_id = _check_opf(epub, opf_path, errors)
+
+        ids_by_path = {}
+        links = []
+        for item in items.values():
+            if item['media_type'] != XHTML_MEDIA_TYPE or item['path'] not in epub.names:
+                continue
+            root = _parse_xml(epub, item['path'], errors)
+            if root is None:
+                continue
+            ids = set()
+            for element in root.iter():
+                id_ = element.get('id')
+                if id_ is None:
+                    continue
+                if id_ in ids:
+                    errors.append(_create_error(item['path'], f'Repeated id: {id_}'))
+                ids.add(id_)
+            ids_by_path[item['path']] = ids
+            _collect_links(item['path'], root, links)
+
+        if ncx_id is not None and items[ncx_id]['path'] in epub.names:
+            _check_ncx(epub, items[ncx_id]['path'], errors, links)
+        _check_links(links, ids_by_path, set(epub.names), errors)
+    finally:
+        epub.close()
+    return errors
+
+
+def validate_epub(path):
+    # path can be an epub file or a directory with the unzipped epub
+    # returns a list of errors, each one a dict with a path and a message
+    try:
+        return _validate_epub(path)
+    except (zipfile.BadZipFile, OSError) as error:
+        # a broken or unreadable epub is one more error, not a crash
+        return [_create_error(str(path), f'The epub can not be read: {error}')]
+
+
+def report_validation_errors(ebook_path, errors):
+    for error in errors:
+        sys.stderr.write(f'{ebook_path}: {error["path"]}: {error["message"]}\n')
@@ -0,0 +1,85 @@
+
+import unittest
+import tempfile
+import zipfile
+from pathlib import Path
+
+from book_section import BookSection
+from book_section_test import _prepare_book_md_files
+from site_creation_test import SUBCHAPTER_BOOK_STRUCTURE
+from site_creation import SiteRenderer, EPUB3
+from epub_validation import validate_epub
+
+
+def _render_epub(book_dir, zip_path):
+    with SiteRenderer(BookSection(Path(book_dir)), site_kind=EPUB3,
+                      zip_path=zip_path, validate=False) as renderer:
+        renderer.render()
+
+
+def _rewrite_epub(zip_path, new_zip_path, replacements, mimetype_last=False):
+    with zipfile.ZipFile(zip_path) as epub_zip, \
+         zipfile.ZipFile(new_zip_path, 'w') as new_zip:
+        zinfos = epub_zip.infolist()
+        if mimetype_last:
+            zinfos = zinfos[1:] + zinfos[:1]
+        for zinfo in zinfos:
+            content = epub_zip.read(zinfo.filename).decode()
+            for fname, old, new in replacements:
+                if fname == zinfo.filename:
+                    content = content.replace(old, new)
+            new_zip.writestr(zinfo, content)
+
+
+class ValidateEpubTest(unittest.TestCase):
+    def test_valid_epub(self):
+        with _prepare_book_md_files(SUBCHAPTER_BOOK_STRUCTURE) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            zip_path = Path(tmp_dir) / 'book.epub'
+            _render_epub(book_dir, zip_path)
+            assert validate_epub(zip_path) == []
+
+            out_dir = Path(tmp_dir) / 'book'
+            with zipfile.ZipFile(zip_path) as epub_zip:
+                epub_zip.extractall(out_dir)
+            assert validate_epub(out_dir) == []
+
+    def test_invalid_epub(self):
+        with _prepare_book_md_files(SUBCHAPTER_BOOK_STRUCTURE) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            zip_path = Path(tmp_dir) / 'book.epub'
+            _render_epub(book_dir, zip_path)
+
+            bad_zip_path = Path(tmp_dir) / 'bad.epub'
+            replacements = [('EPUB/nav.xhtml', '</nav>', ''),
+                            ('EPUB/toc.xhtml', '#nav_span_chapter_1_2', '#missing'),
+                            ('EPUB/toc.ncx', 'playOrder="3"', 'playOrder="5"'),
+                            ('EPUB/content.opf', '<itemref idref="chapter_1"/>',
+                             '<itemref idref="chapter_1"/><itemref idref="chapter_9"/>')]
+            _rewrite_epub(zip_path, bad_zip_path, replacements, mimetype_last=True)
+            errors = validate_epub(bad_zip_path)
+            messages = [(error['path'], error['message'].split(':')[0]) for error in errors]
+            assert messages == [('mimetype', 'mimetype should be the first file in the epub'),
+                                ('EPUB/content.opf', 'Spine item not in the manifest'),
+                                ('EPUB/nav.xhtml', 'Not well-formed XML'),
+                                ('EPUB/toc.ncx', 'navPoint chapter_1_1 playOrder should be 3, not 5'),
+                                ('EPUB/toc.xhtml', 'Broken link, no id missing')]
+
+    def test_truncated_epub(self):
+        with _prepare_book_md_files(SUBCHAPTER_BOOK_STRUCTURE) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            zip_path = Path(tmp_dir) / 'book.epub'
+            _render_epub(book_dir, zip_path)
+            content = zip_path.read_bytes()
+            zip_path.write_bytes(content[:len(content) // 2])
+            errors = validate_epub(zip_path)
+            assert len(errors) == 1
+            assert errors[0]['path'] == str(zip_path)
+            assert errors[0]['message'].startswith('The epub can not be read')
+
+            errors = validate_epub(Path(tmp_dir) / 'missing.epub')
+            assert errors[0]['message'].startswith('The epub can not be read')
+
+
+if __name__ == '__main__':
+    unittest.main()
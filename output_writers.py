@@ -0,0 +1,463 @@
+
+import zipfile
+import zlib
+import gzip
+import hashlib
+import struct
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIMETYPE_FNAME = 'mimetype'
+
+DEFAULT_COMPRESSLEVEL = 6
+STREAM_THRESHOLD = 256 * 1024
+CHUNK_SIZE = 64 * 1024
+
+GZIP = 'gzip'
+BROTLI = 'br'
+PRECOMPRESSED_SUFFIXES = {GZIP: '.gz', BROTLI: '.br'}
+PRECOMPRESSIBLE_SUFFIXES = ('.html', '.xhtml', '.css', '.js', '.json', '.svg',
+                            '.xml', '.txt')
+
+ZIP_LOCAL_HEADER_STRUCT = '<4s2B4HL2L2H'
+ZIP_LOCAL_HEADER_SIZE = struct.calcsize(ZIP_LOCAL_HEADER_STRUCT)
+
+
+def _compress_member(data, compress_type, compresslevel):
+    crc = zlib.crc32(data)
+    if compress_type == zipfile.ZIP_STORED:
+        return crc, data
+    # raw deflate stream, as zipfile writes it
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    return crc, compressor.compress(data) + compressor.flush()
+
+
+def iter_content_chunks(content):
+    if isinstance(content, str):
+        for start in range(0, len(content), CHUNK_SIZE):
+            yield content[start:start + CHUNK_SIZE]
+    else:
+        for chunk in content:
+            yield chunk
+
+
+def hash_content(content):
+    hasher = hashlib.sha256()
+    for chunk in iter_content_chunks(content):
+        hasher.update(chunk.encode())
+    return hasher.hexdigest()
+
+
+def crc_content(content):
+    crc = 0
+    for chunk in iter_content_chunks(content):
+        crc = zlib.crc32(chunk.encode(), crc)
+    return crc
+
+
+def _get_content_size_and_crc(content):
+    size = 0
+    crc = 0
+    for chunk in iter_content_chunks(content):
+        data = chunk.encode()
+        size += len(data)
+        crc = zlib.crc32(data, crc)
+    return size, crc
+
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with path.open('rb') as fhand:
+        for chunk in iter(lambda: fhand.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _read_raw_member(zip_file, zinfo):
+    fhand = zip_file.fp
+    fhand.seek(zinfo.header_offset)
+    header = struct.unpack(ZIP_LOCAL_HEADER_STRUCT,
+                           fhand.read(ZIP_LOCAL_HEADER_SIZE))
+    fname_length, extra_length = header[-2:]
+    fhand.seek(fname_length + extra_length, os.SEEK_CUR)
+    return fhand.read(zinfo.compress_size)
+
+
+def _copy_zip_info(zinfo):
+    new_zinfo = zipfile.ZipInfo(zinfo.filename, date_time=zinfo.date_time)
+    new_zinfo.compress_type = zinfo.compress_type
+    new_zinfo.external_attr = zinfo.external_attr
+    return new_zinfo
+
+
+class EpubZipWriter:
+    def __init__(self, path, compresslevel=DEFAULT_COMPRESSLEVEL,
+                 stream_threshold=STREAM_THRESHOLD, compress_jobs=None,
+                 date_time=None, base_path=None):
+        # if a base archive is given the members whose content has not
+        # changed are copied from it as they are, already compressed
+        self.path = path
+        self.base_path = base_path
+        self.compresslevel = compresslevel
+        self.stream_threshold = stream_threshold
+        self.compress_jobs = compress_jobs
+        self.date_time = date_time
+        self._zip = None
+        self._base_zip = None
+        self._out_path = path
+        self._pool = None
+        self._pending = deque()
+        self.stats = None
+
+    def open(self):
+        start = time.perf_counter()
+        if self.base_path is not None and self.base_path.exists():
+            self._base_zip = zipfile.ZipFile(self.base_path)
+            # the base could be the archive that we are replacing
+            self._out_path = self.path.with_name(f'.{self.path.name}.tmp')
+        self._zip = zipfile.ZipFile(self._out_path, 'w',
+                                    compression=zipfile.ZIP_DEFLATED,
+                                    compresslevel=self.compresslevel)
+        # all entries share the date so the archive does not depend on when
+        # each member was written
+        if self.date_time is None:
+            self.date_time = time.localtime(time.time())[:6]
+        if self.compress_jobs:
+            self._pool = ThreadPoolExecutor(max_workers=self.compress_jobs)
+        self.stats = {'num_entries': 0,
+                      'num_copied_from_base': 0,
+                      'uncompressed_size': 0,
+                      'zip_size': None,
+                      'write_time': time.perf_counter() - start}
+
+    def _create_zip_info(self, path, compress_type=zipfile.ZIP_DEFLATED):
+        zinfo = zipfile.ZipInfo(path, date_time=self.date_time)
+        zinfo.compress_type = compress_type
+        zinfo._compresslevel = self.compresslevel
+        zinfo.external_attr = 0o600 << 16
+        return zinfo
+
+    def _write_mimetype(self, content):
+        if self.stats['num_entries']:
+            msg = 'mimetype should be the first file in the epub'
+            raise ValueError(msg)
+        data = content.encode()
+        self._zip.writestr(self._create_zip_info(MIMETYPE_FNAME, zipfile.ZIP_STORED),
+                           data)
+        return len(data)
+
+    def _write_streamed(self, path, content):
+        size = 0
+        with self._zip.open(self._create_zip_info(path), 'w') as fhand:
+            for chunk in iter_content_chunks(content):
+                data = chunk.encode()
+                fhand.write(data)
+                size += len(data)
+        return size
+
+    def _append_compressed_member(self, zinfo, file_size, crc, compressed):
+        zip_file = self._zip
+        zinfo.file_size = file_size
+        zinfo.CRC = crc
+        zinfo.compress_size = len(compressed)
+
+        zip_file.fp.seek(zip_file.start_dir)
+        zinfo.header_offset = zip_file.fp.tell()
+        zip_file.fp.write(zinfo.FileHeader())
+        zip_file.fp.write(compressed)
+        zip_file.filelist.append(zinfo)
+        zip_file.NameToInfo[zinfo.filename] = zinfo
+        zip_file.start_dir = zip_file.fp.tell()
+        zip_file._didModify = True
+
+    def _append_finished_members(self, wait=False):
+        pending = self._pending
+        while pending and (wait or pending[0]['future'].done()):
+            member = pending.popleft()
+            crc, compressed = member['future'].result()
+            self._append_compressed_member(member['zinfo'],
+                                           file_size=member['file_size'],
+                                           crc=crc, compressed=compressed)
+
+    def _get_base_member(self, path):
+        if self._base_zip is None:
+            return None
+        try:
+            return self._base_zip.getinfo(path)
+        except KeyError:
+            return None
+
+    def get_base_member_crc(self, path):
+        base_zinfo = self._get_base_member(str(path))
+        return None if base_zinfo is None else base_zinfo.CRC
+
+    def _get_unchanged_base_member(self, path, file_size, crc):
+        base_zinfo = self._get_base_member(path)
+        if base_zinfo is None:
+            return None
+        if base_zinfo.file_size != file_size or base_zinfo.CRC != crc:
+            return None
+        return base_zinfo
+
+    def copy_member_from_base(self, path):
+        start = time.perf_counter()
+        path = str(path)
+        base_zinfo = self._get_base_member(path)
+        if base_zinfo is None:
+            raise ValueError(f'{path} is not in the base archive')
+        if self._pool:
+            self._submit_copied_member(base_zinfo)
+        else:
+            self._copy_base_member(base_zinfo)
+        self._update_stats(base_zinfo.file_size, start, copied=True)
+
+    def _copy_base_member(self, base_zinfo):
+        compressed = _read_raw_member(self._base_zip, base_zinfo)
+        self._append_compressed_member(_copy_zip_info(base_zinfo),
+                                       file_size=base_zinfo.file_size,
+                                       crc=base_zinfo.CRC,
+                                       compressed=compressed)
+
+    def _submit_copied_member(self, base_zinfo):
+        future = Future()
+        future.set_result((base_zinfo.CRC,
+                           _read_raw_member(self._base_zip, base_zinfo)))
+        self._pending.append({'zinfo': _copy_zip_info(base_zinfo),
+                              'file_size': base_zinfo.file_size,
+                              'future': future})
+        self._append_finished_members()
+
+    def _submit_member(self, path, content):
+        if path == MIMETYPE_FNAME:
+            if self.stats['num_entries']:
+                msg = 'mimetype should be the first file in the epub'
+                raise ValueError(msg)
+            compress_type = zipfile.ZIP_STORED
+        else:
+            compress_type = zipfile.ZIP_DEFLATED
+
+        data = ''.join(iter_content_chunks(content)).encode()
+        if compress_type != zipfile.ZIP_STORED:
+            base_zinfo = self._get_unchanged_base_member(path, len(data),
+                                                         zlib.crc32(data))
+            if base_zinfo is not None:
+                self._submit_copied_member(base_zinfo)
+                return len(data), True
+        zinfo = self._create_zip_info(path, compress_type)
+        future = self._pool.submit(_compress_member, data, compress_type,
+                                   self.compresslevel)
+        self._pending.append({'zinfo': zinfo, 'file_size': len(data),
+                              'future': future})
+        self._append_finished_members()
+        return len(data), False
+
+    def _write_member(self, path, content):
+        if path == MIMETYPE_FNAME:
+            return self._write_mimetype(content), False
+
+        if self._base_zip is not None and self._get_base_member(path):
+            # the content is compared chunk by chunk, a changed member is
+            # written like in a build without base
+            size, crc = _get_content_size_and_crc(content)
+            base_zinfo = self._get_unchanged_base_member(path, size, crc)
+            if base_zinfo is not None:
+                self._copy_base_member(base_zinfo)
+                return size, True
+
+        if isinstance(content, str) and len(content) < self.stream_threshold:
+            data = content.encode()
+            self._zip.writestr(self._create_zip_info(path), data)
+            return len(data), False
+        return self._write_streamed(path, content), False
+
+    def _update_stats(self, size, start, copied=False):
+        stats = self.stats
+        stats['num_entries'] += 1
+        if copied:
+            stats['num_copied_from_base'] += 1
+        stats['uncompressed_size'] += size
+        stats['write_time'] += time.perf_counter() - start
+
+    def write(self, path, content):
+        start = time.perf_counter()
+        path = str(path)
+        if self._pool:
+            size, copied = self._submit_member(path, content)
+        else:
+            size, copied = self._write_member(path, content)
+        self._update_stats(size, start, copied=copied)
+
+    def close(self):
+        if self._zip is None:
+            return self.stats
+        start = time.perf_counter()
+        if self._pool:
+            self._append_finished_members(wait=True)
+            self._pool.shutdown()
+            self._pool = None
+        self._zip.close()
+        self._zip = None
+        if self._base_zip is not None:
+            self._base_zip.close()
+            self._base_zip = None
+            os.replace(self._out_path, self.path)
+            self._out_path = self.path
+        self.stats['write_time'] += time.perf_counter() - start
+        self.stats['zip_size'] = self.path.stat().st_size
+        return self.stats
+
+
+def get_available_precompressions():
+    if brotli is None:
+        return [GZIP]
+    return [GZIP, BROTLI]
+
+
+def _precompress_file(path, encodings):
+    data = path.read_bytes()
+    for encoding in encodings:
+        if encoding == GZIP:
+            # no mtime in the header, the same file always gives the same gz
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        else:
+            compressed = brotli.compress(data)
+        sibling_path = path.with_name(path.name + PRECOMPRESSED_SUFFIXES[encoding])
+        tmp_path = sibling_path.with_name(f'.{sibling_path.name}.tmp')
+        tmp_path.write_bytes(compressed)
+        os.replace(tmp_path, sibling_path)
+
+
+class DirectoryWriter:
+    def __init__(self, out_dir, exist_ok=False, precompress=None,
+                 compress_jobs=None):
+        # files are written through a temporary file so that nobody sees them
+        # half written. Only a dir that already exists can have unchanged
+        # files, in a new one every file is written without comparing it
+        self.out_dir = out_dir
+        self.exist_ok = exist_ok
+        if precompress is True:
+            precompress = get_available_precompressions()
+        precompress = list(precompress or [])
+        for encoding in precompress:
+            if encoding not in PRECOMPRESSED_SUFFIXES:
+                raise ValueError(f'Unknown precompression: {encoding}')
+            if encoding == BROTLI and brotli is None:
+                raise RuntimeError('brotli precompression requires the brotli module')
+        self.precompress = precompress
+        self.compress_jobs = compress_jobs
+        self._dirs_created = set()
+        self._pool = None
+        self._futures = []
+        self.report = None
+
+    def open(self):
+        start = time.perf_counter()
+        self.out_dir.mkdir(parents=True, exist_ok=self.exist_ok)
+        self._dirs_created = {self.out_dir}
+        if self.precompress:
+            self._pool = ThreadPoolExecutor(max_workers=self.compress_jobs)
+        self.report = {'changed': [],
+                       'unchanged': [],
+                       'precompressed': [],
+                       'bytes_written': 0,
+                       'write_time': time.perf_counter() - start}
+
+    def _make_dir(self, dir_):
+        if dir_ in self._dirs_created:
+            return
+        dir_.mkdir(parents=True, exist_ok=True)
+        self._dirs_created.add(dir_)
+        self._dirs_created.update(dir_.parents)
+
+    def file_is_unchanged(self, path, content_hash):
+        full_path = self.out_dir / path
+        return full_path.is_file() and hash_file(full_path) == content_hash
+
+    def _get_sibling_paths(self, full_path, encodings=None):
+        if encodings is None:
+            encodings = self.precompress
+        return [full_path.with_name(full_path.name + PRECOMPRESSED_SUFFIXES[encoding])
+                for encoding in encodings]
+
+    def _remove_stale_siblings(self, path):
+        # the siblings of the encodings that are not precompressed now were
+        # left by a previous build, the server would send them instead of
+        # the new file
+        full_path = self.out_dir / path
+        if not self.exist_ok or full_path.suffix not in PRECOMPRESSIBLE_SUFFIXES:
+            return
+        encodings = [encoding for encoding in PRECOMPRESSED_SUFFIXES
+                     if encoding not in self.precompress]
+        for sibling in self._get_sibling_paths(full_path, encodings):
+            if sibling.exists():
+                sibling.unlink()
+
+    def _precompress(self, path, changed):
+        full_path = self.out_dir / path
+        if full_path.suffix not in PRECOMPRESSIBLE_SUFFIXES:
+            return
+        if not changed:
+            mtime = full_path.stat().st_mtime_ns
+            if all(sibling.exists() and sibling.stat().st_mtime_ns >= mtime
+                   for sibling in self._get_sibling_paths(full_path)):
+                return
+        self._futures.append(self._pool.submit(_precompress_file, full_path,
+                                               self.precompress))
+        self.report['precompressed'].append(str(path))
+
+    def keep(self, path):
+        # a file from a previous build that is known to be up to date
+        self.report['unchanged'].append(str(path))
+        self._remove_stale_siblings(path)
+        if self.precompress:
+            self._precompress(path, changed=False)
+
+    def remove(self, path):
+        full_path = self.out_dir / path
+        for path_to_remove in [full_path] + self._get_sibling_paths(full_path,
+                                                                     PRECOMPRESSED_SUFFIXES):
+            if path_to_remove.exists():
+                path_to_remove.unlink()
+
+    def write(self, path, content, content_hash=None):
+        start = time.perf_counter()
+        full_path = self.out_dir / path
+        unchanged = False
+        if self.exist_ok and full_path.is_file():
+            if content_hash is None:
+                content_hash = hash_content(content)
+            unchanged = hash_file(full_path) == content_hash
+        if unchanged:
+            self.keep(path)
+        else:
+            self._make_dir(full_path.parent)
+            tmp_path = full_path.with_name(f'.{full_path.name}.tmp')
+            with tmp_path.open('wt') as fhand:
+                fhand.writelines(iter_content_chunks(content))
+            os.replace(tmp_path, full_path)
+            self.report['changed'].append(str(path))
+            self.report['bytes_written'] += full_path.stat().st_size
+            self._remove_stale_siblings(path)
+            if self.precompress:
+                self._precompress(path, changed=True)
+        self.report['write_time'] += time.perf_counter() - start
+
+    def close(self):
+        if self._pool is not None:
+            start = time.perf_counter()
+            try:
+                for future in self._futures:
+                    future.result()
+            finally:
+                self._pool.shutdown()
+                self._pool = None
+                self._futures = []
+            self.report['write_time'] += time.perf_counter() - start
+        return self.report
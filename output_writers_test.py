@@ -0,0 +1,183 @@
+
+import unittest
+import tempfile
+import gzip
+import zipfile
+from pathlib import Path
+
+from output_writers import EpubZipWriter, DirectoryWriter, GZIP
+
+CHAPTER = '<p>Some text in a chapter.</p>\n' * 2000
+
+
+def _write_epub(path, compress_jobs):
+    writer = EpubZipWriter(path, compress_jobs=compress_jobs,
+                           date_time=(2020, 1, 1, 0, 0, 0))
+    writer.open()
+    writer.write('mimetype', 'application/epub+zip')
+    for idx in range(10):
+        writer.write(f'EPUB/chapter_{idx}.xhtml', [f'<h1>{idx}</h1>', CHAPTER])
+    writer.write('EPUB/nav.xhtml', '<nav></nav>')
+    return writer.close()
+
+
+class _StreamRecordingWriter(EpubZipWriter):
+    def open(self):
+        super().open()
+        self.streamed = []
+
+    def _write_streamed(self, path, content):
+        self.streamed.append(path)
+        return super()._write_streamed(path, content)
+
+
+class EpubZipWriterTest(unittest.TestCase):
+    def test_parallel_deflate(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            epubs = []
+            for compress_jobs in [None, 1, 3]:
+                path = Path(tmp_dir) / f'book_{compress_jobs}.epub'
+                stats = _write_epub(path, compress_jobs)
+                assert stats['num_entries'] == 12
+                assert stats['zip_size'] < stats['uncompressed_size']
+                epubs.append(path.read_bytes())
+            assert epubs[0] == epubs[1]
+            assert epubs[0] == epubs[2]
+
+            with zipfile.ZipFile(path) as epub_zip:
+                assert epub_zip.testzip() is None
+                infos = epub_zip.infolist()
+                assert infos[0].filename == 'mimetype'
+                assert infos[0].compress_type == zipfile.ZIP_STORED
+                assert [info.filename for info in infos[1:-1]] == [f'EPUB/chapter_{idx}.xhtml' for idx in range(10)]
+                assert {info.date_time for info in infos} == {(2020, 1, 1, 0, 0, 0)}
+                assert epub_zip.read('EPUB/chapter_4.xhtml').decode() == '<h1>4</h1>' + CHAPTER
+
+    def test_mimetype_first(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for compress_jobs in [None, 2]:
+                writer = EpubZipWriter(Path(tmp_dir) / 'book.epub',
+                                       compress_jobs=compress_jobs)
+                writer.open()
+                writer.write('EPUB/chapter_1.xhtml', CHAPTER)
+                with self.assertRaises(ValueError):
+                    writer.write('mimetype', 'application/epub+zip')
+                writer.close()
+
+    def test_copy_unchanged_members_from_base(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for compress_jobs in [None, 2]:
+                path = Path(tmp_dir) / f'book_{compress_jobs}.epub'
+                _write_epub(path, compress_jobs)
+                previous_chapter_0 = zipfile.ZipFile(path).getinfo('EPUB/chapter_0.xhtml')
+
+                writer = EpubZipWriter(path, compress_jobs=compress_jobs,
+                                       base_path=path)
+                writer.open()
+                writer.write('mimetype', 'application/epub+zip')
+                writer.write('EPUB/chapter_0.xhtml', ['<h1>0</h1>', CHAPTER])
+                writer.write('EPUB/chapter_1.xhtml', 'A new chapter')
+                writer.copy_member_from_base('EPUB/chapter_2.xhtml')
+                stats = writer.close()
+                assert stats['num_entries'] == 4
+                assert stats['num_copied_from_base'] == 2
+
+                with zipfile.ZipFile(path) as epub_zip:
+                    assert epub_zip.testzip() is None
+                    assert epub_zip.namelist() == ['mimetype',
+                                                   'EPUB/chapter_0.xhtml',
+                                                   'EPUB/chapter_1.xhtml',
+                                                   'EPUB/chapter_2.xhtml']
+                    assert epub_zip.getinfo('EPUB/chapter_0.xhtml').date_time == previous_chapter_0.date_time
+                    assert epub_zip.read('EPUB/chapter_1.xhtml') == b'A new chapter'
+                    assert epub_zip.read('EPUB/chapter_2.xhtml').decode() == '<h1>2</h1>' + CHAPTER
+                assert not list(Path(tmp_dir).glob('.*.tmp'))
+
+    def test_stream_changed_members_with_base(self):
+        # a changed member is written like in a build without base
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / 'book.epub'
+            _write_epub(path, compress_jobs=None)
+            writer = _StreamRecordingWriter(path, base_path=path)
+            writer.open()
+            writer.write('mimetype', 'application/epub+zip')
+            writer.write('EPUB/chapter_0.xhtml', ['<h1>0</h1>', CHAPTER])
+            writer.write('EPUB/chapter_1.xhtml', ['<h1>Changed</h1>', CHAPTER])
+            writer.write('EPUB/chapter_2.xhtml', 'A new chapter')
+            stats = writer.close()
+            assert stats['num_copied_from_base'] == 1
+            assert writer.streamed == ['EPUB/chapter_1.xhtml']
+            with zipfile.ZipFile(path) as epub_zip:
+                assert epub_zip.testzip() is None
+                assert epub_zip.read('EPUB/chapter_1.xhtml').decode() == '<h1>Changed</h1>' + CHAPTER
+                assert epub_zip.read('EPUB/chapter_2.xhtml') == b'A new chapter'
+
+
+
+class DirectoryWriterTest(unittest.TestCase):
+    def test_write_if_changed(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_dir = Path(tmp_dir) / 'site'
+            reports = []
+            for chapter_2 in ['Second chapter', 'Second chapter', 'Changed chapter']:
+                writer = DirectoryWriter(out_dir, exist_ok=True)
+                writer.open()
+                writer.write(Path('section/chapter_1.html'), ['<h1>', 'First chapter', '</h1>'])
+                writer.write(Path('section/chapter_2.html'), chapter_2)
+                reports.append(writer.close())
+            assert reports[0]['changed'] == ['section/chapter_1.html', 'section/chapter_2.html']
+            assert reports[1]['changed'] == []
+            assert reports[1]['unchanged'] == ['section/chapter_1.html', 'section/chapter_2.html']
+            assert reports[2]['changed'] == ['section/chapter_2.html']
+            assert (out_dir / 'section' / 'chapter_2.html').read_text() == 'Changed chapter'
+            assert not list(out_dir.rglob('*.tmp'))
+
+            writer = DirectoryWriter(out_dir)
+            with self.assertRaises(FileExistsError):
+                writer.open()
+
+            writer = DirectoryWriter(Path(tmp_dir) / 'new_site')
+            writer.open()
+            writer.write(Path('section/chapter_1.html'), 'First chapter')
+            report = writer.close()
+            assert report['changed'] == ['section/chapter_1.html']
+            assert report['unchanged'] == []
+
+    def test_precompress(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_dir = Path(tmp_dir) / 'site'
+            reports = []
+            for _ in range(2):
+                writer = DirectoryWriter(out_dir, exist_ok=True, precompress=[GZIP],
+                                         compress_jobs=2)
+                writer.open()
+                writer.write(Path('section/chapter_1.html'), CHAPTER)
+                writer.write(Path('images/cover.png'), 'not text')
+                reports.append(writer.close())
+            assert reports[0]['precompressed'] == ['section/chapter_1.html']
+            assert reports[1]['precompressed'] == []
+            gz_path = out_dir / 'section' / 'chapter_1.html.gz'
+            assert gzip.decompress(gz_path.read_bytes()).decode() == CHAPTER
+            assert not (out_dir / 'images' / 'cover.png.gz').exists()
+
+            # without precompression the new file is not hidden by an old sibling
+            for chapter in [CHAPTER, 'Changed chapter']:
+                writer = DirectoryWriter(out_dir, exist_ok=True)
+                writer.open()
+                writer.write(Path('section/chapter_1.html'), chapter)
+                writer.close()
+                assert not gz_path.exists()
+                gz_path.write_bytes(gzip.compress(b'stale'))
+            writer = DirectoryWriter(out_dir, exist_ok=True, precompress=[GZIP])
+            writer.open()
+            writer.remove(Path('section/chapter_1.html'))
+            writer.close()
+            assert not gz_path.exists()
+            assert not (out_dir / 'section' / 'chapter_1.html').exists()
+
+        with self.assertRaises(ValueError):
+            DirectoryWriter(out_dir, precompress=['zstd'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,12 @@
 
 from pathlib import Path
-from tempfile import NamedTemporaryFile
-from subprocess import run, PIPE
+from subprocess import run, PIPE, CalledProcessError
 import re
 from pprint import pprint
 from collections import OrderedDict
 import os
 import uuid
+import asyncio
 
 from bs4 import BeautifulSoup
 
@@ -17,26 +17,44 @@ PANDOC_BIN = 'pandoc'
 CSL_PATHS = {'chicago-note-bibliography-with-ibid': Path('chicago-note-bibliography-with-ibid.csl')}
 this_module_dir = Path(os.path.dirname(os.path.abspath(__file__)))
 CSL_PATHS = {csl: this_module_dir / fname for  csl, fname in CSL_PATHS.items()}
+DEFAULT_CSL = 'chicago-note-bibliography-with-ibid'
 
 ID_RE = re.compile(r'&lt;[0-9a-g]*[-–][0-9a-g]*[-–][0-9a-g]*[-–][0-9a-g]*[-–][0-9a-g]*&gt;')
 CITATION_KEY_RE = re.compile(r'@([^ \]]+)')
 
 
-def _run_pandoc(mk_text, csl_path, libray_csl_json_path):
+def _get_pandoc_cmd(csl_path, libray_csl_json_path):
+    return [PANDOC_BIN,
+            '--csl', str(csl_path),
+            '--bibliography', str(libray_csl_json_path),
+            '--filter', 'pandoc-citeproc']
 
-    with NamedTemporaryFile('wt') as fhand:
-        fhand.write(mk_text)
-        fhand.flush()
 
-        cmd = [PANDOC_BIN,
-               '--csl', str(csl_path),
-               '--bibliography', str(libray_csl_json_path),
-               '--filter', 'pandoc-citeproc',
-               fhand.name]
-        process = run(cmd, stdout=PIPE, stderr=PIPE, check=True)
+def _run_pandoc(mk_text, csl_path, libray_csl_json_path):
+    # the markdown goes through stdin, so there is no temporary file to share
+    # between the renderers that run pandoc at the same time
+    cmd = _get_pandoc_cmd(csl_path, libray_csl_json_path)
+    process = run(cmd, input=mk_text.encode(), stdout=PIPE, stderr=PIPE,
+                  check=True)
     return process
 
 
+async def _run_pandoc_async(mk_text, csl_path, libray_csl_json_path):
+    cmd = _get_pandoc_cmd(csl_path, libray_csl_json_path)
+    process = await asyncio.create_subprocess_exec(*cmd, stdin=PIPE,
+                                                   stdout=PIPE, stderr=PIPE)
+    try:
+        stdout, stderr = await process.communicate(mk_text.encode())
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode:
+        raise CalledProcessError(process.returncode, cmd, output=stdout,
+                                 stderr=stderr)
+    return stdout
+
+
 def _get_ids_from_html_text(html_text):
     matches = ID_RE.findall(html_text)
 
@@ -156,7 +174,7 @@ def _prepare_md_text_for_pandoc(items):
 
 
 def process_citations(md_items, libray_csl_json_path,
-                      csl='chicago-note-bibliography-with-ibid'):
+                      csl=DEFAULT_CSL):
     csl_path = CSL_PATHS[csl]
 
     items = _prepare_items(md_items)
@@ -165,7 +183,32 @@ def process_citations(md_items, libray_csl_json_path,
   
     process = _run_pandoc(md_text, csl_path, libray_csl_json_path)
 
-    results = _parse_pandoc_citations(process.stdout.decode())
+    return _collect_citation_results(items, process.stdout.decode())
+
+
+async def process_citations_async(md_items, libray_csl_json_path,
+                                  csl=DEFAULT_CSL,
+                                  semaphore=None):
+    # the semaphore limits how many pandoc processes run at the same time
+    csl_path = CSL_PATHS[csl]
+
+    items = _prepare_items(md_items)
+
+    md_text = _prepare_md_text_for_pandoc(items)
+
+    if semaphore is None:
+        stdout = await _run_pandoc_async(md_text, csl_path, libray_csl_json_path)
+    else:
+        async with semaphore:
+            stdout = await _run_pandoc_async(md_text, csl_path, libray_csl_json_path)
+
+    # the html is parsed here and not in the default executor, its threads
+    # can all be renders that wait for this coroutine
+    return _collect_citation_results(items, stdout.decode())
+
+
+def _collect_citation_results(items, pandoc_html):
+    results = _parse_pandoc_citations(pandoc_html)
 
     parsed_results_by_id = {}
     for res in results['citations']:
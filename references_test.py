@@ -0,0 +1,34 @@
+
+import unittest
+import asyncio
+import tempfile
+from pathlib import Path
+
+import references
+from benchmarks.synthetic_book import create_synthetic_book
+from benchmarks.run_benchmarks import PANDOC_STUB_PATH
+
+
+class ProcessCitationsTest(unittest.TestCase):
+    def setUp(self):
+        self._pandoc_bin = references.PANDOC_BIN
+        references.PANDOC_BIN = str(PANDOC_STUB_PATH)
+
+    def tearDown(self):
+        references.PANDOC_BIN = self._pandoc_bin
+
+    def test_process_citations_async(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            res = create_synthetic_book(Path(tmp_dir) / 'book', bibliography_size=3)
+            citation_texts = ['[@ref0]', '[@ref1, p. 3]', '[@ref2; @ref0]']
+            expected = references.process_citations(citation_texts,
+                                                    libray_csl_json_path=res['bibliography_path'])
+            processed = asyncio.run(references.process_citations_async(citation_texts,
+                                                                       libray_csl_json_path=res['bibliography_path']))
+            assert processed == expected
+            assert all(item['citations_found'] for item in processed['citation_items'])
+            assert len(processed['references']) == 3
+
+
+if __name__ == '__main__':
+    unittest.main()
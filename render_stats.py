@@ -0,0 +1,198 @@
+
+# Where the time of a build goes. The stages can nest, pandoc runs within
+# citations and read within scan, and the pipelined builds run them in
+# several threads, so the cpu time is the one of the thread that ran them
+
+import sys
+import time
+import threading
+import tracemalloc
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+
+MIB = 1024 ** 2
+
+
+def _get_hit_rate(hits, calls):
+    if not calls:
+        return None
+    return hits / calls
+
+
+class RenderStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self.stages = {}
+        self.sections = defaultdict(dict)
+        self.counters = Counter()
+
+    @contextmanager
+    def stage(self, name, section_id=None):
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_stage(name, wall_time=time.perf_counter() - wall_start,
+                           cpu_time=time.thread_time() - cpu_start,
+                           section_id=section_id)
+
+    def add_stage(self, name, wall_time, cpu_time, num_calls=1, section_id=None):
+        with self._lock:
+            stats = self.stages.setdefault(name, {'wall_time': 0.0,
+                                                  'cpu_time': 0.0,
+                                                  'num_calls': 0})
+            stats['wall_time'] += wall_time
+            stats['cpu_time'] += cpu_time
+            stats['num_calls'] += num_calls
+            if section_id is not None:
+                section_stats = self.sections[section_id]
+                section_stats[name] = section_stats.get(name, 0.0) + wall_time
+
+    def count(self, name, num=1):
+        with self._lock:
+            self.counters[name] += num
+
+    def get_report(self):
+        counters = self.counters
+        markdown_calls = counters['markdown_calls']
+        citation_calls = counters['citation_cache_hits'] + counters['pandoc_calls']
+        return {'wall_time': time.perf_counter() - self._start,
+                'cpu_time': time.process_time() - self._cpu_start,
+                'stages': self.stages,
+                'sections': dict(self.sections),
+                'counters': dict(counters),
+                'cache_hit_rates': {'markdown': _get_hit_rate(counters['markdown_cache_hits'],
+                                                              markdown_calls),
+                                    'citations': _get_hit_rate(counters['citation_cache_hits'],
+                                                               citation_calls)}}
+
+
+def print_render_report(report):
+    print(f'render: {report["wall_time"]:.3f} s wall, {report["cpu_time"]:.3f} s cpu')
+    for stage, stats in report['stages'].items():
+        print(f'  {stage}: {stats["wall_time"]:.3f} s wall, '
+              f'{stats["cpu_time"]:.3f} s cpu, {stats["num_calls"]} calls')
+
+
+def _get_deep_size(obj, seen=None):
+    # only the containers are followed, the objects that they hold, like the
+    # book sections, are owned by someone else
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_get_deep_size(key, seen) + _get_deep_size(value, seen)
+                    for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(_get_deep_size(item, seen) for item in obj)
+    return size
+
+
+def _take_snapshot():
+    # the profiler itself is left out
+    return tracemalloc.take_snapshot().filter_traces(
+        (tracemalloc.Filter(False, __file__),
+         tracemalloc.Filter(False, tracemalloc.__file__),
+         tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+         tracemalloc.Filter(False, '<unknown>')))
+
+
+# tracemalloc is global to the process, only one profiler can use it at a time
+_profiler_lock = threading.Lock()
+
+
+class MemoryProfiler:
+    # a tracemalloc snapshot at every stage boundary, the difference between
+    # two of them are the allocations that the stage left behind. The peaks
+    # are the ones of the whole process, the allocations of other threads
+    # that run at the same time are counted too
+    def __init__(self, get_structures=None, num_top_allocations=10):
+        self.get_structures = get_structures
+        self.num_top_allocations = num_top_allocations
+        self.stages = {}
+        self._snapshot = None
+        self._started_tracing = False
+        self._start_memory = 0
+        self._peak_memory = 0
+        self._final_memory = None
+
+    def start(self):
+        if not _profiler_lock.acquire(blocking=False):
+            raise RuntimeError('Another memory profiler is running, only one can use tracemalloc')
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._start_memory = tracemalloc.get_traced_memory()[0]
+        self._peak_memory = self._start_memory
+        self._snapshot = _take_snapshot()
+
+    def stop(self):
+        if self._snapshot is None:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        self._peak_memory = max(self._peak_memory, peak)
+        self._final_memory = current
+        self._snapshot = None
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        _profiler_lock.release()
+
+    @contextmanager
+    def stage(self, name):
+        start_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            self._peak_memory = max(self._peak_memory, peak)
+            snapshot = _take_snapshot()
+            self.stages[name] = {'peak': peak - start_memory,
+                                 'retained': current - start_memory,
+                                 'top_allocations': self._get_top_allocations(snapshot),
+                                 'structures': self._get_structure_sizes()}
+            self._snapshot = snapshot
+
+    def _get_top_allocations(self, snapshot):
+        stats = [stat for stat in snapshot.compare_to(self._snapshot, 'lineno')
+                 if stat.size_diff > 0]
+        stats.sort(key=lambda stat: stat.size_diff, reverse=True)
+        return [{'site': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+                 'size_diff': stat.size_diff,
+                 'count_diff': stat.count_diff}
+                for stat in stats[:self.num_top_allocations]]
+
+    def _get_structure_sizes(self):
+        if self.get_structures is None:
+            return {}
+        return {name: _get_deep_size(structure)
+                for name, structure in self.get_structures().items()}
+
+    def get_report(self):
+        final_memory = self._final_memory
+        if final_memory is None:
+            final_memory = tracemalloc.get_traced_memory()[0]
+        return {'peak': self._peak_memory - self._start_memory,
+                'retained': final_memory - self._start_memory,
+                'stages': self.stages}
+
+
+def print_memory_report(report, num_top_allocations=3):
+    print(f'memory: {report["peak"] / MIB:.2f} MiB peak, '
+          f'{report["retained"] / MIB:.2f} MiB retained')
+    for stage, stats in report['stages'].items():
+        print(f'  {stage}: {stats["peak"] / MIB:.2f} MiB peak, '
+              f'{stats["retained"] / MIB:.2f} MiB retained')
+        for allocation in stats['top_allocations'][:num_top_allocations]:
+            print(f'      {allocation["size_diff"] / MIB:+.2f} MiB {allocation["site"]}')
+    if report['stages']:
+        last_stage = list(report['stages'].values())[-1]
+        for name, size in last_stage['structures'].items():
+            print(f'  {name}: {size / MIB:.2f} MiB')
@@ -0,0 +1,203 @@
+
+# A prebuilt inverted index for the html site, the terms are split in shards
+# so that a query only downloads the shards of its terms
+
+import re
+import json
+import html
+import unicodedata
+from collections import Counter
+from pathlib import Path
+
+SEARCH_DIR = Path('search')
+SEARCH_DOCS_FNAME = 'docs.json'
+SEARCH_SHARD_FNAME = 'shard_{shard}.json'
+SEARCH_JS_FNAME = 'search.js'
+SEARCH_HTML_FNAME = 'search.html'
+NUM_SHARDS = 16
+MIN_TERM_LENGTH = 2
+
+_ANCHOR_RE = re.compile('<span id="nav_span_([^"]+)">')
+_TAG_RE = re.compile('<[^>]*>')
+_WORD_RE = re.compile(r'\w+')
+
+SEARCH_JS = '''// Answers queries with the shards written by search_index.py
+var md2epubSearch = (function () {{
+  var NUM_SHARDS = {num_shards};
+  var MIN_TERM_LENGTH = {min_term_length};
+  var SHARD_FNAME = '{shard_fname}';
+  var docs = null;
+  var shards = {{}};
+
+  function getJSON(url) {{
+    return fetch(url).then(function (response) {{ return response.json(); }});
+  }}
+
+  function normalize(text) {{
+    return text.normalize('NFKD').replace(/\\p{{M}}/gu, '').toLowerCase();
+  }}
+
+  function shardFor(term) {{
+    var hash = 0;
+    for (var i = 0; i < term.length; i++) {{
+      hash = (Math.imul(hash, 31) + term.charCodeAt(i)) >>> 0;
+    }}
+    return hash % NUM_SHARDS;
+  }}
+
+  function getShard(shard) {{
+    if (!(shard in shards)) {{
+      shards[shard] = getJSON(SHARD_FNAME.replace('{{shard}}', shard));
+    }}
+    return shards[shard];
+  }}
+
+  function search(query) {{
+    var terms = (normalize(query).match(/[\\p{{L}}\\p{{N}}_]+/gu) || []).filter(function (term) {{
+      return term.length >= MIN_TERM_LENGTH;
+    }});
+    if (docs === null) {{
+      docs = getJSON('{docs_fname}');
+    }}
+    return Promise.all([docs].concat(terms.map(function (term) {{
+      return getShard(shardFor(term));
+    }}))).then(function (loaded) {{
+      var targets = loaded[0];
+      var scores = null;
+      terms.forEach(function (term, idx) {{
+        var postings = loaded[idx + 1][term] || [];
+        var termScores = {{}};
+        postings.forEach(function (posting) {{ termScores[posting[0]] = posting[1]; }});
+        if (scores === null) {{
+          scores = termScores;
+        }} else {{
+          Object.keys(scores).forEach(function (target) {{
+            if (target in termScores) {{
+              scores[target] += termScores[target];
+            }} else {{
+              delete scores[target];
+            }}
+          }});
+        }}
+      }});
+      return Object.keys(scores || {{}}).sort(function (a, b) {{
+        return scores[b] - scores[a];
+      }}).map(function (target) {{ return targets[target]; }});
+    }});
+  }}
+
+  return search;
+}})();
+'''
+
+SEARCH_HTML = '''<!DOCTYPE html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<script src="{js_fname}"></script>
+</head>
+<body>
+<form id="search_form">
+<input id="search_query" type="search" autofocus>
+</form>
+<ol id="search_results"></ol>
+<script>
+document.getElementById('search_form').addEventListener('submit', function (event) {{
+  event.preventDefault();
+  md2epubSearch(document.getElementById('search_query').value).then(function (results) {{
+    var ol = document.getElementById('search_results');
+    ol.innerHTML = '';
+    results.forEach(function (result) {{
+      var a = document.createElement('a');
+      a.href = result.url;
+      a.textContent = result.title;
+      var li = document.createElement('li');
+      li.appendChild(a);
+      ol.appendChild(li);
+    }});
+  }});
+}});
+</script>
+</body>
+</html>
+'''
+
+
+def normalize_text(text):
+    # the marks are removed like \p{M} does in search.js, so that the queries
+    # find the terms of the index
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(char for char in text
+                   if not unicodedata.category(char).startswith('M'))
+    return text.lower()
+
+
+def _iter_utf16_code_units(text):
+    for char in text:
+        code_point = ord(char)
+        if code_point > 0xffff:
+            code_point -= 0x10000
+            yield 0xd800 + (code_point >> 10)
+            yield 0xdc00 + (code_point & 0x3ff)
+        else:
+            yield code_point
+
+
+def get_term_shard(term, num_shards=NUM_SHARDS):
+    # the javascript computes the same hash, it iterates over utf-16 units
+    hash_ = 0
+    for code_unit in _iter_utf16_code_units(term):
+        hash_ = (hash_ * 31 + code_unit) & 0xffffffff
+    return hash_ % num_shards
+
+
+def count_terms(text):
+    text = html.unescape(_TAG_RE.sub(' ', text))
+    terms = _WORD_RE.findall(normalize_text(text))
+    return dict(Counter(term for term in terms if len(term) >= MIN_TERM_LENGTH))
+
+
+def extract_search_targets(html_text, titles):
+    # every nav span starts a target, the text before the first one is the
+    # html head
+    chunks = _ANCHOR_RE.split(html_text)
+    targets = []
+    for anchor, text in zip(chunks[1::2], chunks[2::2]):
+        terms = count_terms(text)
+        if not terms:
+            continue
+        targets.append({'anchor': f'nav_span_{anchor}',
+                        'title': titles.get(anchor, anchor),
+                        'terms': terms})
+    return targets
+
+
+def build_search_index_files(documents, num_shards=NUM_SHARDS):
+    # documents is a list of dicts with the url and the search targets of
+    # every document, in reading order
+    targets = []
+    shards = [{} for _ in range(num_shards)]
+    for document in documents:
+        for target in document['targets']:
+            target_idx = len(targets)
+            targets.append({'url': f'{document["url"]}#{target["anchor"]}',
+                            'title': target['title']})
+            for term, count in target['terms'].items():
+                shard = shards[get_term_shard(term, num_shards)]
+                shard.setdefault(term, []).append([target_idx, count])
+
+    files = {SEARCH_DOCS_FNAME: json.dumps(targets, ensure_ascii=False,
+                                           separators=(',', ':'))}
+    for shard_idx, shard in enumerate(shards):
+        fname = SEARCH_SHARD_FNAME.format(shard=shard_idx)
+        files[fname] = json.dumps(shard, ensure_ascii=False, sort_keys=True,
+                                  separators=(',', ':'))
+    files[SEARCH_JS_FNAME] = SEARCH_JS.format(num_shards=num_shards,
+                                              min_term_length=MIN_TERM_LENGTH,
+                                              shard_fname=SEARCH_SHARD_FNAME,
+                                              docs_fname=SEARCH_DOCS_FNAME)
+    return files
+
+
+def create_search_html(title):
+    return SEARCH_HTML.format(title=title, js_fname=SEARCH_JS_FNAME)
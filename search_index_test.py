@@ -0,0 +1,85 @@
+
+import unittest
+import json
+import shutil
+import subprocess
+
+from search_index import (extract_search_targets, build_search_index_files,
+                          get_term_shard, count_terms, normalize_text,
+                          SEARCH_DOCS_FNAME, SEARCH_SHARD_FNAME, SEARCH_JS_FNAME,
+                          NUM_SHARDS)
+
+CHAPTER_HTML = '''<!DOCTYPE html>
+<head>
+<title>Title words</title>
+</head>
+<body>
+<div id="chapter_1" class="chapter">
+<span id="nav_span_chapter_1">&#160;</span>
+<h1>Índice de la duda</h1>
+<p>La duda y <em>la</em> razón.</p>
+<span id="nav_span_chapter_1_1">&#160;</span>
+<h2>Razón</h2>
+</div>
+</body>
+</html>
+'''
+
+
+class SearchIndexTest(unittest.TestCase):
+    def test_count_terms(self):
+        assert count_terms('<p>La Duda &amp; la <b>razón</b>, y</p>') == {'la': 2, 'duda': 1, 'razon': 1}
+
+    def test_build_index(self):
+        titles = {'chapter_1': 'Chapter', 'chapter_1_1': 'Subchapter'}
+        targets = extract_search_targets(CHAPTER_HTML, titles)
+        assert [target['anchor'] for target in targets] == ['nav_span_chapter_1', 'nav_span_chapter_1_1']
+        assert targets[0]['terms'] == {'indice': 1, 'de': 1, 'la': 3, 'duda': 2, 'razon': 1}
+        assert 'words' not in targets[0]['terms']
+
+        files = build_search_index_files([{'url': '../section/chapter_1.html',
+                                           'targets': targets}])
+        assert len(files) == NUM_SHARDS + 2
+        docs = json.loads(files[SEARCH_DOCS_FNAME])
+        assert docs[1] == {'url': '../section/chapter_1.html#nav_span_chapter_1_1',
+                           'title': 'Subchapter'}
+        shard = json.loads(files[SEARCH_SHARD_FNAME.format(shard=get_term_shard('razon'))])
+        assert shard['razon'] == [[0, 1], [1, 1]]
+
+# runs search.js with the built files instead of the ones of a web server
+NODE_SEARCH_SCRIPT = '''
+var files = %s;
+global.fetch = function (url) {
+  return Promise.resolve({json: function () { return JSON.parse(files[url]); }});
+};
+eval(files['%s'] + ';global.md2epubSearch = md2epubSearch;');
+md2epubSearch(%s).then(function (results) { console.log(JSON.stringify(results)); });
+'''
+
+
+def _search_with_node(files, query):
+    script = NODE_SEARCH_SCRIPT % (json.dumps(files), SEARCH_JS_FNAME, json.dumps(query))
+    process = subprocess.run(['node', '-e', script], capture_output=True, check=True)
+    return json.loads(process.stdout)
+
+
+class SearchNormalizationTest(unittest.TestCase):
+    def test_normalize_marks(self):
+        # U+1DC0 is a combining mark outside the U+0300-U+036F block
+        assert normalize_text('Raz\u1dc0o\u0301n') == 'razon'
+        assert count_terms('<p>raz\u1dc0ón</p>') == {'razon': 1}
+
+    @unittest.skipUnless(shutil.which('node'), 'node is required to run search.js')
+    def test_search_js(self):
+        targets = extract_search_targets(CHAPTER_HTML, {'chapter_1': 'Chapter',
+                                                        'chapter_1_1': 'Subchapter'})
+        files = build_search_index_files([{'url': '../section/chapter_1.html',
+                                           'targets': targets}])
+        assert f"'{SEARCH_SHARD_FNAME}'" in files[SEARCH_JS_FNAME]
+        results = _search_with_node(files, 'Raz\u1dc0o\u0301n')
+        assert [result['title'] for result in results] == ['Chapter', 'Subchapter']
+        assert _search_with_node(files, 'ÍNDICE duda') == [results[0]]
+
+
+if __name__ == '__main__':
+    unittest.main()
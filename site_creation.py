@@ -2,16 +2,32 @@
 from pprint import pprint
 import re
 from collections import OrderedDict, defaultdict
-import zipfile
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, Future
 from pathlib import Path
 import datetime
 import subprocess
 import sys
 import os
+import json
+import time
+import threading
+import asyncio
 
 import mistune
 
-from references import process_citations
+from references import (process_citations, process_citations_async,
+                        CSL_PATHS, DEFAULT_CSL)
+from output_writers import (EpubZipWriter, DirectoryWriter, crc_content,
+                            hash_content, DEFAULT_COMPRESSLEVEL)
+from build_pipeline import run_pipeline
+from render_stats import (RenderStats, MemoryProfiler, print_render_report,
+                          print_memory_report)
+from anchors import (AnchorTable, INTERNAL_LINK_RE, scan_md_anchors,
+                     get_header_anchor_id)
+from epub_validation import validate_epub, report_validation_errors
+from search_index import (extract_search_targets, build_search_index_files,
+                          create_search_html, SEARCH_DIR, SEARCH_HTML_FNAME)
 from book_section import (BOOK, CHAPTER, PART, SUBCHAPTER,
                           _parse_header_line,
                           SpecialSection)
@@ -40,6 +56,7 @@ NBSP = '&#160;'
 BACK_ARROW = '&#8592;'
 
 BLOCKQUOTE_RE = re.compile('^<blockquote>[\n ]*<p>[^<>]*</p>[\n ]*</blockquote>$')
+QUOTE_MARK_RE = re.compile(r'^ *> ?', re.MULTILINE)
 
 XHTML_FILES_EXTENSION = 'xhtml'
 HTML_FILES_EXTENSION = 'html'
@@ -91,12 +108,28 @@ NCX_FNAME = 'toc.ncx'
 NCX_HEADER_XML = '''<?xml version='1.0' encoding='utf-8'?>
 <ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'''
 OPF_FNAME = 'content.opf'
+
+MANIFEST_FNAME = '.md2epub_manifest.json'
+STATS_FNAME = '.md2epub_stats.json'
+MANIFEST_VERSION = 6
+DEFAULT_PANDOC_PROCESSES = os.cpu_count() or 1
+CITATION_RESULT_KEYS = ['citation_keys', 'citations_found',
+                        'footnote_html_text', 'citation_text_is_note_number',
+                        'html_main_text']
 OPF_HEADER_XML = '''<?xml version='1.0' encoding='utf-8'?>
 <package unique-identifier="id" version="3.0" xmlns="http://www.idpf.org/2007/opf" prefix="rendition: http://www.idpf.org/vocab/rendition/#">
   <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
 '''
 
 
+def _get_bibliography_hash(bibliography_path, csl=DEFAULT_CSL):
+    # the citations of a section depend on these files, not only on its markdown
+    if bibliography_path is None:
+        return None
+    return hash_content(json.dumps([Path(bibliography_path).read_text(),
+                                    CSL_PATHS[csl].read_text()]))
+
+
 def _itemize_fragment(md_text):
 
     # This algorithm has one limitation, it does not allow to have trees
@@ -105,13 +138,12 @@ def _itemize_fragment(md_text):
     footnote_re = re.compile(r' *\[\^(?P<id>[^\]]+)\]')
     footnote_definition_re = re.compile(r'\[\^(?P<id>[^\]]*)\]:(?P<content>[^\n]+)')
     citation_re = re.compile(r' *\[@(?P<id>[^ \],]+),? *(?P<locator_term>[\w]*):? *(?P<locator_positions>[0-9]*)\]', re.UNICODE)
-    internal_link_re = re.compile(r'\[(?P<text>[^\]]+)\]\(#(?P<link_id>[^\)]+)\)')
 
     item_kinds = OrderedDict([('paragraph_limit', {'re': re.compile('\n{2,}')}),
                               ('footnote_definition', {'re': footnote_definition_re}),
                               ('footnote', {'re': footnote_re}),
                               ('citation', {'re': citation_re}),
-                              ('internal_link', {'re': internal_link_re}),
+                              ('internal_link', {'re': INTERNAL_LINK_RE}),
                               ])
     re_idx = {item_kind: idx for idx, item_kind in enumerate(item_kinds.keys())}
 
@@ -175,10 +207,7 @@ def _itemize_fragment(md_text):
 
 
 def _join_fragment_lines(fragment_lines):
-    fragment = ''.join(fragment_lines).strip()
-
-    fragment = re.sub('\n>', '\n\n>', fragment)
-    return fragment
+    return ''.join(fragment_lines).strip()
 
 
 def _itemize_md_text(md_text):
@@ -186,6 +215,10 @@ def _itemize_md_text(md_text):
     fragment_lines = []
     for line in md_text:
 
+        if line.startswith('>') and fragment_lines:
+            # every blockquote line starts its own paragraph
+            fragment_lines.append('\n')
+
         if line.startswith('#'):
             if fragment_lines:
                 for item in _itemize_fragment(_join_fragment_lines(fragment_lines)):
@@ -205,47 +238,261 @@ def _itemize_md_text(md_text):
             yield item
 
 
-def _add_p_tags(html_text):
-    html_text = html_text.strip()
+class _BlockMarkdown(mistune.Markdown):
+    def render_blocks(self, md_text):
+        # paragraphs are returned as inline html, the caller decides where
+        # the <p> tags go, any other block is returned already rendered
+        self.tokens = self.block(mistune.preprocessing(md_text))
+        self.tokens.reverse()
+        self.inline.setup(self.block.def_links, self.block.def_footnotes)
 
-    if html_text.startswith('<ul>') and html_text.endswith('</ul>'):
-        return html_text
-    if html_text.startswith('<ol>') and html_text.endswith('</ol>'):
-        return html_text
+        blocks = []
+        while self.pop():
+            if self.token['type'] == 'paragraph':
+                kind = 'inline'
+                html_text = self.inline(self.token['text'])
+            else:
+                kind = 'block'
+                html_text = self.tok()
+            html_text = html_text.strip()
+            if html_text:
+                blocks.append({'kind': kind, 'html': html_text})
+        return blocks
+
+
+def _close_paragraph(paragraph, htmls, quoted=False):
+    html_text = ''.join(paragraph).strip()
+    if html_text and quoted:
+        htmls.append(f'<blockquote><p>{html_text}</p>\n</blockquote>')
+    elif html_text:
+        htmls.append(f'<p>{html_text}</p>\n')
+    paragraph.clear()
+
+
+def _remove_quote_marks(md_text):
+    return QUOTE_MARK_RE.sub('', md_text)
+
+
+def _create_markdown_renderer():
+    renderer = mistune.Renderer(use_xhtml=True)
+    return _BlockMarkdown(renderer)
+
+
+class _CachedMarkdown:
+    # the rendered blocks do not depend on the site kind, so they can be
+    # shared by the renderers of every kind
+    def __init__(self):
+        self._render_markdown = _create_markdown_renderer()
+        self._blocks = {}
+        self._used_blocks = set()
+        self._lock = threading.Lock()
+        self.num_calls = 0
+        self.num_hits = 0
+        self.render_time = 0.0
+        self.render_cpu_time = 0.0
+
+    def render_blocks(self, md_text):
+        # the mistune parser keeps its state in the instance, only one
+        # thread can use it at a time
+        with self._lock:
+            self.num_calls += 1
+            self._used_blocks.add(md_text)
+            try:
+                blocks = self._blocks[md_text]
+            except KeyError:
+                pass
+            else:
+                self.num_hits += 1
+                return blocks
+            start = time.perf_counter()
+            cpu_start = time.thread_time()
+            blocks = self._render_markdown.render_blocks(md_text)
+            self.render_time += time.perf_counter() - start
+            self.render_cpu_time += time.thread_time() - cpu_start
+            self._blocks[md_text] = blocks
+            return blocks
+
+    def drop_unused(self):
+        with self._lock:
+            self._blocks = {md_text: self._blocks[md_text] for md_text in self._used_blocks
+                            if md_text in self._blocks}
+            self._used_blocks = set()
+
+
+class RenderCache:
+    def __init__(self):
+        self.render_markdown = _CachedMarkdown()
+        self.citations = {}
+        self.citations_used = set()
+        self.citations_lock = threading.Lock()
+
+    def clear_citations(self):
+        with self.citations_lock:
+            self.citations.clear()
+
+    def drop_unused(self):
+        # a long lived cache, like the one of the watcher, only keeps what
+        # was used since the last call
+        self.render_markdown.drop_unused()
+        with self.citations_lock:
+            self.citations = {key: self.citations[key] for key in self.citations_used
+                              if key in self.citations}
+            self.citations_used = set()
+
+
+def _process_basic_markdown(render_markdown, md_text):
+    blocks = render_markdown.render_blocks(md_text)
+
+    for block in blocks:
+        assert '&lt;' not in block['html']
+        assert '<h' not in block['html']
+    return blocks
+
+
+def _build_anchor(url, text, site_kind, id_=None, anchor_id=None,
+                  is_note_to_ref=False):
+    if id_:
+        url = f'{url}#{id_}'
+
+    if anchor_id:
+        anchor_id_str = f'id="{anchor_id}"'
+    else:
+        anchor_id_str = ''
+
+    if site_kind == EPUB3 and is_note_to_ref:
+        anchor = f'<a {anchor_id_str} epub:type="noteref" href="{url}">{text}</a>'
+    else:
+        anchor = f'<a {anchor_id_str} href="{url}">{text}</a>'
+    return anchor
+
+
+def _count_notes_in_items(items):
+    return sum(1 for item in items if item['kind'] == 'citation' and
+               item['citations_found'] and item.get('footnote_html_text'))
+
+
+def _render_items_html(items, render_markdown, site_kind, links,
+                       first_note_number=1):
+    note_lis = []
+    htmls = []
+    paragraph = []
+    # a quoted paragraph is kept open, so the citations and links that
+    # follow the quote line stay inside the blockquote
+    quoted = False
+
+    def close_paragraph():
+        nonlocal quoted
+        _close_paragraph(paragraph, htmls, quoted)
+        quoted = False
+
+    for item in items:
+        #print('item')
+        #pprint(item)
+        if item['kind'] == 'header':
+            close_paragraph()
+            res = _parse_header_line(item['md_orig_main_text'])
+            if item.get('anchor_id'):
+                id_str = f' id="{item["anchor_id"]}"'
+            else:
+                id_str = ''
+            html_item_text = f'<h{res["level"]}{id_str}>{res["text"]}</h{res["level"]}>\n'
+            htmls.append(html_item_text)
+        elif item['kind'] == 'std_md':
+            md_text = item['md_orig_main_text']
+            if not paragraph and md_text.lstrip().startswith('>'):
+                blocks = _process_basic_markdown(render_markdown,
+                                                 _remove_quote_marks(md_text))
+                if len(blocks) == 1 and blocks[0]['kind'] == 'inline':
+                    quoted = True
+                    paragraph.append(blocks[0]['html'])
+                    if md_text[-1:].isspace():
+                        paragraph.append(' ')
+                    continue
+            blocks = _process_basic_markdown(render_markdown, md_text)
+            for idx, block in enumerate(blocks):
+                if block['kind'] == 'inline':
+                    # the markdown renderer strips the spaces that separate
+                    # this text from the items around it
+                    if idx == 0 and paragraph and md_text[:1].isspace():
+                        paragraph.append(' ')
+                    paragraph.append(block['html'])
+                    if idx == len(blocks) - 1 and md_text[-1:].isspace():
+                        paragraph.append(' ')
+                else:
+                    close_paragraph()
+                    htmls.append(block['html'])
+        elif item['kind'] == 'citation':
+            note_number = first_note_number + len(note_lis)
+            note_id_in_text = f'citation_{note_number}'
+            if item['citations_found']:
+                if item.get('footnote_html_text'):
+                    endnote_id = f'{links["endnotes_section_id"]}_{note_number}'
+                    epub_type = 'epub:type="endnote" ' if site_kind == EPUB3 else ''
+                    endnote_li = f'<span {epub_type}id="{endnote_id}">{item["footnote_html_text"]}</span>'
+                    endnote_li += _build_anchor(links['section_url'],
+                                                text=BACK_ARROW,
+                                                site_kind=site_kind,
+                                                id_=note_id_in_text)
+                    note_lis.append(endnote_li)
+                else:
+                    endnote_id = None
+
+                if item['citation_text_is_note_number']:
+                    html_item_text = f'<sup>{first_note_number + len(note_lis)}</sup>'
+                else:
+                    html_item_text = item['html_main_text']
+
+                #html_item_text += f'<span id="{note_id_in_text}"></span>'
+
+                if endnote_id:
+                    html_item_text = _build_anchor(links['endnote_urls'][len(note_lis) - 1],
+                                                   text=html_item_text,
+                                                   site_kind=site_kind,
+                                                   id_=endnote_id,
+                                                   is_note_to_ref=True,
+                                                   anchor_id=note_id_in_text)
+            else:
+                html_item_text = item['md_orig_main_text']
+            paragraph.append(html_item_text)
+        elif item['kind'] == 'internal_link':
+            paragraph.append(_build_anchor(links['internal_urls'][item['link_id']],
+                                           text=item['text'],
+                                           site_kind=site_kind))
+        elif item['kind'] == 'paragraph_limit':
+            close_paragraph()
+        elif item['kind'] == 'html':
+            close_paragraph()
+            htmls.append(item['html'])
+        else:
+            raise NotImplementedError()
+    close_paragraph()
+    #pprint(htmls)
+    return {'html': '\n'.join(htmls), 'note_lis': note_lis}
 
-    first_close_p_position = None
-    try:
-        first_open_p_position = html_text.index('<p>')
-    except ValueError:
-        first_open_p_position = None
-    try:
-        first_close_p_position = html_text.index('</p>')
-    except ValueError:
-        first_close_p_position = None
 
-    #print(first_open_p_position, first_close_p_position)
-    #print(html_text)
+_WORKER_RENDER_MARKDOWN = None
 
-    if first_close_p_position is None and first_open_p_position is None:
-        return f'<p>{html_text}</p>\n'
 
-    if first_close_p_position and (first_open_p_position is None or first_open_p_position > first_close_p_position):
-        html_text = f'<p>{html_text}'
+def _render_items_html_in_worker(task):
+    global _WORKER_RENDER_MARKDOWN
+    if _WORKER_RENDER_MARKDOWN is None:
+        _WORKER_RENDER_MARKDOWN = _create_markdown_renderer()
+    return _render_items_html(render_markdown=_WORKER_RENDER_MARKDOWN, **task)
 
-    last_p_open_position = html_text.rfind('<p>')
-    if last_p_open_position < 0:
-        last_p_open_position = None
-    last_p_close_position = html_text.rfind('</p>')
-    if last_p_close_position < 0:
-        last_p_close_position = None
-    if last_p_close_position and (last_p_close_position is None or last_p_close_position < last_p_open_position):
-        html_text = f'{html_text}</p>\n'
 
-    return html_text
+def _get_picklable_item(item):
+    # the regex match is only needed while itemizing
+    return {key: value for key, value in item.items() if key != 'match'}
 
 
 class SiteRenderer:
-    def __init__(self, md_book, site_kind, zip_path=None, out_dir=None):
+    def __init__(self, md_book, site_kind, zip_path=None, out_dir=None,
+                 compresslevel=DEFAULT_COMPRESSLEVEL, compress_jobs=None,
+                 jobs=None, pipeline=False, incremental=False,
+                 render_cache=None, max_chapter_size=None,
+                 endnotes_per_chapter=False, max_endnotes_per_file=None,
+                 search_index=None, precompress=False, validate=None,
+                 write_stats=False, profile_memory=False):
         self.book = md_book
 
         if not(zip_path is not None or out_dir is not None):
@@ -255,59 +502,260 @@ class SiteRenderer:
             zip_path = zip_path.resolve()
         self.out_zip_path = zip_path
         self._out_zip = None
+        self.compresslevel = compresslevel
+        self.compress_jobs = compress_jobs
         if out_dir:
             out_dir = out_dir.resolve()
         self.out_dir = out_dir
+        self._out_dir_writer = None
 
         if site_kind not in SUPPORTED_SITE_KINDS:
             msg = f'site_kind not supported'
             raise NotImplementedError(msg)
         self.site_kind = site_kind
-        self._sections_info = defaultdict(dict)
-
-        renderer = mistune.Renderer(use_xhtml=True)
-        self._render_markdown = mistune.Markdown(renderer)
+        if pipeline and jobs and jobs > 1:
+            msg = 'A pipelined build renders the sections in order, it can not use jobs'
+            raise ValueError(msg)
+        if incremental and (pipeline or (jobs and jobs > 1)):
+            msg = 'An incremental build can not be pipelined or use jobs'
+            raise ValueError(msg)
+        if max_chapter_size is not None and max_chapter_size < 0:
+            raise ValueError('max_chapter_size should be a positive number of bytes')
+        self.max_chapter_size = max_chapter_size
+        if search_index is None:
+            search_index = site_kind == HTML
+        if search_index and site_kind != HTML:
+            raise ValueError('The search index is only created for html sites')
+        self.search_index = search_index
+        if precompress and site_kind != HTML:
+            raise ValueError('Only the files of html sites are precompressed')
+        self.precompress = precompress
+        if validate is None:
+            validate = site_kind == EPUB3
+        if validate and site_kind != EPUB3:
+            raise ValueError('Only epubs can be validated')
+        self.validate = validate
+        self.write_stats = write_stats
+        self.profile_memory = profile_memory
+        if max_endnotes_per_file is not None and max_endnotes_per_file < 1:
+            raise ValueError('max_endnotes_per_file should be at least 1')
+        self.endnotes_per_chapter = endnotes_per_chapter
+        self.max_endnotes_per_file = max_endnotes_per_file
+        self.jobs = jobs
+        self.pipeline = pipeline
+        self.incremental = incremental
+
+        # the render cache is the only state that can be shared with the
+        # renderers running in other threads, it is locked
+        if render_cache is None:
+            render_cache = RenderCache()
+        self._render_cache = render_cache
+        self._render_markdown = render_cache.render_markdown
         self.citation_notes_should_be_endnotes = True
+        self._render_lock = threading.Lock()
+        self._event_loop = None
+        self._pandoc_semaphore = None
+        self._reset_render_state()
+
+    def _reset_render_state(self):
+        # everything that a render accumulates, a new render starts again
+        self.zip_stats = None
+        self.dir_report = None
+        self.validation_errors = None
+        self.stats = RenderStats()
+        self.render_report = None
+        self.memory_profiler = None
+        self._search_targets = {}
+        self._section_titles = {}
+        self._endnote_file_starts = set()
+        self._documents = None
+        self._document_sections = {}
+        self._document_md_pieces = {}
+        self._document_link_ids = {}
+        self._anchors = None
+        self.pipeline_stats = None
+        self.sections_rendered = None
+        self._manifest = None
+        self._bibliography_hash = None
+        self._file_hashes = {}
+        self._file_crcs = {}
+        self._sections_info = defaultdict(dict)
+        self._sections_and_items = []
+        self.citation_keys_not_found = set()
         self.note_lis = defaultdict(list)
         self.section_main_html = {}
         self._special_sections = {}
         self._references = {}
         self._sections_added = []
+        self._backmater_sections = []
+        self._pending_citations = {}
 
     def __enter__(self):
         return self
 
     def __exit__(self, *exc_details):
         self._close_out_files()
+        if self.memory_profiler is not None:
+            self.memory_profiler.stop()
+
+    def _memory_stage(self, name):
+        if self.memory_profiler is None:
+            return nullcontext()
+        return self.memory_profiler.stage(name)
+
+    def _get_profiled_structures(self):
+        # the structures that grow with the book and stay alive for the render
+        return {'sections_and_items': self._sections_and_items,
+                'note_lis': self.note_lis,
+                'references': self._references,
+                'section_main_html': self.section_main_html,
+                'document_md_pieces': self._document_md_pieces,
+                'search_targets': self._search_targets}
 
     def _open_out_files(self):
         if self.out_zip_path:
-            self._out_zip = zipfile.ZipFile(self.out_zip_path, 'w')
+            base_path = self.out_zip_path if self.incremental else None
+            self._out_zip = EpubZipWriter(self.out_zip_path,
+                                          compresslevel=self.compresslevel,
+                                          compress_jobs=self.compress_jobs,
+                                          base_path=base_path)
+            self._out_zip.open()
         if self.out_dir:
-            self.out_dir.mkdir()
+            self._out_dir_writer = DirectoryWriter(self.out_dir,
+                                                   exist_ok=self.incremental,
+                                                   precompress=self.precompress,
+                                                   compress_jobs=self.compress_jobs)
+            self._out_dir_writer.open()
 
     def _close_out_files(self):
         if self._out_zip:
-            self._out_zip.close()
+            stats = self._out_zip.close()
+            self._out_zip = None
+            self.zip_stats = stats
+            print(f'{self.out_zip_path}: {stats["num_entries"]} files, '
+                  f'{stats["uncompressed_size"]} bytes compressed to '
+                  f'{stats["zip_size"]} bytes in {stats["write_time"]:.3f} s')
+            if stats['num_copied_from_base']:
+                print(f'{stats["num_copied_from_base"]} files copied from the previous epub')
+        if self._out_dir_writer:
+            report = self._out_dir_writer.close()
+            self._out_dir_writer = None
+            self.dir_report = report
+            print(f'{self.out_dir}: {len(report["changed"])} files written, '
+                  f'{len(report["unchanged"])} unchanged in '
+                  f'{report["write_time"]:.3f} s')
+            if report['precompressed']:
+                print(f'{len(report["precompressed"])} files precompressed')
+
+    @staticmethod
+    def _get_md_size(section):
+        return sum(path.stat().st_size for path in section.md_files)
+
+    def _plan_documents(self):
+        # Every document is written to its own file. A chapter includes its
+        # subchapters unless it is bigger than max_chapter_size, then it is
+        # split at the subchapters
+        documents = []
+        for section in self.book.parts_and_chapters:
+            document = {'section': section, 'merged_subsections': []}
+            documents.append(document)
+            self._document_sections[section.id] = section
+            self._section_titles[section.id] = section.title
+            if section.kind != CHAPTER:
+                continue
+
+            size = self._get_md_size(section)
+            for subchapter in section.subsections:
+                subchapter_size = self._get_md_size(subchapter)
+                if (self.max_chapter_size is not None and
+                    size + subchapter_size > self.max_chapter_size):
+                    document = {'section': subchapter, 'merged_subsections': []}
+                    documents.append(document)
+                    size = 0
+                else:
+                    document['merged_subsections'].append(subchapter)
+                self._document_sections[subchapter.id] = document['section']
+                self._section_titles[subchapter.id] = subchapter.title
+                size += subchapter_size
+        self._documents = documents
+
+    def _read_document_md(self, document):
+        # the markdown read to build the anchor table is used only once
+        with self.stats.stage('read', document['section'].id):
+            md_pieces = self._document_md_pieces.pop(document['section'].id, None)
+            if md_pieces is not None:
+                return md_pieces
+            sections = [document['section']] + document['merged_subsections']
+            return [{'section': section,
+                     'md_lines': list(section.iter_md_text(keep_header_ids=True))}
+                    for section in sections]
+
+    def _build_anchor_table(self):
+        # every section and header id is mapped to its url before any
+        # section is rendered, so links can point forward
+        with self.stats.stage('scan'):
+            anchors = AnchorTable()
+            for document in self._documents:
+                file_section = document['section']
+                md_pieces = self._read_document_md(document)
+                self._document_md_pieces[file_section.id] = md_pieces
+                link_ids = []
+                for piece in md_pieces:
+                    section_id = piece['section'].id
+                    anchors.add_anchor(section_id,
+                                       self.get_url_to_section(file_section,
+                                                               id_=f'nav_span_{section_id}'))
+                    res = scan_md_anchors(piece['md_lines'], section_id)
+                    for header_id in res['header_ids']:
+                        anchors.add_anchor(header_id,
+                                           self.get_url_to_section(file_section,
+                                                                   id_=header_id))
+                    for link_id in res['link_ids']:
+                        anchors.add_link(section_id, link_id)
+                    link_ids.extend(res['link_ids'])
+                self._document_link_ids[file_section.id] = sorted(set(link_ids))
+            anchors.check_links()
+            self._anchors = anchors
+
+    def _tokenize_document(self, document, md_pieces=None):
+        with self.stats.stage('tokenize', document['section'].id):
+            if md_pieces is None:
+                md_pieces = self._read_document_md(document)
+            items = []
+            for idx, piece in enumerate(md_pieces):
+                if idx:
+                    span = f'<span id="nav_span_{piece["section"].id}">{NBSP}</span>\n'
+                    items.append({'kind': 'html', 'html': span})
+                for item in _itemize_md_text(piece['md_lines']):
+                    if item['kind'] == 'header':
+                        item['anchor_id'] = get_header_anchor_id(item['md_orig_main_text'],
+                                                                 piece['section'].id)
+                    elif item['kind'] == 'internal_link':
+                        item['link_id'] = item['match'].group('link_id')
+                        item['text'] = item['match'].group('text')
+                    items.append(item)
+            return {'section': document['section'], 'items': items}
 
     def _get_sections_and_items(self):
         sections_and_items = []
-        for section in self.book.parts_and_chapters:
-            section_and_items = {'section': section,
-                                 'items': list(_itemize_md_text(section.md_text))}
-            sections_and_items.append(section_and_items)
+        for document in self._documents:
+            sections_and_items.append(self._tokenize_document(document))
         return sections_and_items
 
     def _process_citations(self):
-        citation_keys_not_found = self.citation_keys_not_found
-
         for section_and_items in self._sections_and_items:
+            self._process_citations_in_section(section_and_items)
+
+    def _process_citations_in_section(self, section_and_items):
+        with self.stats.stage('citations', section_and_items['section'].id):
+            citation_keys_not_found = set()
+            references = {}
+
             citations = [item for item in section_and_items['items'] if item['kind'] == 'citation']
 
             if citations:
                 citation_texts = [citation['md_orig_main_text'] for citation in citations]
-                processed_citations = process_citations(citation_texts,
-                                                        libray_csl_json_path=self.book.bibliography_path)
+                processed_citations = self._run_process_citations(citation_texts)
 
                 assert len(citations) == len(processed_citations['citation_items'])
 
@@ -330,26 +778,91 @@ class SiteRenderer:
                     else:
                         citation['citations_found'] = False
                         citation_keys_not_found.update(processed_citation['citation_keys'])
-                self._references.update(dict(processed_citations['references']))
-
-    @staticmethod
-    def _make_dir_tree(path):
-        dirs_to_check = list(reversed(path.parents)) + [path]
-        for dir_ in dirs_to_check:
-            if not dir_.exists():
-                dir_.mkdir()
-        
-    def create_file(self, path, content):
-
-        if self.out_zip_path:
-            self._out_zip.writestr(str(path), content)
-        if self.out_dir:
-            full_path = self.out_dir / path
-            self._make_dir_tree(full_path.parent)
-
-            fhand = full_path.open('wt')
-            fhand.write(content)
-            fhand.close()
+                references = dict(processed_citations['references'])
+
+            section_and_items['references'] = references
+            section_and_items['citation_keys_not_found'] = citation_keys_not_found
+            self._references.update(references)
+            self.citation_keys_not_found.update(citation_keys_not_found)
+            return section_and_items
+
+    def _run_process_citations(self, citation_texts):
+        bibliography_path = self.book.bibliography_path
+        key = (str(bibliography_path), tuple(citation_texts))
+        render_cache = self._render_cache
+        with render_cache.citations_lock:
+            render_cache.citations_used.add(key)
+            processed_citations = render_cache.citations.get(key)
+        if processed_citations is not None:
+            # another renderer got it first, our pandoc is not needed
+            future = self._pending_citations.pop(key, None)
+            if future is not None:
+                future.cancel()
+            self.stats.count('citation_cache_hits')
+            return processed_citations
+
+        # pandoc runs without the lock, so other renderers are not kept waiting
+        self.stats.count('pandoc_calls')
+        with self.stats.stage('pandoc'):
+            future = self._pending_citations.pop(key, None)
+            if future is None:
+                future = self._submit_process_citations(citation_texts)
+            processed_citations = future.result()
+        with render_cache.citations_lock:
+            return render_cache.citations.setdefault(key, processed_citations)
+
+    def _submit_process_citations(self, citation_texts):
+        bibliography_path = self.book.bibliography_path
+        if self._event_loop is None:
+            future = Future()
+            future.set_result(process_citations(citation_texts,
+                                                libray_csl_json_path=bibliography_path))
+            return future
+        coroutine = process_citations_async(citation_texts,
+                                            libray_csl_json_path=bibliography_path,
+                                            semaphore=self._pandoc_semaphore)
+        return asyncio.run_coroutine_threadsafe(coroutine, self._event_loop)
+
+    def _prefetch_citations(self):
+        # with an event loop the pandocs of every section are started at once,
+        # the sections pick up their results when they get to them
+        if self._event_loop is None:
+            return
+        bibliography_path = self.book.bibliography_path
+        render_cache = self._render_cache
+        for section_and_items in self._sections_and_items:
+            citation_texts = [item['md_orig_main_text'] for item in section_and_items['items']
+                              if item['kind'] == 'citation']
+            if not citation_texts:
+                continue
+            key = (str(bibliography_path), tuple(citation_texts))
+            with render_cache.citations_lock:
+                if key in render_cache.citations:
+                    continue
+            if key not in self._pending_citations:
+                self._pending_citations[key] = self._submit_process_citations(citation_texts)
+
+    def create_file(self, path, content, section_id=None):
+        with self.stats.stage('write', section_id):
+            content_hash = None
+            if self.incremental:
+                content_hash = hash_content(content)
+                self._file_hashes[str(path)] = content_hash
+            if self.out_zip_path:
+                if self.incremental:
+                    self._file_crcs[str(path)] = crc_content(content)
+                self._out_zip.write(path, content)
+            if self.out_dir:
+                self._out_dir_writer.write(path, content, content_hash=content_hash)
+
+    def _previous_file_is_unchanged(self, path, content_hash):
+        if self._manifest['files'].get(str(path)) != content_hash:
+            return False
+        if self.out_dir is None:
+            # the previous epub is the only copy that we have
+            crc = self._out_zip.get_base_member_crc(path)
+            return crc is not None and crc == self._manifest['zip_crcs'].get(str(path))
+        return self._out_dir_writer.file_is_unchanged(path, content_hash)
 
     def _create_mimetype_file(self):
         self.create_file('mimetype', 'application/epub+zip')
@@ -383,6 +896,10 @@ class SiteRenderer:
             fname =  f'chapter_{section.idx}.{extension}'
         elif section.kind == PART:
             fname = f'part_{section.idx}.{extension}'
+        elif section.kind == SUBCHAPTER and self._document_sections.get(section.id) is section:
+            chapter = section.parent
+            subchapter_number = chapter.subsections.index(section) + 1
+            fname = f'chapter_{chapter.idx}_{subchapter_number}.{extension}'
         else:
             raise ValueError(f'No fpath defined for this kind of section: {section.kind}')
         return fname
@@ -409,18 +926,10 @@ class SiteRenderer:
                                 is_note_to_ref=False):
         if not text:
             text = section.title
-        url = self.get_url_to_section(section, id_=id_)
-
-        if anchor_id:
-            anchor_id_str = f'id="{anchor_id}"'
-        else:
-            anchor_id_str = ''
-
-        if self.site_kind == EPUB3 and is_note_to_ref:
-            anchor = f'<a {anchor_id_str} epub:type="noteref" href="{url}">{text}</a>'
-        else:
-            anchor = f'<a {anchor_id_str} href="{url}">{text}</a>'
-        return anchor
+        url = self.get_url_to_section(section)
+        return _build_anchor(url, text, site_kind=self.site_kind, id_=id_,
+                             anchor_id=anchor_id,
+                             is_note_to_ref=is_note_to_ref)
 
     def _get_special_section(self, section_id):
         if section_id in self._special_sections:
@@ -449,131 +958,128 @@ class SiteRenderer:
         self._special_sections[section_id] = section
         return section
 
-    def _process_basic_markdown(self, md_text):
-        html_text = self._render_markdown(md_text)
-        html_text = html_text.strip()
+    def _endnotes_are_split(self):
+        return self.endnotes_per_chapter or self.max_endnotes_per_file is not None
 
-        if html_text.startswith('<p>'):
-            html_text = html_text[3:]
-        if html_text.endswith('</p>'):
-            html_text = html_text[:-4]
-
-        assert '&lt;' not in html_text
-        #print('html_text', html_text)
-        assert '<h' not in html_text
-        return html_text
-    
-    def _create_html_from_items(self, items, section=None):
-
-        if self.citation_notes_should_be_endnotes:
-            section_to_add_citation_notes = self._get_special_section(ENDNOTE_CHAPTER_ID)
-            note_lis = self.note_lis[section_to_add_citation_notes.id]
+    def _get_endnote_file_start(self, first_note_number, note_number):
+        # the endnote files are named after their first note, so the file of
+        # a note only depends on where the notes of its section start
+        if self.endnotes_per_chapter:
+            start = first_note_number
         else:
-            raise NotImplementedError('Implement notes at the end of chapter')
-
-        citations_not_found = set()
-        htmls = []
-        paragraph = ''
-        for item in items:
-            #print('item')
-            #pprint(item)
-            if item['kind'] == 'header':
-                paragraph = paragraph.strip()
-                if paragraph:
-                    htmls.append(_add_p_tags(paragraph))
-                    paragraph = ''
-                res = _parse_header_line(item['md_orig_main_text'])
-                html_item_text = f'<h{res["level"]}>{res["text"]}</h{res["level"]}>\n'
-                htmls.append(html_item_text)
-            elif item['kind'] == 'std_md':
-                paragraph += self._process_basic_markdown(item['md_orig_main_text'])
-            elif item['kind'] == 'citation':
-                note_id_in_text = f'citation_{len(note_lis) + 1}'
-                if item['citations_found']:
-                    if item.get('footnote_html_text'):
-                        endnote_id = f'{section_to_add_citation_notes.id}_{len(note_lis) + 1}'
-                        epub_type = 'epub:type="endnote" ' if self.site_kind == EPUB3 else ''
-                        endnote_li = f'<span {epub_type}id="{endnote_id}">{item["footnote_html_text"]}</span>'
-                        endnote_li += self.build_anchor_to_section(section, text=BACK_ARROW, id_=note_id_in_text)
-                        note_lis.append(endnote_li)
-                    else:
-                        endnote_id = None
-
-                    if item['citation_text_is_note_number']:
-                        if self.citation_notes_should_be_endnotes:
-                            html_item_text = f'<sup>{len(note_lis) + 1}</sup>'
-                        else:
-                            raise NotImplementedError('Implement notes at the end of chapter')
-                    else:
-                        html_item_text = item['html_main_text']
-
-                    #html_item_text += f'<span id="{note_id_in_text}"></span>'
+            start = 1
+        if self.max_endnotes_per_file is not None:
+            start += (note_number - start) // self.max_endnotes_per_file * self.max_endnotes_per_file
+        return start
 
-                    if endnote_id:
-                        html_item_text = self.build_anchor_to_section(section=section_to_add_citation_notes,
-                                                                      text=html_item_text,
-                                                                      id_=endnote_id,
-                                                                      is_note_to_ref=True,
-                                                                      anchor_id=note_id_in_text)
-                else:
-                    html_item_text = item['md_orig_main_text']
-                    citations_not_found.update(item['citation_keys'])
-                paragraph += html_item_text
-            elif item['kind'] == 'paragraph_limit':
-                paragraph = paragraph.strip()
-                if paragraph:
-                    #print('paragraph:', paragraph)
-                    htmls.append(_add_p_tags(paragraph))
-                    paragraph = ''
-            elif item['kind'] == 'html':
-                htmls.append(item['html'])
-            else:
-                raise NotImplementedError()
-        paragraph = paragraph.strip()
-        if paragraph:
-            #print('paragraph:', paragraph)
-            htmls.append(_add_p_tags(paragraph))
-        #pprint(htmls)
-        return '\n'.join(htmls)
-
-    def _create_section(self, section, items):
-        if section.id == TOC_CHAPTER_ID:
-            self._sections_added.insert(0, section)
-        else:
-            self._sections_added.append(section)
+    def _get_endnotes_section(self, file_start=None):
+        if file_start is None:
+            return self._get_special_section(ENDNOTE_CHAPTER_ID)
 
-        title = section.title
-        main_html = self._create_html_from_items(items, section)
+        section_id = f'{ENDNOTE_CHAPTER_ID}_from_{file_start}'
+        if section_id in self._special_sections:
+            return self._special_sections[section_id]
+        section = SpecialSection(kind=CHAPTER,
+                                 title=ENDNOTE_CHAPTER_TITLE[self.book.lang],
+                                 id=section_id,
+                                 parent=self.book)
+        fname = f'{ENDNOTE_CHAPTER_BASE_NAME}_{file_start}.{self._get_files_extension()}'
+        self._sections_info[section_id]['path_within_site'] = self._get_base_path() / fname
+        self._special_sections[section_id] = section
+        return section
 
-        if self.site_kind == EPUB3:
-            head_html_template = EPUB_CHAPTER_HEADER_HTML
-            start_section_template = EPUB_START_CHAPTER_SECTION
-            end_section = EPUB_END_CHAPTER_SECTION
-        elif self.site_kind == HTML:
-            head_html_template = HTML_CHAPTER_HEADER_HTML
-            start_section_template = HTML_START_CHAPTER_SECTION
-            end_section = HTML_END_CHAPTER_SECTION
+    def _get_endnote_urls(self, first_note_number, num_notes):
+        if not self._endnotes_are_split():
+            url = self.get_url_to_section(self._get_endnotes_section())
+            return [url] * num_notes
+
+        urls = []
+        for note_number in range(first_note_number, first_note_number + num_notes):
+            file_start = self._get_endnote_file_start(first_note_number, note_number)
+            self._endnote_file_starts.add(file_start)
+            urls.append(self.get_url_to_section(self._get_endnotes_section(file_start)))
+        return urls
+
+    def _get_links_for_items(self, section, first_note_number=1, num_notes=0):
+        links = {'endnotes_section_id': ENDNOTE_CHAPTER_ID,
+                 'endnote_urls': self._get_endnote_urls(first_note_number, num_notes),
+                 'section_url': None,
+                 'internal_urls': {}}
+        if section is not None:
+            links['section_url'] = self.get_url_to_section(section)
+            links['internal_urls'] = {link_id: self._anchors.get_url(link_id)
+                                      for link_id in self._document_link_ids.get(section.id, [])}
+        return links
 
-        if section.kind == PART:
-            section_kind = 'part'
-        elif section.kind == CHAPTER:
-            section_kind = 'chapter'
+    def _create_html_from_items(self, items, section=None):
+        if not self.citation_notes_should_be_endnotes:
+            raise NotImplementedError('Implement notes at the end of chapter')
 
-        html = head_html_template.format(title=title)
-        html += '<body>\n'
-        html += start_section_template.format(epub_type=section_kind,
-                                              section_id=section.id)
-        html += main_html
-        html += end_section
-        html += '</body>\n'
-        html += '</html>\n'
+        note_lis = self.note_lis[ENDNOTE_CHAPTER_ID]
+        first_note_number = len(note_lis) + 1
+        links = self._get_links_for_items(section, first_note_number,
+                                          _count_notes_in_items(items))
+        res = _render_items_html(items, self._render_markdown,
+                                 site_kind=self.site_kind,
+                                 links=links,
+                                 first_note_number=first_note_number)
+        note_lis.extend(res['note_lis'])
+        return res['html']
+
+    def _create_section(self, section, items=None, main_html=None):
+        section_file = self._build_section_file(section, items=items,
+                                                main_html=main_html)
+        self._write_section_file(section_file)
+
+    def _write_section_file(self, section_file):
+        self.create_file(section_file['path'], section_file['html'],
+                         section_id=section_file['section'].id)
+
+        section = section_file['section']
+        if self.search_index and self._document_sections.get(section.id) is section:
+            self._search_targets[section.id] = extract_search_targets(''.join(section_file['html']),
+                                                                      self._section_titles)
+
+    def _build_section_file(self, section, items=None, main_html=None):
+        with self.stats.stage('render', section.id):
+            if section.id == TOC_CHAPTER_ID:
+                self._sections_added.insert(0, section)
+            else:
+                self._sections_added.append(section)
 
-        section_path = self._get_path_within_site_for_section(section)
+            title = section.title
+            if main_html is None:
+                main_html = self._create_html_from_items(items, section)
 
-        self.create_file(section_path, html)
+            if self.site_kind == EPUB3:
+                head_html_template = EPUB_CHAPTER_HEADER_HTML
+                start_section_template = EPUB_START_CHAPTER_SECTION
+                end_section = EPUB_END_CHAPTER_SECTION
+            elif self.site_kind == HTML:
+                head_html_template = HTML_CHAPTER_HEADER_HTML
+                start_section_template = HTML_START_CHAPTER_SECTION
+                end_section = HTML_END_CHAPTER_SECTION
 
-    def _create_endnotes_section_items(self):
-        lis = self.note_lis[ENDNOTE_CHAPTER_ID]
+            if section.kind == PART:
+                section_kind = 'part'
+            elif section.kind == CHAPTER:
+                section_kind = 'chapter'
+            elif section.kind == SUBCHAPTER:
+                section_kind = 'subchapter'
+
+            html = [head_html_template.format(title=title),
+                    '<body>\n',
+                    start_section_template.format(epub_type=section_kind,
+                                                  section_id=section.id),
+                    main_html,
+                    end_section,
+                    '</body>\n',
+                    '</html>\n']
+
+            section_path = self._get_path_within_site_for_section(section)
+            return {'section': section, 'path': section_path, 'html': html}
+
+    def _create_endnotes_section_items(self, lis, first_note_number=1):
         if not lis:
             return []
         
@@ -592,7 +1098,10 @@ class SiteRenderer:
                 html += '</aside>'
                 htmls.append(html)
         elif self.site_kind == HTML:
-            htmls.append('<ol>\n')
+            if first_note_number == 1:
+                htmls.append('<ol>\n')
+            else:
+                htmls.append(f'<ol start="{first_note_number}">\n')
             htmls.extend((f'<li>{li}</li>' for li in lis))
             htmls.append('</ol>\n')
 
@@ -604,6 +1113,29 @@ class SiteRenderer:
         items = [{'kind': 'html', 'html': html} for html in htmls]
         return items
 
+    def _create_endnotes_sections(self):
+        lis = self.note_lis[ENDNOTE_CHAPTER_ID]
+        if not self._endnotes_are_split():
+            file_starts = [None]
+            limits = [0, len(lis)]
+        else:
+            file_starts = sorted(self._endnote_file_starts)
+            limits = [start - 1 for start in file_starts] + [len(lis)]
+
+        for idx, file_start in enumerate(file_starts):
+            first_note_number = limits[idx] + 1
+            items = self._create_endnotes_section_items(lis[limits[idx]:limits[idx + 1]],
+                                                        first_note_number)
+            if items:
+                section = self._get_endnotes_section(file_start)
+                if file_start is not None:
+                    note_range = f'{first_note_number}'
+                    if limits[idx + 1] > first_note_number:
+                        note_range += f'-{limits[idx + 1]}'
+                    section.title = f'{ENDNOTE_CHAPTER_TITLE[self.book.lang]} {note_range}'
+                self._create_section(section, items)
+                self._backmater_sections.append(section)
+
     def _create_reference_items(self):
 
         if not self._references:
@@ -634,23 +1166,57 @@ class SiteRenderer:
         items = [{'kind': 'html', 'html': html} for html in htmls]
         return items
 
-    def _build_nav_for_chapter(self, chapter):
-        htmls = []
-        chapter_anchor = self.build_anchor_to_section(chapter)
+    def _build_navigation(self):
+        # One flat entry per navigation point, in reading order, every
+        # navigation file is created from it
+        navigation = []
+
+        def add_entry(section, level, file_section=None, fragment=None,
+                      in_spine=True):
+            if file_section is None:
+                file_section = section
+            path = self._get_path_within_site_for_section(file_section)
+            navigation.append({'id': section.id,
+                               'kind': section.kind,
+                               'level': level,
+                               'title': section.title,
+                               'fname': path.name,
+                               'fragment': fragment,
+                               'url': self.get_url_to_section(file_section, id_=fragment),
+                               'in_spine': in_spine,
+                               'play_order': None})
+
+        def add_chapter(chapter, level):
+            add_entry(chapter, level)
+            for subchapter in chapter.subsections:
+                file_section = self._document_sections[subchapter.id]
+                if file_section is subchapter:
+                    add_entry(subchapter, level + 1)
+                else:
+                    add_entry(subchapter, level + 1, file_section=file_section,
+                              fragment=f'nav_span_{subchapter.id}',
+                              in_spine=False)
 
-        subchapters = list(chapter.subsections)
-        if subchapters:
-            htmls.append(f'<li>{chapter_anchor}\n')
-            htmls.append('<ol>\n')
-            for subchapter in subchapters:
-                anchor = self.build_anchor_to_section(subchapter)
-                htmls.append(f'<li>{anchor}</li>\n')
-            htmls.append('</ol></li>\n')
-        else:
-            htmls.append(f'<li>{chapter_anchor}</li>\n')
-        return htmls
+        add_entry(self._get_special_section(TOC_CHAPTER_ID), 1)
+        for section in self.book.subsections:
+            if section.kind == PART:
+                add_entry(section, 1, in_spine=not section.has_no_html)
+                for chapter in section.subsections:
+                    add_chapter(chapter, 2)
+            elif section.kind == CHAPTER:
+                add_chapter(section, 1)
+        for section in self._backmater_sections:
+            add_entry(section, 1)
 
-    def _create_toc_section_items(self):
+        play_order = 1
+        for entry in navigation:
+            if entry['kind'] == PART and not entry['in_spine']:
+                continue
+            entry['play_order'] = play_order
+            play_order += 1
+        return navigation
+
+    def _create_toc_section_items(self, navigation):
 
         if self.site_kind == EPUB3:
             html = '<nav epub:type="toc">\n'
@@ -661,18 +1227,24 @@ class SiteRenderer:
         htmls.append(f'<h1>{TOC_CHAPTER_TITLE[self.book.lang]}</h1>\n')
         htmls.append('<ol>\n')
 
-        for section in self.book.subsections:
-            if section.kind == PART:
-                anchor = self.build_anchor_to_section(section)
+        entries = [entry for entry in navigation if entry['id'] != TOC_CHAPTER_ID]
+        open_levels = []
+        for idx, entry in enumerate(entries):
+            level = entry['level']
+            while open_levels and open_levels[-1] >= level:
+                htmls.append('</ol></li>\n')
+                open_levels.pop()
+
+            anchor = _build_anchor(entry['url'], entry['title'],
+                                   site_kind=self.site_kind)
+            next_level = entries[idx + 1]['level'] if idx + 1 < len(entries) else 0
+            if entry['kind'] == PART or next_level > level:
                 htmls.append(f'<li>{anchor}\n')
                 htmls.append('<ol>\n')
-                for chapter in section.subsections:
-                    htmls.extend(self._build_nav_for_chapter(chapter))
-                htmls.append('</ol></li>\n')
-            elif section.kind == CHAPTER:
-                htmls.extend(self._build_nav_for_chapter(section))
-        for section in self._backmater_sections:
-            htmls.extend(self._build_nav_for_chapter(section))
+                open_levels.append(level)
+            else:
+                htmls.append(f'<li>{anchor}</li>\n')
+        htmls.extend('</ol></li>\n' for _ in open_levels)
 
         htmls.append('</ol>\n')
         htmls.append('</nav>\n')
@@ -700,28 +1272,26 @@ class SiteRenderer:
         path = base_path / self._get_nav_fname()
         self.create_file(path, html)
 
-    def _build_nav_point_xml_for_section(self, section, play_order, level):
-
-        fname = self._get_fname_for_section(section)
-        span_id = f'nav_span_{section.id}'
+    @staticmethod
+    def _build_nav_point_xml(entry):
 
-        nbsps_for_nested = NBSP * (level - 1)
-        if section.kind in [PART, CHAPTER]:
-            return f'''<navPoint class="{section.kind}" id="{section.id}" playOrder="{play_order}">
+        nbsps_for_nested = NBSP * (entry['level'] - 1)
+        if entry['fragment'] is None:
+            return f'''<navPoint class="{entry['kind']}" id="{entry['id']}" playOrder="{entry['play_order']}">
     <navLabel>
-        <text>{nbsps_for_nested}{section.title}</text>
+        <text>{nbsps_for_nested}{entry['title']}</text>
     </navLabel>
-    <content src="{fname}" />
+    <content src="{entry['fname']}" />
     </navPoint>'''
         else:
-            return f'''<navPoint id="{section.id}" playOrder="{play_order}">
+            return f'''<navPoint id="{entry['id']}" playOrder="{entry['play_order']}">
     <navLabel>
-    <text>{nbsps_for_nested}{section.title}</text>
+    <text>{nbsps_for_nested}{entry['title']}</text>
     </navLabel>
-    <content src="{fname}#{span_id}" />
+    <content src="{entry['fname']}#{entry['fragment']}" />
     </navPoint>'''
 
-    def _create_ncx_xml(self):
+    def _create_ncx_xml(self, navigation):
 
         book = self.book
         html = NCX_HEADER_XML
@@ -734,43 +1304,21 @@ class SiteRenderer:
         # Do not use nested navPoints because some ebook do not support them
         # Use &nbsp; to simulate nesting
 
-        play_order = 1
-        toc_chapter = self._get_special_section(TOC_CHAPTER_ID)
-        html += self._build_nav_point_xml_for_section(toc_chapter, play_order, 1)
-        play_order += 1
-
-        for section in self.book.subsections:
-            if section.kind == PART:
-                if not section.has_no_html:
-                    html += self._build_nav_point_xml_for_section(section, play_order, 1)
-                    play_order += 1
-                for chapter in section.subsections:
-                    html += self._build_nav_point_xml_for_section(chapter, play_order, 2)
-                    play_order += 1
-                    for subchapter in chapter.subsections:
-                        html += self._build_nav_point_xml_for_section(subchapter, play_order, 3)
-                        play_order += 1
-            elif section.kind == CHAPTER:
-                html += self._build_nav_point_xml_for_section(section, play_order, 1)
-                play_order += 1
-                for subchapter in section.subsections:
-                    html += self._build_nav_point_xml_for_section(subchapter, play_order, 2)
-                    play_order += 1
-        for section in self._backmater_sections:
-            html += self._build_nav_point_xml_for_section(section, play_order, 1)
-            play_order += 1
+        for entry in navigation:
+            if entry['play_order'] is not None:
+                html += self._build_nav_point_xml(entry)
 
         html += '</navMap>'
         html += '</ncx>'
         return html
 
-    def _create_ncx(self):
-        xml = self._create_ncx_xml()
+    def _create_ncx(self, navigation):
+        xml = self._create_ncx_xml(navigation)
         base_path = self._get_base_path()
         path = base_path / NCX_FNAME
         self.create_file(path, xml)
 
-    def _create_opf_xml(self):
+    def _create_opf_xml(self, navigation):
         xml = OPF_HEADER_XML
 
         now = datetime.datetime.utcnow().isoformat(timespec='seconds')
@@ -788,30 +1336,9 @@ class SiteRenderer:
 
         item_xml = '<item href="{fname}" id="{id}" media-type="application/xhtml+xml" />\n'
 
-        spine = [TOC_CHAPTER_ID]
-        toc_chapter = self._sections_added[0]
-        toc_fname = self._get_fname_for_section(toc_chapter)
-        xml += item_xml.format(fname=toc_fname,
-                               id='toc')
-
-        for section in self.book.subsections:
-            if section.kind == PART:
-                if not section.has_no_html:
-                    spine.append(section.id)
-                    fname = self._get_fname_for_section(section)
-                    xml += item_xml.format(fname=fname, id=section.id)
-                for chapter in section.subsections:
-                    spine.append(chapter.id)
-                    fname = self._get_fname_for_section(chapter)
-                    xml += item_xml.format(fname=fname, id=chapter.id)
-            elif section.kind == CHAPTER:
-                spine.append(section.id)
-                fname = self._get_fname_for_section(section)
-                xml += item_xml.format(fname=fname, id=section.id)
-        for section in self._backmater_sections:
-            spine.append(section.id)
-            fname = self._get_fname_for_section(section)
-            xml += item_xml.format(fname=fname, id=section.id)
+        spine = [entry for entry in navigation if entry['in_spine']]
+        for entry in spine:
+            xml += item_xml.format(fname=entry['fname'], id=entry['id'])
 
         xml += f'<item href="{NCX_FNAME}" id="ncx" media-type="application/x-dtbncx+xml" />\n'
         fname = self._get_nav_fname()
@@ -820,76 +1347,423 @@ class SiteRenderer:
         xml += '</manifest>\n'
 
         xml += '<spine toc="ncx">\n'
-        for chapter_id in spine:
-            xml += f'<itemref idref="{chapter_id}"/>\n'
+        for entry in spine:
+            xml += f'<itemref idref="{entry["id"]}"/>\n'
         xml += '</spine>\n'
 
         xml += '<guide>\n'
         title = TOC_CHAPTER_TITLE[book.lang]
+        toc_fname = spine[0]['fname']
         xml += f'<reference type="toc" title="{title}" href="{toc_fname}" />\n'
         xml += '</guide>\n'
         xml += '</package>\n'
         return xml
 
-    def _create_opf(self):
-        xml = self._create_opf_xml()
+    def _create_opf(self, navigation):
+        xml = self._create_opf_xml(navigation)
         base_path = self._get_base_path()
         path = base_path / OPF_FNAME
         self.create_file(path, xml)
 
     def _create_navigation_files(self):
+        with self.stats.stage('navigation'):
+            navigation = self._build_navigation()
+            items = self._create_toc_section_items(navigation)
+            section = self._get_special_section(TOC_CHAPTER_ID)
+            self._create_section(section, items)
 
-        items = self._create_toc_section_items()
-        section = self._get_special_section(TOC_CHAPTER_ID)
-        self._create_section(section, items)
-
-        if self.site_kind == EPUB3:
-            items = self._create_toc_section_items()
-            self._create_nav(items)
-            self._create_ncx()
-            self._create_opf()
+            if self.site_kind == EPUB3:
+                self._create_nav(items)
+                self._create_ncx(navigation)
+                self._create_opf(navigation)
+
+    def _create_search_index(self):
+        with self.stats.stage('search_index'):
+            documents = []
+            for document in self._documents:
+                section = document['section']
+                documents.append({'url': self.get_url_to_section(section),
+                                  'targets': self._search_targets.get(section.id, [])})
+            for fname, content in build_search_index_files(documents).items():
+                self.create_file(SEARCH_DIR / fname, content)
+            self.create_file(SEARCH_DIR / SEARCH_HTML_FNAME,
+                             create_search_html(self.book.title))
+
+    def _create_sections_in_parallel(self):
+        if not self.citation_notes_should_be_endnotes:
+            raise NotImplementedError('Implement notes at the end of chapter')
 
-    def render(self):
-        print(self.site_kind)
-        self.citation_keys_not_found= set()
+        # the endnote numbers are assigned beforehand so that every section
+        # can be rendered on its own
+        note_lis = self.note_lis[ENDNOTE_CHAPTER_ID]
+        first_note_number = len(note_lis) + 1
+        tasks = []
+        for section_and_items in self._sections_and_items:
+            items = section_and_items['items']
+            num_notes = _count_notes_in_items(items)
+            links = self._get_links_for_items(section_and_items['section'],
+                                              first_note_number, num_notes)
+            tasks.append({'items': [_get_picklable_item(item) for item in items],
+                          'site_kind': self.site_kind,
+                          'links': links,
+                          'first_note_number': first_note_number})
+            first_note_number += num_notes
+
+        with self.stats.stage('render_in_workers'), \
+             ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            results = executor.map(_render_items_html_in_worker, tasks)
+            for section_and_items, res in zip(self._sections_and_items, results):
+                note_lis.extend(res['note_lis'])
+                self._create_section(section_and_items['section'],
+                                     main_html=res['html'])
+
+    def _render_section_in_pipeline(self, section_and_items):
+        self._sections_and_items.append(section_and_items)
+        return self._build_section_file(section_and_items['section'],
+                                        items=section_and_items['items'])
+
+    def _create_sections_pipelined(self):
+        # while pandoc resolves the citations of one section the previous
+        # one is being rendered and written
+        self._sections_and_items = []
+        stages = [('tokenize', self._tokenize_document),
+                  ('citations', self._process_citations_in_section),
+                  ('render', self._render_section_in_pipeline),
+                  ('write', self._write_section_file)]
+        self.pipeline_stats = run_pipeline(self._documents, stages)
+
+        print(f'pipeline wall time: {self.pipeline_stats["wall_time"]:.3f} s')
+        for stage, stats in self.pipeline_stats['stages'].items():
+            print(f'  {stage}: {stats["num_items"]} sections, '
+                  f'busy {stats["busy_time"]:.3f} s '
+                  f'({stats["occupancy"]:.0%})')
+
+    def _get_manifest_path(self):
+        if self.out_dir is None:
+            zip_path = self.out_zip_path
+            return zip_path.with_name(f'.{zip_path.name}{MANIFEST_FNAME}')
+        return self.out_dir / MANIFEST_FNAME
+
+    def _load_manifest(self):
+        empty_manifest = {'version': MANIFEST_VERSION,
+                          'site_kind': self.site_kind,
+                          'bibliography_hash': None,
+                          'sections': {},
+                          'files': {},
+                          'zip_crcs': {}}
+        path = self._get_manifest_path()
+        if not path.exists():
+            return empty_manifest
+        with path.open('rt') as fhand:
+            manifest = json.load(fhand)
+        if (manifest.get('version') != MANIFEST_VERSION or
+            manifest.get('site_kind') != self.site_kind):
+            return empty_manifest
+        return manifest
+
+    def _save_manifest(self, sections_info):
+        manifest = {'version': MANIFEST_VERSION,
+                    'site_kind': self.site_kind,
+                    'bibliography_hash': self._bibliography_hash,
+                    'sections': sections_info,
+                    'files': self._file_hashes,
+                    'zip_crcs': self._file_crcs}
+        with self._get_manifest_path().open('wt') as fhand:
+            json.dump(manifest, fhand)
+
+    def _remove_stale_files(self):
+        if self.out_dir is None:
+            return
+        for path in self._manifest['files']:
+            if path in self._file_hashes:
+                continue
+            self._out_dir_writer.remove(path)
 
-        self._sections_and_items = self._get_sections_and_items()
-        self._process_citations()
+    def _reuse_previous_file(self, path, content_hash):
+        self._file_hashes[str(path)] = content_hash
+        if self.out_dir:
+            self._out_dir_writer.keep(path)
+        if not self.out_zip_path:
+            return
+        crc = self._manifest['zip_crcs'].get(str(path))
+        self._file_crcs[str(path)] = crc
+        if crc is not None and self._out_zip.get_base_member_crc(path) == crc:
+            self._out_zip.copy_member_from_base(path)
+        else:
+            content = (self.out_dir / path).read_text()
+            self._file_crcs[str(path)] = crc_content(content)
+            self._out_zip.write(path, content)
 
-        # self._process_notes()
+    @staticmethod
+    def _apply_previous_citation_results(section_and_items, section_info):
+        citations = [item for item in section_and_items['items'] if item['kind'] == 'citation']
+        for citation, result in zip(citations, section_info['citation_items']):
+            citation.update(result)
+
+    def _create_sections_incrementally(self):
+        # A section is only rendered again if its markdown changed or if
+        # something it links to moved: its own path, the first endnote
+        # number or the endnotes url. When the bibliography or the CSL
+        # change the cached citations are discarded
+        previous_sections_info = self._manifest['sections']
+        self._bibliography_hash = _get_bibliography_hash(self.book.bibliography_path)
+        bibliography_changed = self._bibliography_hash != self._manifest['bibliography_hash']
+        sections_info = {}
+        note_lis = self.note_lis[ENDNOTE_CHAPTER_ID]
+        self._sections_and_items = []
+        self.sections_rendered = []
+        for document in self._documents:
+            section = document['section']
+            md_pieces = self._read_document_md(document)
+            source_hash = hash_content(json.dumps([[piece['section'].id, piece['md_lines']]
+                                                   for piece in md_pieces]))
+
+            previous_info = previous_sections_info.get(section.id)
+            if (previous_info and bibliography_changed and
+                previous_info['citation_items']):
+                previous_info = None
+            if previous_info and previous_info['source_hash'] == source_hash:
+                section_and_items = None
+                num_notes = previous_info['num_notes']
+                self._references.update(previous_info['references'])
+                self.citation_keys_not_found.update(previous_info['citation_keys_not_found'])
+            else:
+                previous_info = None
+                section_and_items = self._tokenize_document(document, md_pieces)
+                self._process_citations_in_section(section_and_items)
+                num_notes = _count_notes_in_items(section_and_items['items'])
+
+            first_note_number = len(note_lis) + 1
+            links = self._get_links_for_items(section, first_note_number,
+                                              num_notes)
+            path = self._get_path_within_site_for_section(section)
+            render_key = hash_content(json.dumps([source_hash,
+                                                  first_note_number,
+                                                  str(path), links,
+                                                  self.site_kind,
+                                                  self.search_index]))
+
+            if (previous_info and previous_info['render_key'] == render_key and
+                self._previous_file_is_unchanged(path, previous_info['output_hash'])):
+                self.stats.count('sections_reused')
+                self._sections_added.append(section)
+                note_lis.extend(previous_info['note_lis'])
+                if self.search_index:
+                    self._search_targets[section.id] = previous_info['search_targets']
+                self._reuse_previous_file(path, previous_info['output_hash'])
+                sections_info[section.id] = previous_info
+                continue
 
-        self._open_out_files()
+            if section_and_items is None:
+                section_and_items = self._tokenize_document(document, md_pieces)
+                self._apply_previous_citation_results(section_and_items,
+                                                      previous_sections_info[section.id])
+                section_and_items['references'] = previous_sections_info[section.id]['references']
+                section_and_items['citation_keys_not_found'] = previous_sections_info[section.id]['citation_keys_not_found']
+            self._sections_and_items.append(section_and_items)
+            self._create_section(section, section_and_items['items'])
+            self.sections_rendered.append(section.id)
 
+            items = section_and_items['items']
+            citation_items = [{key: item[key] for key in CITATION_RESULT_KEYS if key in item}
+                              for item in items if item['kind'] == 'citation']
+            sections_info[section.id] = {'source_hash': source_hash,
+                                         'render_key': render_key,
+                                         'citation_items': citation_items,
+                                         'references': section_and_items['references'],
+                                         'citation_keys_not_found': sorted(section_and_items['citation_keys_not_found']),
+                                         'first_note_number': first_note_number,
+                                         'num_notes': num_notes,
+                                         'note_lis': note_lis[first_note_number - 1:],
+                                         'search_targets': self._search_targets.get(section.id),
+                                         'output_hash': self._file_hashes[str(path)]}
+        print(f'{len(self.sections_rendered)} of {len(sections_info)} sections rendered')
+        return sections_info
+
+    def _create_backbone_files(self):
         if self.site_kind == EPUB3:
             self._create_mimetype_file()
             self._create_epub_backbone()
 
-        for section_and_items in self._sections_and_items:
-            section = section_and_items['section']
-            items = section_and_items['items']
-            self._create_section(section, items)
+    def _get_stats_path(self):
+        if self.out_dir is None:
+            zip_path = self.out_zip_path
+            return zip_path.with_name(f'.{zip_path.name}{STATS_FNAME}')
+        return self.out_dir / STATS_FNAME
+
+    def _add_writer_stats(self):
+        stats = self.stats
+        if self.zip_stats:
+            stats.count('zip_uncompressed_bytes', self.zip_stats['uncompressed_size'])
+            stats.count('zip_bytes', self.zip_stats['zip_size'])
+            stats.count('zip_members_copied', self.zip_stats['num_copied_from_base'])
+        if self.dir_report:
+            stats.count('dir_bytes_written', self.dir_report['bytes_written'])
+            stats.count('dir_files_unchanged', len(self.dir_report['unchanged']))
 
-        self._backmater_sections = []
-        endnotes_items = self._create_endnotes_section_items()
-        if endnotes_items:
-            section = self._get_special_section(ENDNOTE_CHAPTER_ID)
-            self._create_section(section, endnotes_items)
-            self._backmater_sections.append(section)
+    def render(self):
+        return self._run_render()
+
+    async def render_async(self, pandoc_semaphore=None, executor=None):
+        # the render runs in a thread of the executor, so its file writes do
+        # not block the event loop, and pandoc runs in the loop as an asyncio
+        # subprocess. Share the semaphore to limit the pandocs of many books
+        loop = asyncio.get_running_loop()
+        if pandoc_semaphore is None:
+            pandoc_semaphore = asyncio.Semaphore(DEFAULT_PANDOC_PROCESSES)
+        return await loop.run_in_executor(executor, self._run_render,
+                                          loop, pandoc_semaphore)
+
+    def _run_render(self, event_loop=None, pandoc_semaphore=None):
+        # a renderer renders one book at a time, several renderers can
+        # render at the same time in different threads
+        if not self._render_lock.acquire(blocking=False):
+            raise RuntimeError('This renderer is already rendering, use another one')
+        try:
+            self._reset_render_state()
+            self._event_loop = event_loop
+            self._pandoc_semaphore = pandoc_semaphore
+            return self._render()
+        finally:
+            for future in self._pending_citations.values():
+                future.cancel()
+            if self.memory_profiler is not None:
+                # a failed render should not keep the profiler running
+                self.memory_profiler.stop()
+            self._event_loop = None
+            self._pandoc_semaphore = None
+            self._render_lock.release()
+
+    def _render(self):
+        print(self.site_kind)
+        render_markdown = self._render_markdown
+        markdown_calls = render_markdown.num_calls
+        markdown_hits = render_markdown.num_hits
+        markdown_time = render_markdown.render_time
+        markdown_cpu_time = render_markdown.render_cpu_time
+
+        if self.profile_memory:
+            self.memory_profiler = MemoryProfiler(get_structures=self._get_profiled_structures)
+            self.memory_profiler.start()
+
+        with self._memory_stage('plan'):
+            with self.stats.stage('plan'):
+                self._plan_documents()
+            self._build_anchor_table()
+
+        with self._memory_stage('sections'):
+            if self.pipeline:
+                self._open_out_files()
+                self._create_backbone_files()
+                self._create_sections_pipelined()
+            elif self.incremental:
+                self._open_out_files()
+                self._manifest = self._load_manifest()
+                self._create_backbone_files()
+                sections_info = self._create_sections_incrementally()
+            else:
+                self._sections_and_items = self._get_sections_and_items()
+                self._prefetch_citations()
+                self._process_citations()
 
-        reference_items = self._create_reference_items()
-        if reference_items:
-            section = self._get_special_section(BIBLIOGRAPHY_CHAPTER_ID)
-            self._create_section(section, reference_items)
-            self._backmater_sections.append(section)
+                # self._process_notes()
 
-        self._create_navigation_files()
+                self._open_out_files()
+                self._create_backbone_files()
 
-        self._close_out_files()
+                if self.jobs and self.jobs > 1:
+                    self._create_sections_in_parallel()
+                else:
+                    for section_and_items in self._sections_and_items:
+                        section = section_and_items['section']
+                        items = section_and_items['items']
+                        self._create_section(section, items)
+
+        self._backmater_sections = []
+        with self._memory_stage('endnotes'):
+            self._create_endnotes_sections()
+
+        with self._memory_stage('bibliography'):
+            reference_items = self._create_reference_items()
+            if reference_items:
+                section = self._get_special_section(BIBLIOGRAPHY_CHAPTER_ID)
+                self._create_section(section, reference_items)
+                self._backmater_sections.append(section)
+
+        with self._memory_stage('navigation'):
+            self._create_navigation_files()
+
+        if self.search_index:
+            with self._memory_stage('search_index'):
+                self._create_search_index()
+
+        if self.incremental:
+            with self._memory_stage('manifest'):
+                self._remove_stale_files()
+                self._save_manifest(sections_info)
+
+        with self._memory_stage('close'):
+            with self.stats.stage('close'):
+                self._close_out_files()
+
+        if self.validate:
+            with self.stats.stage('validate'), self._memory_stage('validate'):
+                epub_path = self.out_zip_path if self.out_zip_path else self.out_dir
+                self.validation_errors = validate_epub(epub_path)
+                report_validation_errors(epub_path, self.validation_errors)
+
+        # the markdown cache can be shared with other renderers, only what
+        # happened in this render is counted
+        stats = self.stats
+        stats.count('markdown_calls', render_markdown.num_calls - markdown_calls)
+        stats.count('markdown_cache_hits', render_markdown.num_hits - markdown_hits)
+        stats.count('mistune_calls', (render_markdown.num_calls - markdown_calls) -
+                                     (render_markdown.num_hits - markdown_hits))
+        stats.add_stage('mistune',
+                        wall_time=render_markdown.render_time - markdown_time,
+                        cpu_time=render_markdown.render_cpu_time - markdown_cpu_time,
+                        num_calls=stats.counters['mistune_calls'])
+        if self.sections_rendered is not None:
+            stats.count('sections_rendered', len(self.sections_rendered))
+        self._add_writer_stats()
+        report = stats.get_report()
+        if self.memory_profiler is not None:
+            self.memory_profiler.stop()
+            report['memory'] = self.memory_profiler.get_report()
+        self.render_report = report
+        print_render_report(report)
+        if self.memory_profiler is not None:
+            print_memory_report(report['memory'])
+        if self.write_stats:
+            with self._get_stats_path().open('wt') as fhand:
+                json.dump(report, fhand, indent=2)
+        return report
+
+def render_sites(md_book, targets, **renderer_kwargs):
+    # targets is a dict with the zip_path and/or out_dir for every site kind,
+    # the citations and the markdown are only processed for the first one
+    render_cache = RenderCache()
+    renderers = {}
+    for site_kind, target in targets.items():
+        with SiteRenderer(md_book, site_kind=site_kind,
+                          render_cache=render_cache,
+                          **target, **renderer_kwargs) as renderer:
+            renderer.render()
+        renderers[site_kind] = renderer
+    return renderers
+
+
+def check_epub(ebook_path, epubcheck=True):
+    # the python validation is fast, epubcheck is slow but complete
+    errors = validate_epub(ebook_path)
+    report_validation_errors(ebook_path, errors)
+    if not epubcheck:
+        return errors
 
-def check_epub(ebook_path):
     cmd = ['java', '-jar', str(EPUBCHECK_JAR), str(ebook_path)]
     completed_process = subprocess.run(cmd, capture_output=True)
 
     if completed_process.returncode:
         sys.stdout.write(completed_process.stdout.decode())
         sys.stderr.write(completed_process.stderr.decode())
+    return errors
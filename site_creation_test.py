@@ -0,0 +1,640 @@
+
+import unittest
+import asyncio
+import tempfile
+import re
+import json
+import tracemalloc
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from book_section import BookSection
+from book_section_test import (_prepare_book_md_files, _MarkdownFile,
+                               _Directory, BOOK1_STRUCTURE)
+from site_creation import (SiteRenderer, _itemize_md_text, HTML, EPUB3,
+                           MANIFEST_FNAME, STATS_FNAME, render_sites,
+                           RenderCache)
+import references
+from benchmarks.synthetic_book import create_synthetic_book
+from render_stats import MemoryProfiler
+from benchmarks.run_benchmarks import PANDOC_STUB_PATH
+
+SIMPLE_BOOK_METADATA = '''---
+title:  'The book title'
+lang: 'en'
+uid: 'anUniqueIdForTheBook'
+author:
+- Jose Blanca
+---
+'''
+
+SIMPLE_CHAPTER1 = '''# First chapter {#chapter_one}
+Some text in the first chapter.
+
+- a list item
+- another item
+'''
+
+SIMPLE_CHAPTER2 = '''# Second chapter
+Text in the second chapter.
+
+> A quote.
+'''
+
+SIMPLE_BOOK_STRUCTURE = _Directory(path='',
+                                   content=[_MarkdownFile(path=Path('book.md'),
+                                                          content=SIMPLE_BOOK_METADATA),
+                                            _Directory(path=Path('chapter1'),
+                                                       content=[_MarkdownFile(path=Path('chapter1.md'),
+                                                                              content=SIMPLE_CHAPTER1)]),
+                                            _Directory(path=Path('chapter2'),
+                                                       content=[_MarkdownFile(path=Path('chapter2.md'),
+                                                                              content=SIMPLE_CHAPTER2)])])
+
+PART_BOOK_STRUCTURE = _Directory(path='',
+                                 content=[_MarkdownFile(path=Path('book.md'),
+                                                        content=SIMPLE_BOOK_METADATA),
+                                          _Directory(path=Path('00_part'),
+                                                     content=[_MarkdownFile(path=Path('part.md'),
+                                                                            content='# The part {$part}\n'),
+                                                              _Directory(path=Path('chapter1'),
+                                                                         content=[_MarkdownFile(path=Path('chapter1.md'),
+                                                                                                content=SIMPLE_CHAPTER1)])]),
+                                          _Directory(path=Path('chapter2'),
+                                                     content=[_MarkdownFile(path=Path('chapter2.md'),
+                                                                            content=SIMPLE_CHAPTER2)])])
+
+
+SUBCHAPTER_BOOK_STRUCTURE = _Directory(path='',
+                                       content=[_MarkdownFile(path=Path('book.md'),
+                                                              content=SIMPLE_BOOK_METADATA),
+                                                _Directory(path=Path('chapter1'),
+                                                           content=[_MarkdownFile(path=Path('chapter1.md'),
+                                                                                  content='# First chapter\nIntro.\n'),
+                                                                    _Directory(path=Path('sub1'),
+                                                                               content=[_MarkdownFile(path=Path('sub1.md'),
+                                                                                                      content='# First subchapter\nText 1.\n')]),
+                                                                    _Directory(path=Path('sub2'),
+                                                                               content=[_MarkdownFile(path=Path('sub2.md'),
+                                                                                                      content='# Second subchapter\nText 2.\n')])])])
+
+
+
+def _read_files_in_dir(dir_):
+    return {str(path.relative_to(dir_)): path.read_bytes()
+            for path in dir_.rglob('*') if path.is_file()}
+
+
+def _render_md_lines(renderer, lines):
+    items = list(_itemize_md_text(lines))
+    return renderer._create_html_from_items(items)
+
+
+class ParagraphTest(unittest.TestCase):
+    def test_paragraphs(self):
+        with _prepare_book_md_files(BOOK1_STRUCTURE) as book_dir:
+            book = BookSection(Path(book_dir))
+            renderer = SiteRenderer(book, site_kind=HTML,
+                                    out_dir=Path(book_dir) / 'site')
+
+            html = _render_md_lines(renderer, ['Some text.\n', '\n',
+                                               'Other *para*\n',
+                                               'continues.\n'])
+            assert html == '<p>Some text.</p>\n\n<p>Other <em>para</em>\ncontinues.</p>\n'
+
+            html = _render_md_lines(renderer, ['text\n', '- a\n', '- b\n'])
+            assert html == '<p>text</p>\n\n<ul>\n<li>a</li>\n<li>b</li>\n</ul>'
+
+            html = _render_md_lines(renderer, ['1. x\n', '2. y\n'])
+            assert html == '<ol>\n<li>x</li>\n<li>y</li>\n</ol>'
+
+            html = _render_md_lines(renderer, ['Intro\n', '> a quote\n',
+                                               '> another\n'])
+            assert html == '<p>Intro</p>\n\n<blockquote><p>a quote</p>\n</blockquote>\n<blockquote><p>another</p>\n</blockquote>'
+
+            items = list(_itemize_md_text(['a\n', '> q [@noref] tail\n']))
+            for item in items:
+                if item['kind'] == 'citation':
+                    item['citations_found'] = False
+                    item['citation_keys'] = ['noref']
+            html = renderer._create_html_from_items(items)
+            assert html == '<p>a</p>\n\n<blockquote><p>q [@noref] tail</p>\n</blockquote>'
+
+
+def _create_note_items(num_notes):
+    items = list(_itemize_md_text([f'Text [@ref{idx}].\n' for idx in range(num_notes)]))
+    for item in items:
+        if item['kind'] == 'citation':
+            item.update({'citations_found': True,
+                         'citation_keys': ['ref'],
+                         'footnote_html_text': 'A note.',
+                         'citation_text_is_note_number': True})
+    return items
+
+
+class EndnotesTest(unittest.TestCase):
+    def test_split_endnotes(self):
+        with _prepare_book_md_files(SIMPLE_BOOK_STRUCTURE) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            cases = [({}, [['endnotes'] * 3, ['endnotes'] * 2]),
+                     ({'max_endnotes_per_file': 2},
+                      [['endnotes_1', 'endnotes_1', 'endnotes_3'], ['endnotes_3', 'endnotes_5']]),
+                     ({'endnotes_per_chapter': True},
+                      [['endnotes_1'] * 3, ['endnotes_4'] * 2])]
+            for idx, (options, expected_files) in enumerate(cases):
+                book = BookSection(Path(book_dir))
+                out_dir = Path(tmp_dir) / f'site_{idx}'
+                with SiteRenderer(book, site_kind=HTML, out_dir=out_dir,
+                                  **options) as renderer:
+                    renderer._open_out_files()
+                    renderer._plan_documents()
+                    hrefs = []
+                    for section, num_notes in zip(book.parts_and_chapters, [3, 2]):
+                        html = renderer._create_html_from_items(_create_note_items(num_notes),
+                                                                section)
+                        hrefs.append(re.findall(r'href="../section/([a-z0-9_]+)\.html#endnotes_[0-9]', html))
+                    assert hrefs == expected_files
+                    renderer._backmater_sections = []
+                    renderer._create_endnotes_sections()
+                fnames = sorted(path.name for path in (out_dir / 'section').iterdir())
+                assert fnames == sorted({f'{fname}.html' for fnames in expected_files for fname in fnames})
+                notes = ''.join(path.read_text() for path in (out_dir / 'section').iterdir())
+                assert notes.count('<li>') == 5
+                for note_number in range(1, 6):
+                    assert f'id="endnotes_{note_number}"' in notes
+
+
+class RenderTest(unittest.TestCase):
+    def test_render_epub(self):
+        with _prepare_book_md_files(SIMPLE_BOOK_STRUCTURE) as book_dir:
+            book = BookSection(Path(book_dir))
+            with tempfile.TemporaryDirectory() as out_dir:
+                zip_path = Path(out_dir) / 'book.epub'
+                with SiteRenderer(book, site_kind=EPUB3,
+                                  zip_path=zip_path) as renderer:
+                    renderer.render()
+
+                with zipfile.ZipFile(zip_path) as epub_zip:
+                    infos = epub_zip.infolist()
+                    assert infos[0].filename == 'mimetype'
+                    assert infos[0].compress_type == zipfile.ZIP_STORED
+                    assert epub_zip.read('mimetype') == b'application/epub+zip'
+                    assert all(info.compress_type == zipfile.ZIP_DEFLATED
+                               for info in infos[1:])
+                    chapter = epub_zip.read('EPUB/chapter_1.xhtml').decode()
+                    assert '<li>a list item</li>' in chapter
+
+    def test_render_html(self):
+        with _prepare_book_md_files(SIMPLE_BOOK_STRUCTURE) as book_dir:
+            book = BookSection(Path(book_dir))
+            out_dir = Path(book_dir) / 'site'
+            with SiteRenderer(book, site_kind=HTML,
+                              out_dir=out_dir) as renderer:
+                renderer.render()
+            chapter = (out_dir / 'section' / 'chapter_2.html').read_text()
+            assert '<blockquote><p>A quote.</p>' in chapter
+            assert (out_dir / 'section' / 'toc.html').exists()
+
+    def test_parallel_render(self):
+        with _prepare_book_md_files(SIMPLE_BOOK_STRUCTURE) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            sites = []
+            for idx, options in enumerate([{}, {'jobs': 2},
+                                           {'pipeline': True}]):
+                book = BookSection(Path(book_dir))
+                out_dir = Path(tmp_dir) / f'site_{idx}'
+                with SiteRenderer(book, site_kind=HTML, out_dir=out_dir,
+                                  **options) as renderer:
+                    renderer.render()
+                sites.append(_read_files_in_dir(out_dir))
+            assert sites[0] == sites[1]
+            assert sites[0] == sites[2]
+            stages = renderer.pipeline_stats['stages']
+            assert list(stages) == ['tokenize', 'citations', 'render', 'write']
+            assert stages['write']['num_items'] == 2
+
+    def test_parallel_render_with_citations(self):
+        # the workers number the endnotes of their sections on their own
+        pandoc_bin = references.PANDOC_BIN
+        references.PANDOC_BIN = str(PANDOC_STUB_PATH)
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                book_dir = Path(tmp_dir) / 'book'
+                create_synthetic_book(book_dir, num_parts=1, chapters_per_part=4,
+                                      subchapters_per_chapter=1,
+                                      paragraphs_per_section=3, bibliography_size=10)
+                sites = []
+                note_numbers = []
+                for idx, options in enumerate([{}, {'jobs': 3}]):
+                    out_dir = Path(tmp_dir) / f'site_{idx}'
+                    with SiteRenderer(BookSection(book_dir), site_kind=HTML,
+                                      out_dir=out_dir, **options) as renderer:
+                        renderer.render()
+                    site = _read_files_in_dir(out_dir)
+                    sites.append(site)
+                    endnotes = site['section/endnotes.html'].decode()
+                    refs = [re.findall(r'href="\.\./section/endnotes\.html#endnotes_([0-9]+)"',
+                                       site[f'section/chapter_{chapter}.html'].decode())
+                            for chapter in range(1, 5)]
+                    note_numbers.append((re.findall(r'id="endnotes_([0-9]+)"', endnotes),
+                                         refs))
+                ids, refs = note_numbers[0]
+                assert ids == [str(number) for number in range(1, len(ids) + 1)]
+                assert sum(refs, []) == ids
+                assert note_numbers[1] == note_numbers[0]
+                assert sites[1] == sites[0]
+        finally:
+            references.PANDOC_BIN = pandoc_bin
+
+    def test_incremental_render(self):
+        with _prepare_book_md_files(SIMPLE_BOOK_STRUCTURE) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            out_dir = Path(tmp_dir) / 'site'
+            renders = []
+            changed_files = []
+            for modify_chapter in [False, False, True]:
+                if modify_chapter:
+                    path = Path(book_dir) / 'chapter2' / 'chapter2.md'
+                    path.write_text(path.read_text() + '\nOne more line.\n')
+                book = BookSection(Path(book_dir))
+                with SiteRenderer(book, site_kind=HTML, out_dir=out_dir,
+                                  incremental=True) as renderer:
+                    renderer.render()
+                renders.append(renderer.sections_rendered)
+                changed_files.append([path for path in renderer.dir_report['changed']
+                                      if not path.startswith('search/')])
+            assert renders == [['chapter_one', 'chapter_2'], [], ['chapter_2']]
+            assert changed_files[1] == []
+            assert changed_files[2] == ['section/chapter_2.html']
+            chapter = (out_dir / 'section' / 'chapter_2.html').read_text()
+            assert 'One more line.' in chapter
+
+            fresh_dir = Path(tmp_dir) / 'fresh_site'
+            with SiteRenderer(BookSection(Path(book_dir)), site_kind=HTML,
+                              out_dir=fresh_dir) as renderer:
+                renderer.render()
+            site = _read_files_in_dir(out_dir)
+            del site[MANIFEST_FNAME]
+            assert site == _read_files_in_dir(fresh_dir)
+
+    def test_incremental_epub(self):
+        with _prepare_book_md_files(SIMPLE_BOOK_STRUCTURE) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            zip_path = Path(tmp_dir) / 'book.epub'
+            copied = []
+            for modify_chapter in [False, True]:
+                if modify_chapter:
+                    path = Path(book_dir) / 'chapter2' / 'chapter2.md'
+                    path.write_text(path.read_text() + '\nOne more line.\n')
+                book = BookSection(Path(book_dir))
+                with SiteRenderer(book, site_kind=EPUB3, zip_path=zip_path,
+                                  incremental=True) as renderer:
+                    renderer.render()
+                copied.append(renderer.zip_stats['num_copied_from_base'])
+            assert renderer.sections_rendered == ['chapter_2']
+            assert renderer.validation_errors == []
+            assert copied[0] == 0
+            assert copied[1] > 0
+
+            with zipfile.ZipFile(zip_path) as epub_zip:
+                assert epub_zip.testzip() is None
+                assert epub_zip.namelist()[0] == 'mimetype'
+                chapter = epub_zip.read('EPUB/chapter_2.xhtml').decode()
+                assert 'One more line.' in chapter
+                chapter = epub_zip.read('EPUB/chapter_1.xhtml').decode()
+                assert '<li>a list item</li>' in chapter
+
+    def test_incremental_bibliography_change(self):
+        pandoc_bin = references.PANDOC_BIN
+        references.PANDOC_BIN = str(PANDOC_STUB_PATH)
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                book_dir = Path(tmp_dir) / 'book'
+                out_dir = Path(tmp_dir) / 'site'
+                res = create_synthetic_book(book_dir, num_parts=1, chapters_per_part=2,
+                                            paragraphs_per_section=2, bibliography_size=5)
+                renders = []
+                for modify_bibliography in [False, False, True]:
+                    if modify_bibliography:
+                        path = res['bibliography_path']
+                        path.write_text(path.read_text().replace('Book number', 'Revised book'))
+                    with SiteRenderer(BookSection(book_dir), site_kind=HTML,
+                                      out_dir=out_dir, incremental=True) as renderer:
+                        renderer.render()
+                    renders.append(renderer.sections_rendered)
+                assert renders[1] == []
+                assert renders[2] == ['chapter_1', 'chapter_2']
+                endnotes = (out_dir / 'section' / 'endnotes.html').read_text()
+                assert '<em>Revised book' in endnotes
+                assert '<em>Book number' not in endnotes
+                bibliography = (out_dir / 'section' / 'bibliography.html').read_text()
+                assert '<em>Revised book' in bibliography
+                assert '<em>Book number' not in bibliography
+        finally:
+            references.PANDOC_BIN = pandoc_bin
+
+    def test_render_several_site_kinds(self):
+        with _prepare_book_md_files(SIMPLE_BOOK_STRUCTURE) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            book = BookSection(Path(book_dir))
+            zip_path = Path(tmp_dir) / 'book.epub'
+            targets = {EPUB3: {'zip_path': zip_path},
+                       HTML: {'out_dir': Path(tmp_dir) / 'site'}}
+            renderers = render_sites(book, targets)
+            assert renderers[EPUB3]._render_cache is renderers[HTML]._render_cache
+            report = renderers[HTML].render_report
+            assert report['cache_hit_rates']['markdown'] == 1
+            assert report['counters']['mistune_calls'] == 0
+            assert renderers[EPUB3].render_report['counters']['mistune_calls'] > 0
+
+            html_dir = Path(tmp_dir) / 'html_site'
+            with SiteRenderer(BookSection(Path(book_dir)), site_kind=HTML,
+                              out_dir=html_dir) as renderer:
+                renderer.render()
+            assert _read_files_in_dir(Path(tmp_dir) / 'site') == _read_files_in_dir(html_dir)
+            with zipfile.ZipFile(zip_path) as epub_zip:
+                chapter = epub_zip.read('EPUB/chapter_2.xhtml').decode()
+                assert 'epub:type="chapter"' in chapter
+                assert '<blockquote><p>A quote.</p>' in chapter
+
+
+    def test_render_stats(self):
+        with _prepare_book_md_files(SIMPLE_BOOK_STRUCTURE) as book_dir:
+            out_dir = Path(book_dir) / 'site'
+            with SiteRenderer(BookSection(Path(book_dir)), site_kind=HTML,
+                              out_dir=out_dir, write_stats=True) as renderer:
+                report = renderer.render()
+            for stage in ['plan', 'scan', 'read', 'tokenize', 'citations',
+                          'render', 'write', 'navigation', 'close', 'mistune']:
+                assert report['stages'][stage]['num_calls'] > 0
+            assert set(report['sections']['chapter_2']) == {'read', 'tokenize', 'citations',
+                                                            'render', 'write'}
+            assert report['counters']['dir_bytes_written'] > 0
+            assert report['counters'].get('pandoc_calls', 0) == 0
+            with (out_dir / STATS_FNAME).open() as fhand:
+                assert json.load(fhand)['counters'] == report['counters']
+
+    def test_profile_memory(self):
+        with _prepare_book_md_files(SIMPLE_BOOK_STRUCTURE) as book_dir:
+            out_dir = Path(book_dir) / 'site'
+            with SiteRenderer(BookSection(Path(book_dir)), site_kind=HTML,
+                              out_dir=out_dir, profile_memory=True) as renderer:
+                report = renderer.render()
+            assert not tracemalloc.is_tracing()
+            memory = report['memory']
+            assert list(memory['stages']) == ['plan', 'sections', 'endnotes',
+                                              'bibliography', 'navigation',
+                                              'search_index', 'close']
+            assert memory['peak'] > 0
+            sections = memory['stages']['sections']
+            assert sections['peak'] >= sections['retained']
+            assert sections['structures']['sections_and_items'] > 0
+            assert any('site_creation.py' in allocation['site']
+                       for allocation in sections['top_allocations'])
+
+            with SiteRenderer(BookSection(Path(book_dir)), site_kind=HTML,
+                              out_dir=Path(book_dir) / 'site2') as renderer:
+                assert 'memory' not in renderer.render()
+
+            # the stage peaks of two profilers would mix, tracemalloc is global
+            profiler = MemoryProfiler()
+            profiler.start()
+            try:
+                with self.assertRaises(RuntimeError):
+                    with SiteRenderer(BookSection(Path(book_dir)), site_kind=HTML,
+                                      out_dir=Path(book_dir) / 'site3',
+                                      profile_memory=True) as renderer:
+                        renderer.render()
+                assert tracemalloc.is_tracing()
+            finally:
+                profiler.stop()
+            assert not tracemalloc.is_tracing()
+            with SiteRenderer(BookSection(Path(book_dir)), site_kind=HTML,
+                              out_dir=Path(book_dir) / 'site4',
+                              profile_memory=True) as renderer:
+                assert renderer.render()['memory']['peak'] > 0
+
+    def test_navigation(self):
+        with _prepare_book_md_files(PART_BOOK_STRUCTURE) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            zip_path = Path(tmp_dir) / 'book.epub'
+            with SiteRenderer(BookSection(Path(book_dir)), site_kind=EPUB3,
+                              zip_path=zip_path) as renderer:
+                renderer.render()
+            with zipfile.ZipFile(zip_path) as epub_zip:
+                ncx = epub_zip.read('EPUB/toc.ncx').decode()
+                opf = epub_zip.read('EPUB/content.opf').decode()
+                toc = epub_zip.read('EPUB/toc.xhtml').decode()
+            assert re.findall('id="([^"]+)" playOrder="([0-9]+)"', ncx) == [('toc', '1'), ('part_1', '2'), ('chapter_one', '3'), ('chapter_2', '4')]
+            assert re.findall('<itemref idref="([^"]+)"/>', opf) == ['toc', 'part_1', 'chapter_one', 'chapter_2']
+            assert '<content src="chapter_1.xhtml" />' in ncx
+            toc_items = re.findall('<li>|</li>|<ol>|</ol>', toc)
+            assert toc_items == ['<ol>', '<li>', '<ol>', '<li>', '</li>', '</ol>', '</li>', '<li>', '</li>', '</ol>']
+
+
+    def test_split_chapters(self):
+        with _prepare_book_md_files(SUBCHAPTER_BOOK_STRUCTURE) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            epubs = {}
+            for max_chapter_size in [None, 0]:
+                zip_path = Path(tmp_dir) / f'book_{max_chapter_size}.epub'
+                with SiteRenderer(BookSection(Path(book_dir)), site_kind=EPUB3,
+                                  zip_path=zip_path,
+                                  max_chapter_size=max_chapter_size) as renderer:
+                    renderer.render()
+                with zipfile.ZipFile(zip_path) as epub_zip:
+                    epubs[max_chapter_size] = {name: epub_zip.read(name).decode()
+                                               for name in epub_zip.namelist()}
+
+            files = epubs[None]
+            chapter = files['EPUB/chapter_1.xhtml']
+            assert '<h2>Second subchapter</h2>' in chapter
+            assert chapter.index('<span id="nav_span_chapter_1_2">') < chapter.index('Text 2.')
+            assert '<content src="chapter_1.xhtml#nav_span_chapter_1_2" />' in files['EPUB/toc.ncx']
+            assert re.findall('<itemref idref="([^"]+)"/>', files['EPUB/content.opf']) == ['toc', 'chapter_1']
+
+            files = epubs[0]
+            assert 'Text 2.' not in files['EPUB/chapter_1.xhtml']
+            assert 'Text 2.' in files['EPUB/chapter_1_2.xhtml']
+            assert 'epub:type="subchapter"' in files['EPUB/chapter_1_2.xhtml']
+            assert re.findall('<itemref idref="([^"]+)"/>', files['EPUB/content.opf']) == ['toc', 'chapter_1', 'chapter_1_1', 'chapter_1_2']
+            assert re.findall('id="([^"]+)" playOrder="([0-9]+)"', files['EPUB/toc.ncx']) == [('toc', '1'), ('chapter_1', '2'), ('chapter_1_1', '3'), ('chapter_1_2', '4')]
+            assert 'href="../EPUB/chapter_1_2.xhtml"' in files['EPUB/toc.xhtml']
+
+    def test_internal_links(self):
+        chapter1 = '# First chapter {#chapter_one}\nSee [the details](#details) and [the second chapter](#chapter_2).\n'
+        chapter2 = '# Second chapter\nText.\n\n## Details {#details}\nBack to [the first](#chapter_one).\n'
+        structure = _Directory(path='',
+                               content=[_MarkdownFile(path=Path('book.md'),
+                                                      content=SIMPLE_BOOK_METADATA),
+                                        _Directory(path=Path('chapter1'),
+                                                   content=[_MarkdownFile(path=Path('chapter1.md'),
+                                                                          content=chapter1)]),
+                                        _Directory(path=Path('chapter2'),
+                                                   content=[_MarkdownFile(path=Path('chapter2.md'),
+                                                                          content=chapter2)])])
+        with _prepare_book_md_files(structure) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            zip_path = Path(tmp_dir) / 'book.epub'
+            with SiteRenderer(BookSection(Path(book_dir)), site_kind=EPUB3,
+                              zip_path=zip_path) as renderer:
+                renderer.render()
+            assert renderer.validation_errors == []
+            with zipfile.ZipFile(zip_path) as epub_zip:
+                chapter1_html = epub_zip.read('EPUB/chapter_1.xhtml').decode()
+                chapter2_html = epub_zip.read('EPUB/chapter_2.xhtml').decode()
+            assert '<a  href="../EPUB/chapter_2.xhtml#details">the details</a>' in chapter1_html
+            assert 'href="../EPUB/chapter_2.xhtml#nav_span_chapter_2"' in chapter1_html
+            assert '<h1>First chapter</h1>' in chapter1_html
+            assert '<h2 id="details">Details</h2>' in chapter2_html
+            assert 'href="../EPUB/chapter_1.xhtml#nav_span_chapter_one"' in chapter2_html
+
+            path = Path(book_dir) / 'chapter2' / 'chapter2.md'
+            path.write_text(chapter2.replace('#chapter_one', '#missing') + 'A [link](#gone).\n')
+            with self.assertRaises(ValueError) as context:
+                with SiteRenderer(BookSection(Path(book_dir)), site_kind=HTML,
+                                  out_dir=Path(tmp_dir) / 'site') as renderer:
+                    renderer.render()
+            assert '#missing in chapter_2, #gone in chapter_2' in str(context.exception)
+            assert not (Path(tmp_dir) / 'site').exists()
+
+
+
+def _read_files_in_epub(zip_path):
+    # the modification date is the only thing that changes between renders
+    with zipfile.ZipFile(zip_path) as epub_zip:
+        return {name: re.sub(b'<meta property="dcterms:modified">[^<]*</meta>', b'',
+                             epub_zip.read(name))
+                for name in epub_zip.namelist()}
+
+
+def _render_synthetic_book(book_dir, site_kind, out_path, render_cache):
+    target = {'zip_path': out_path} if site_kind == EPUB3 else {'out_dir': out_path}
+    with SiteRenderer(BookSection(book_dir), site_kind=site_kind,
+                      render_cache=render_cache, **target) as renderer:
+        renderer.render()
+    if site_kind == EPUB3:
+        return _read_files_in_epub(out_path)
+    return _read_files_in_dir(out_path)
+
+
+def _assert_citations_resolved(files, site_kind):
+    if site_kind == EPUB3:
+        endnotes, bibliography = files['EPUB/endnotes.xhtml'], files['EPUB/bibliography.xhtml']
+    else:
+        endnotes = files['section/endnotes.html']
+        bibliography = files['section/bibliography.html']
+    assert b'id="endnotes_1"' in endnotes
+    assert b'<li>Author' in bibliography
+
+
+class ConcurrentRenderTest(unittest.TestCase):
+    def setUp(self):
+        self._pandoc_bin = references.PANDOC_BIN
+        references.PANDOC_BIN = str(PANDOC_STUB_PATH)
+
+    def tearDown(self):
+        references.PANDOC_BIN = self._pandoc_bin
+
+    def test_concurrent_renders(self):
+        # every thread has its own book and renderer, only the cache is shared
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            book_dir = tmp_dir / 'book'
+            create_synthetic_book(book_dir, num_parts=1, chapters_per_part=3,
+                                  subchapters_per_chapter=1,
+                                  paragraphs_per_section=3, bibliography_size=10)
+            expected = {site_kind: _render_synthetic_book(book_dir, site_kind,
+                                                          tmp_dir / f'expected_{site_kind}',
+                                                          RenderCache())
+                        for site_kind in (HTML, EPUB3)}
+            for site_kind, files in expected.items():
+                _assert_citations_resolved(files, site_kind)
+
+            render_cache = RenderCache()
+            site_kinds = [HTML, EPUB3] * 4
+            with ThreadPoolExecutor(max_workers=len(site_kinds)) as pool:
+                futures = [pool.submit(_render_synthetic_book, book_dir, site_kind,
+                                       tmp_dir / f'out_{idx}_{site_kind}', render_cache)
+                           for idx, site_kind in enumerate(site_kinds)]
+                results = [future.result() for future in futures]
+            for site_kind, files in zip(site_kinds, results):
+                assert files == expected[site_kind]
+            assert render_cache.citations
+
+    def test_render_async(self):
+        async def render_books(book_dir, out_dirs):
+            # one pandoc at a time for all the books
+            pandoc_semaphore = asyncio.Semaphore(1)
+            render_cache = RenderCache()
+            renderers = [SiteRenderer(BookSection(book_dir), site_kind=HTML,
+                                      out_dir=out_dir, render_cache=render_cache)
+                         for out_dir in out_dirs]
+            return await asyncio.gather(*[renderer.render_async(pandoc_semaphore)
+                                          for renderer in renderers])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            book_dir = tmp_dir / 'book'
+            create_synthetic_book(book_dir, num_parts=1, chapters_per_part=3,
+                                  paragraphs_per_section=3, bibliography_size=10)
+            expected = _render_synthetic_book(book_dir, HTML, tmp_dir / 'expected',
+                                              RenderCache())
+            out_dirs = [tmp_dir / f'out_{idx}' for idx in range(3)]
+            reports = asyncio.run(render_books(book_dir, out_dirs))
+            for out_dir in out_dirs:
+                files = _read_files_in_dir(out_dir)
+                _assert_citations_resolved(files, HTML)
+                assert files == expected
+            assert sum(report['counters'].get('pandoc_calls', 0) for report in reports) >= 3
+
+    def test_render_async_more_books_than_workers(self):
+        # every worker of the default executor is a render that waits for
+        # its pandoc coroutine, the coroutines can not need those workers
+        num_workers = 2
+
+        async def render_books(book_dir, out_dirs):
+            loop = asyncio.get_running_loop()
+            loop.set_default_executor(ThreadPoolExecutor(max_workers=num_workers))
+            renderers = [SiteRenderer(BookSection(book_dir), site_kind=HTML,
+                                      out_dir=out_dir, render_cache=RenderCache())
+                         for out_dir in out_dirs]
+            return await asyncio.wait_for(asyncio.gather(*[renderer.render_async()
+                                                           for renderer in renderers]),
+                                          timeout=60)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            book_dir = tmp_dir / 'book'
+            create_synthetic_book(book_dir, num_parts=1, chapters_per_part=3,
+                                  paragraphs_per_section=3, bibliography_size=10)
+            out_dirs = [tmp_dir / f'out_{idx}' for idx in range(num_workers * 3)]
+            asyncio.run(render_books(book_dir, out_dirs))
+            for out_dir in out_dirs:
+                _assert_citations_resolved(_read_files_in_dir(out_dir), HTML)
+
+    def test_reentrant_render(self):
+        with _prepare_book_md_files(SIMPLE_BOOK_STRUCTURE) as book_dir:
+            out_dir = Path(book_dir) / 'site'
+            renderer = SiteRenderer(BookSection(Path(book_dir)), site_kind=HTML,
+                                    out_dir=out_dir, incremental=True)
+            with renderer:
+                renderer.render()
+            files = _read_files_in_dir(out_dir)
+            note_lis = dict(renderer.note_lis)
+            with renderer:
+                renderer.render()
+            assert _read_files_in_dir(out_dir) == files
+            assert dict(renderer.note_lis) == note_lis
+
+            renderer._render_lock.acquire()
+            try:
+                with self.assertRaises(RuntimeError):
+                    renderer.render()
+            finally:
+                renderer._render_lock.release()
+
+
+if __name__ == '__main__':
+    unittest.main()
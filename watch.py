@@ -0,0 +1,217 @@
+
+# Rebuilds the html site when the book changes and serves it with live reload
+# python watch.py book_dir out_dir
+
+import argparse
+import functools
+import threading
+import time
+import traceback
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from book_section import BookSection
+from site_creation import (SiteRenderer, RenderCache, HTML, HTML_CHAPTER_DIR,
+                           TOC_CHAPTER_BASE_NAME)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8000
+POLL_INTERVAL = 0.2
+
+RELOAD_URL = '/__md2epub_build_id'
+RELOAD_SCRIPT = '''<script>
+(function () {{
+  var buildId = {build_id};
+  setInterval(function () {{
+    fetch('{reload_url}').then(function (response) {{
+      return response.text();
+    }}).then(function (text) {{
+      if (parseInt(text) !== buildId) {{
+        window.location.reload();
+      }}
+    }}).catch(function () {{}});
+  }}, 500);
+}})();
+</script>
+'''
+
+
+def _get_book_snapshot(dir_):
+    # mtimes and sizes of the md files and the directories, the hidden ones
+    # are not part of the book
+    snapshot = {}
+    for path in dir_.iterdir():
+        if path.name.startswith('.'):
+            continue
+        if path.is_dir():
+            snapshot[path] = None
+            snapshot.update(_get_book_snapshot(path))
+        elif path.suffix == '.md':
+            stat = path.stat()
+            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+def _inject_reload_script(html, build_id):
+    script = RELOAD_SCRIPT.format(build_id=build_id, reload_url=RELOAD_URL)
+    idx = html.rfind('</body>')
+    if idx == -1:
+        return html + script
+    return html[:idx] + script + html[idx:]
+
+
+class BookWatcher:
+    def __init__(self, book_dir, out_dir):
+        book_dir = book_dir.resolve()
+        out_dir = out_dir.resolve()
+        if book_dir == out_dir or book_dir in out_dir.parents:
+            msg = 'The out_dir can not be inside the book dir, it would be taken as a chapter'
+            raise ValueError(msg)
+        self.book_dir = book_dir
+        self.out_dir = out_dir
+        self.build_id = 0
+        self.sections_rendered = None
+        # the markdown and the citations are cached between builds
+        self.render_cache = RenderCache()
+        self.book = BookSection(book_dir)
+        self._snapshot = self._get_snapshot()
+
+    def build(self):
+        start = time.perf_counter()
+        with SiteRenderer(self.book, site_kind=HTML, out_dir=self.out_dir,
+                          incremental=True,
+                          render_cache=self.render_cache) as renderer:
+            renderer.render()
+        self.render_cache.drop_unused()
+        self.sections_rendered = renderer.sections_rendered
+        self.build_id += 1
+        print(f'Build {self.build_id} done in {time.perf_counter() - start:.3f} s')
+
+    def _get_snapshot(self):
+        # the bibliography can be anywhere, not only in the book dir
+        snapshot = _get_book_snapshot(self.book_dir)
+        bibliography_path = self.book.bibliography_path
+        if bibliography_path is not None and bibliography_path.is_file():
+            stat = bibliography_path.stat()
+            snapshot[bibliography_path.resolve()] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def _get_changed_paths(self):
+        snapshot = self._get_snapshot()
+        previous_snapshot = self._snapshot
+        self._snapshot = snapshot
+        changed_paths = {path for path, stat in snapshot.items()
+                         if path not in previous_snapshot or previous_snapshot[path] != stat}
+        changed_paths.update(path for path in previous_snapshot
+                             if path not in snapshot)
+        return changed_paths
+
+    def _update_book(self, changed_paths):
+        # The tree is kept if the directories did not change, only the
+        # sections whose files changed read their headers again
+        sections_by_dir = {section.dir: section
+                           for section in self.book._walk_book_sections(stop_in_me=False)}
+        bibliography_path = self.book.bibliography_path
+        if bibliography_path is not None:
+            bibliography_path = bibliography_path.resolve()
+        sections_to_refresh = []
+        for path in changed_paths:
+            if path == bibliography_path:
+                # the cached pandoc results refer to the old bibliography
+                self.render_cache.clear_citations()
+                continue
+            section = sections_by_dir.get(path.parent)
+            if section is None or path.suffix != '.md':
+                self.book = BookSection(self.book_dir)
+                return
+            sections_to_refresh.append(section)
+
+        for section in sections_to_refresh:
+            kind = section.kind
+            section.refresh()
+            if section.kind != kind:
+                self.book = BookSection(self.book_dir)
+                return
+
+    def check_and_build(self):
+        changed_paths = self._get_changed_paths()
+        if not changed_paths:
+            return False
+        self._update_book(changed_paths)
+        self.build()
+        return True
+
+
+class _PreviewRequestHandler(SimpleHTTPRequestHandler):
+    def __init__(self, *args, watcher, **kwargs):
+        self.watcher = watcher
+        super().__init__(*args, directory=str(watcher.out_dir), **kwargs)
+
+    def _send_text(self, text, content_type):
+        data = text.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url_path = self.path.split('?', 1)[0]
+        if url_path == RELOAD_URL:
+            self._send_text(str(self.watcher.build_id), 'text/plain')
+            return
+        if url_path == '/':
+            self.send_response(302)
+            self.send_header('Location', f'/{HTML_CHAPTER_DIR}/{TOC_CHAPTER_BASE_NAME}.html')
+            self.end_headers()
+            return
+        path = Path(self.translate_path(url_path))
+        if path.suffix == '.html' and path.is_file():
+            html = _inject_reload_script(path.read_text(), self.watcher.build_id)
+            self._send_text(html, 'text/html; charset=utf-8')
+            return
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_preview_server(watcher, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    handler = functools.partial(_PreviewRequestHandler, watcher=watcher)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def watch(book_dir, out_dir, host=DEFAULT_HOST, port=DEFAULT_PORT,
+          poll_interval=POLL_INTERVAL):
+    watcher = BookWatcher(book_dir, out_dir)
+    watcher.build()
+
+    server = create_preview_server(watcher, host, port)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    print(f'Serving {watcher.out_dir} at http://{host}:{server.server_port}/')
+
+    try:
+        while True:
+            time.sleep(poll_interval)
+            try:
+                watcher.check_and_build()
+            except Exception:
+                # a broken file should not stop the watch, the author will fix it
+                traceback.print_exc()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild and serve the html site while the book is edited')
+    parser.add_argument('book_dir', type=Path)
+    parser.add_argument('out_dir', type=Path)
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+    watch(args.book_dir, args.out_dir, host=args.host, port=args.port)
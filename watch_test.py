@@ -0,0 +1,118 @@
+
+import unittest
+import tempfile
+import threading
+import urllib.request
+from pathlib import Path
+
+import references
+from book_section_test import _prepare_book_md_files
+from site_creation_test import SIMPLE_BOOK_STRUCTURE, SUBCHAPTER_BOOK_STRUCTURE
+from watch import BookWatcher, create_preview_server, RELOAD_URL
+from benchmarks.synthetic_book import create_synthetic_book
+from benchmarks.run_benchmarks import PANDOC_STUB_PATH
+
+
+class WatchTest(unittest.TestCase):
+    def test_rebuild_changed_sections(self):
+        with _prepare_book_md_files(SIMPLE_BOOK_STRUCTURE) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            watcher = BookWatcher(Path(book_dir), Path(tmp_dir) / 'site')
+            watcher.build()
+            assert watcher.sections_rendered == ['chapter_one', 'chapter_2']
+            assert not watcher.check_and_build()
+
+            path = Path(book_dir) / 'chapter2' / 'chapter2.md'
+            path.write_text(path.read_text().replace('# Second chapter',
+                                                     '# Renamed chapter'))
+            assert watcher.check_and_build()
+            assert watcher.sections_rendered == ['chapter_2']
+            chapter = (watcher.out_dir / 'section' / 'chapter_2.html').read_text()
+            assert 'Renamed chapter' in chapter
+
+            chapter3_dir = Path(book_dir) / 'chapter3'
+            chapter3_dir.mkdir()
+            (chapter3_dir / 'chapter3.md').write_text('# Third chapter\nText.\n')
+            assert watcher.check_and_build()
+            assert watcher.sections_rendered == ['chapter_3']
+            assert watcher.build_id == 3
+
+            # only the blocks of the last build are kept in the cache
+            blocks = watcher.render_cache.render_markdown._blocks
+            assert list(blocks) == ['Text.']
+
+    def test_subchapter_ids(self):
+        with _prepare_book_md_files(SUBCHAPTER_BOOK_STRUCTURE) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            watcher = BookWatcher(Path(book_dir), Path(tmp_dir) / 'site')
+            watcher.build()
+            path = Path(book_dir) / 'chapter1' / 'chapter1.md'
+            path.write_text('# First chapter {#intro}\nIntro.\n')
+            assert watcher.check_and_build()
+            ids = [section.id for section in watcher.book._walk_book_sections(stop_in_me=False)]
+            assert ids == [None, 'intro', 'intro_1', 'intro_2']
+
+    def test_bibliography_change(self):
+        pandoc_bin = references.PANDOC_BIN
+        references.PANDOC_BIN = str(PANDOC_STUB_PATH)
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                book_dir = Path(tmp_dir) / 'book'
+                res = create_synthetic_book(book_dir, num_parts=1, chapters_per_part=2,
+                                            paragraphs_per_section=2, bibliography_size=5)
+                watcher = BookWatcher(book_dir, Path(tmp_dir) / 'site')
+                watcher.build()
+                render_cache = watcher.render_cache
+                assert render_cache.citations
+                assert not watcher.check_and_build()
+
+                path = res['bibliography_path']
+                path.write_text(path.read_text().replace('Book number', 'Revised book'))
+                assert watcher.check_and_build()
+                assert watcher.render_cache is render_cache
+                assert watcher.sections_rendered == ['chapter_1', 'chapter_2']
+                endnotes = (watcher.out_dir / 'section' / 'endnotes.html').read_text()
+                assert '<em>Revised book' in endnotes
+                assert '<em>Book number' not in endnotes
+
+                # the book points to another bibliography
+                new_path = Path(tmp_dir) / 'new_bibliography.json'
+                new_path.write_text(path.read_text().replace('Revised book', 'New book'))
+                book_path = book_dir / 'book.md'
+                book_path.write_text(book_path.read_text().replace(str(path), str(new_path)))
+                assert watcher.check_and_build()
+                assert watcher.book.bibliography_path == new_path
+                endnotes = (watcher.out_dir / 'section' / 'endnotes.html').read_text()
+                assert '<em>New book' in endnotes
+                assert len(render_cache.citations) == len(watcher.sections_rendered)
+        finally:
+            references.PANDOC_BIN = pandoc_bin
+
+    def test_out_dir_in_book_dir(self):
+        with _prepare_book_md_files(SIMPLE_BOOK_STRUCTURE) as book_dir:
+            with self.assertRaises(ValueError):
+                BookWatcher(Path(book_dir), Path(book_dir) / 'site')
+
+    def test_preview_server(self):
+        with _prepare_book_md_files(SIMPLE_BOOK_STRUCTURE) as book_dir, \
+             tempfile.TemporaryDirectory() as tmp_dir:
+            watcher = BookWatcher(Path(book_dir), Path(tmp_dir) / 'site')
+            watcher.build()
+            server = create_preview_server(watcher, port=0)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            try:
+                base_url = f'http://127.0.0.1:{server.server_port}'
+                with urllib.request.urlopen(base_url + '/section/chapter_2.html') as response:
+                    html = response.read().decode()
+                assert html.index('<script>') < html.index('</body>')
+                assert 'var buildId = 1;' in html
+                with urllib.request.urlopen(base_url + RELOAD_URL) as response:
+                    assert response.read() == b'1'
+            finally:
+                server.shutdown()
+                server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()